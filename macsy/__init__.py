@@ -7,4 +7,4 @@ we have built a modular system by combining multiple AI modules into a flexible
 This framework (Macsy) is flexible and allows the design and implementation of modular agents, where simple modules cooperate in the annotation of a large dataset without central coordination via a blackboard system.
 """
 
-__all__ = ['api', 'blackboards', 'cursors', 'managers', 'utils']
\ No newline at end of file
+__all__ = ['analytics', 'api', 'archives', 'backends', 'bitmaps', 'blackboards', 'catalogs', 'cursors', 'inheritance', 'joins', 'managers', 'mappers', 'replicas', 'schedulers', 'utils', 'writers']
\ No newline at end of file
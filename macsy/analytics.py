@@ -0,0 +1,124 @@
+'''Analytics computed on the database server and returned as compact results rather than documents.'''
+
+import numpy as np
+from collections import namedtuple
+from macsy.utils import run_concurrently
+
+TagPeriodMatrix = namedtuple('TagPeriodMatrix', ['counts', 'tags', 'periods'])
+TagPeriodMatrix.__doc__ = '''Number of documents annotated with each tag in each period.
+
+    The **counts** are a :class:`numpy.ndarray` with a row for each of the **tags** (names)
+    and a column for each of the **periods** (the :class:`datetime.datetime` each period starts at).
+'''
+
+def build_tag_period_matrix(periods, counts, tag_names):
+    '''Build a :class:`TagPeriodMatrix` from the per-tag period counts of a document manager.'''
+    tag_ids = list(counts)
+    matrix = np.array([counts[tag_id] for tag_id in tag_ids], dtype=np.int64).reshape(len(tag_ids), len(periods))
+    return TagPeriodMatrix(matrix, [tag_names.get(tag_id, tag_id) for tag_id in tag_ids], list(periods))
+
+class CooccurrenceMatrix():
+    '''Sparse matrix of the number of documents in which each pair of tags occur together.
+
+    The counts are held in coordinate form in NumPy arrays, for the upper triangle of the matrix
+    (each pair once, with **rows** <= **cols**), and the diagonal holds the number of documents with each tag.
+
+    Example:
+        >>> matrix = blackboard.count_cooccurrences(min_date=['2017-01-01'])
+        >>> matrix.get('Tag_1', 'Tag_2')
+        >>> for tag_a, tag_b, count in matrix.most_common(10):
+        >>> ... print(tag_a, tag_b, count)
+    '''
+
+    def __init__(self, tag_ids, rows, cols, counts, names):
+        self.tag_ids = tag_ids
+        self.rows = rows
+        self.cols = cols
+        self.counts = counts
+        self.names = names
+        self._index = {tag_id : index for index, tag_id in enumerate(tag_ids.tolist())}
+        self._ids = {name : tag_id for tag_id, name in names.items()}
+
+    def get(self, tag_a, tag_b):
+        '''Get the number of documents with both tags, given by id or name.
+
+        Returns:
+            :class:`int`: number of documents annotated with both tags.
+        '''
+        a, b = sorted(self._index.get(self._ids.get(tag, tag), -1) for tag in [tag_a, tag_b])
+        if a < 0:
+            return 0
+        match = np.flatnonzero((self.rows == a) & (self.cols == b))
+        return int(self.counts[match[0]]) if len(match) else 0
+
+    def most_common(self, n=None):
+        '''Get the pairs of different tags which occur together most often.
+
+        Returns:
+            :class:`list[tuple]`: (tag name, tag name, count) for the **n** most common pairs.
+        '''
+        off_diagonal = np.flatnonzero(self.rows != self.cols)
+        order = off_diagonal[np.argsort(-self.counts[off_diagonal], kind='stable')][:n]
+        return [(self._name(self.rows[i]), self._name(self.cols[i]), int(self.counts[i])) for i in order]
+
+    def to_dense(self):
+        '''Convert to a dense, symmetric :class:`numpy.ndarray`, with rows and columns in the order of **tag_ids**.'''
+        dense = np.zeros((len(self.tag_ids), len(self.tag_ids)), dtype=np.int64)
+        dense[self.rows, self.cols] = self.counts
+        dense[self.cols, self.rows] = self.counts
+        return dense
+
+    def _name(self, index):
+        tag_id = int(self.tag_ids[index])
+        return self.names.get(tag_id, tag_id)
+
+class CooccurrenceAccumulator():
+    '''Accumulates tag pair counts from batches of tag arrays, holding only the distinct pairs seen so far.'''
+
+    def __init__(self):
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._pairs = {}
+
+    def add(self, tag_arrays):
+        keys = [self._pair_keys(tags) for tags in tag_arrays if tags]
+        if keys:
+            self._merge(np.concatenate(keys), None)
+        return self
+
+    def update(self, other):
+        self._merge(other._keys, other._counts)
+        return self
+
+    def to_matrix(self, names):
+        tag_ids, inverse = np.unique(np.concatenate([self._keys >> 32, self._keys & 0xFFFFFFFF]), return_inverse=True)
+        rows, cols = inverse[:len(self._keys)], inverse[len(self._keys):]
+        return CooccurrenceMatrix(tag_ids, rows, cols, self._counts, names)
+
+    def _pair_keys(self, tags):
+        tags = np.unique(np.asarray(tags, dtype=np.int64))
+        if len(tags) not in self._pairs:
+            self._pairs[len(tags)] = np.triu_indices(len(tags))
+        upper = self._pairs[len(tags)]
+        return (tags[upper[0]] << 32) | tags[upper[1]]
+
+    def _merge(self, keys, counts):
+        keys = np.concatenate([self._keys, keys])
+        counts = np.concatenate([self._counts, np.ones(len(keys) - len(self._keys), dtype=np.int64) if counts is None else counts])
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        self._counts = np.bincount(inverse, weights=counts, minlength=len(self._keys)).astype(np.int64)
+
+def count_cooccurrences(cursors, field, names, batch_size=10000):
+    '''Count the co-occurrences of the tags in **field** of the documents of each cursor, streaming the cursors concurrently.'''
+    def accumulate(cursor):
+        accumulator, batch = CooccurrenceAccumulator(), []
+        for doc in cursor:
+            batch.append(doc.get(field))
+            if len(batch) >= batch_size:
+                accumulator.add(batch)
+                batch = []
+        return accumulator.add(batch)
+    total = CooccurrenceAccumulator()
+    for accumulator in run_concurrently(accumulate, cursors):
+        total.update(accumulator)
+    return total.to_matrix(names)
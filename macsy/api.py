@@ -4,7 +4,10 @@ import urllib.parse
 from macsy.utils import validate_settings, validate_blackboard_name
 from pymongo import MongoClient
 from macsy.blackboards import Blackboard, DateBasedBlackboard
-from macsy.managers import TagManager, DocumentManager, DateBasedDocumentManager, CounterManager
+from macsy.catalogs import BlackboardCatalog
+from macsy.managers import TagManager, DocumentManager, DateBasedDocumentManager, CounterManager, RollupManager
+from macsy.inheritance import TagPropagator
+from macsy.schedulers import BackfillScheduler
 
 class BlackboardAPI():
     '''Entry object for loading and deleting blackboards.
@@ -32,7 +35,7 @@ class BlackboardAPI():
                 username, password, dbname (database name) and dburl (database url).
             MongoClient (:class:`MongoClient`, optional): optional :class:`MongoClient` to use, generally
                 useful for mocking, and testing the blackboards without connecting to a real
-                database.
+                database, or a storage backend such as :class:`MemoryClient<macsy.backends.MemoryClient>`.
 
         Raises:
             :class:`ValueError`: If incorrect or incomplete database settings are provided.
@@ -46,8 +49,22 @@ class BlackboardAPI():
         self.__dburl = settings[
             BlackboardAPI._setting_fields.get('dburl')].replace('mongodb://', '').strip('/')
         self.__admin_mode = self._check_admin_attempt(settings)
+        self.__settings = dict(settings)
+        self.__mongo_client = MongoClient
         self.__client = MongoClient(self._get_connection_string(settings))
         self.__db = self.__client[self.__dbname]
+        self.__catalog = BlackboardCatalog(self.__db)
+
+    def get_catalog(self, refresh=False):
+        '''Get the cached catalog of the blackboards in the database.
+
+        Args:
+            refresh (:class:`bool`, optional): re-read the catalog from the database first.
+
+        Returns:
+            :class:`BlackboardCatalog<macsy.catalogs.BlackboardCatalog>`: the catalog.
+        '''
+        return self.__catalog.refresh() if refresh else self.__catalog
 
     def get_blackboard_names(self):
         '''Retrieve a list of all available blackboard names.
@@ -55,12 +72,7 @@ class BlackboardAPI():
         Returns:
             :class:`list[str]`: names of available blackboards.
         '''
-        suffix_len = len(CounterManager.counter_suffix)
-        collections = self.__db.collection_names(include_system_collections=False)
-        blackboards = (coll[0:-suffix_len] for coll in collections if coll.endswith(CounterManager.counter_suffix))
-        blackboards = [blackboard for blackboard in blackboards if self.blackboard_exists(blackboard.split('_')[0])]
-
-        return blackboards
+        return self.__catalog.get_names()
 
     @validate_blackboard_name
     def blackboard_exists(self, blackboard_name):
@@ -75,11 +87,7 @@ class BlackboardAPI():
         Raises:
             :class:`ValueError`: If **blackboard_name** contains forbidden characters.
         '''
-        collection = self.__db[blackboard_name + CounterManager.counter_suffix]
-        result = collection.find_one({CounterManager.counter_id : CounterManager.counter_type})
-        if result:
-            return True
-        return False
+        return self.__catalog.get(blackboard_name, refresh=True) is not None
 
     @validate_blackboard_name
     def load_blackboard(self, blackboard_name, date_based=None):
@@ -96,7 +104,7 @@ class BlackboardAPI():
         Raises:
             :class:`ValueError`: If **blackboard_name** contains forbidden characters.
         '''
-        settings = (self.__db, blackboard_name, self.__admin_mode)
+        settings = (self.__db, blackboard_name, self.__admin_mode, self)
         return DateBasedBlackboard(settings) \
             if self.get_blackboard_type(blackboard_name, date_based) == \
             CounterManager.counter_type_date_based else Blackboard(settings)
@@ -127,6 +135,7 @@ class BlackboardAPI():
                 CounterManager.counter_type_date_based : self.__drop_date_based_blackboard}
             blackboard_type = self.get_blackboard_type(blackboard_name)
             drop_method[blackboard_type](blackboard_name)
+            self.__catalog.invalidate(blackboard_name)
 
     @validate_blackboard_name
     def get_blackboard_type(self, blackboard_name, date_based=None):
@@ -142,15 +151,16 @@ class BlackboardAPI():
         Raises:
             :class:`ValueError`: If **blackboard_name** contains forbidden characters.
         '''
-        collection = self.__db[blackboard_name + CounterManager.counter_suffix]
-        result = collection.find_one({CounterManager.counter_id : CounterManager.counter_type})
-        if result is not None:
-            BlackboardAPI._check_blackboard_type_errors((blackboard_name, \
-                result.get(CounterManager.counter_type), date_based))
-            return result.get(CounterManager.counter_type)
+        info = self.__catalog.get(blackboard_name, refresh=True)
+        if info is not None:
+            BlackboardAPI._check_blackboard_type_errors((blackboard_name, info.type, date_based))
+            return info.type
         types = {True: CounterManager.counter_type_date_based, False: CounterManager.counter_type_standard, None: None}
         return types[date_based]
 
+    def _get_connection(self):
+        return (dict(self.__settings), self.__mongo_client)
+
     @validate_settings
     def _get_connection_string(self, settings):
         settings = (self.__username, self.__password, \
@@ -165,15 +175,19 @@ class BlackboardAPI():
         return True
 
     def __drop_standard_blackboard(self, blackboard_name):
-        for suffix in ['', CounterManager.counter_suffix, TagManager.tag_suffix]:
-            self.__db.drop_collection(blackboard_name + suffix)
+        for coll in [blackboard_name] + self.__get_auxiliary_collections(blackboard_name):
+            self.__db.drop_collection(coll)
 
     def __drop_date_based_blackboard(self, blackboard_name):
-        for coll in self.__db.collection_names():
-            suffix = coll.split('_')[-1]
-            if blackboard_name == coll.split('_')[0] and (suffix.isdigit() or \
-                suffix in CounterManager.counter_suffix or TagManager.tag_suffix):
-                self.__db.drop_collection(coll)
+        collections = list(self.__catalog.get(blackboard_name).collections.values())
+        for coll in collections + self.__get_auxiliary_collections(blackboard_name):
+            self.__db.drop_collection(coll)
+
+    @staticmethod
+    def __get_auxiliary_collections(blackboard_name):
+        suffixes = [CounterManager.counter_suffix, TagManager.tag_suffix, RollupManager.rollup_suffix,
+            BackfillScheduler.checkpoint_suffix, TagPropagator.state_suffix]
+        return [blackboard_name + suffix for suffix in suffixes]
 
     @staticmethod
     def _check_blackboard_type_errors(ntd):
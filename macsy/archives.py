@@ -0,0 +1,198 @@
+'''Archives hold the documents of cold partitions in compressed local chunk files, which are read through transparently.'''
+
+import os
+import gzip
+from copy import deepcopy
+from itertools import islice
+from bson import BSON, decode_all
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.raw_bson import RawBSONDocument
+from macsy.utils import LRUCache, match, project, is_operator_condition
+
+class PartitionArchive():
+    '''Read-only, collection-like view of the documents of an archived partition.
+
+    The documents are stored in id order in gzip-compressed chunk files of concatenated BSON, next to an index file
+    holding the id range of each chunk, so a query with bounds on ``_id`` only decompresses the chunks overlapping them.
+    All other conditions are evaluated on the client with :func:`match()<macsy.utils.match>`. The archive supports the reading parts
+    of the :class:`pymongo.collection.Collection` interface used by the document managers: :meth:`find`,
+    :meth:`find_one`, :meth:`estimated_document_count` and :meth:`with_options`.
+
+    Archives are created by :meth:`archive()<macsy.blackboards.DateBasedBlackboard.archive>`, see :func:`write_archive`.
+    '''
+
+    index_file = 'index.bson'
+    chunk_file = 'chunk_{:06d}.bson.gz'
+    chunk_cache_size = 4
+
+    def __init__(self, path, codec_options=DEFAULT_CODEC_OPTIONS, cache=None):
+        self.path = path
+        self.codec_options = codec_options
+        self._index = None
+        self._cache = cache if cache is not None else LRUCache(PartitionArchive.chunk_cache_size)
+
+    @property
+    def name(self):
+        ''':class:`str`: name of the collection the documents were archived from.'''
+        return self._get_index()['name']
+
+    def find(self, filter=None, projection=None):
+        '''Find the archived documents matching a query, in ascending id order unless sorted otherwise.
+
+        Returns:
+            :class:`ArchiveCursor`: cursor over the matching documents.
+        '''
+        return ArchiveCursor(self, filter or {}, projection)
+
+    def find_one(self, filter=None, projection=None):
+        return next(self.find(filter, projection).limit(1), None)
+
+    def estimated_document_count(self):
+        return self._get_index()['count']
+
+    def with_options(self, codec_options=None, **kwargs):
+        return PartitionArchive(self.path, codec_options or self.codec_options, self._cache)
+
+    def get_chunks(self, query=None):
+        '''Get the index entries of the chunks which may hold documents matching the ``_id`` bounds of a query.'''
+        lower, upper = id_bounds(query or {})
+        return [chunk for chunk in self._get_index()['chunks'] if _in_range(chunk, lower, upper)]
+
+    def _scan(self, query, order):
+        chunks = self.get_chunks(query)
+        for chunk in (chunks if order > 0 else reversed(chunks)):
+            docs = self._read_chunk(chunk['file'])
+            for doc in (docs if order > 0 else reversed(docs)):
+                if match(doc, query):
+                    yield doc
+
+    def _read_chunk(self, file_name):
+        key = (file_name, self.codec_options.document_class)
+        docs = self._cache.get(key)
+        if docs is None:
+            with open(os.path.join(self.path, file_name), 'rb') as chunk:
+                docs = decode_all(gzip.decompress(chunk.read()), self.codec_options)
+            self._cache.put(key, docs)
+        return docs
+
+    def _get_index(self):
+        if self._index is None:
+            with open(os.path.join(self.path, PartitionArchive.index_file), 'rb') as index:
+                self._index = BSON(index.read()).decode()
+        return self._index
+
+class ArchiveCursor():
+    '''Cursor over the documents of a :class:`PartitionArchive`, supporting the :class:`pymongo.cursor.Cursor` methods used for reading.
+
+    Documents can only be sorted by ``_id``. The returned documents are copies, so changing them does not change the cached chunks.
+    '''
+
+    def __init__(self, archive, query, projection):
+        self.collection = archive
+        self._query = query
+        self._projection = projection
+        self._order = 1
+        self._limit = 0
+        self._count = None
+        self._docs = None
+
+    def sort(self, key_or_list, direction=None):
+        keys = [(key_or_list, direction or 1)] if isinstance(key_or_list, str) else list(key_or_list)
+        if len(keys) != 1 or keys[0][0] != '_id':
+            raise ValueError('Archived documents can only be sorted by _id: {}'.format(keys))
+        self._order = keys[0][1]
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def hint(self, index):
+        # Archives have no indexes, only the id ranges of their chunks
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        if self._count is None:
+            self._count = self.collection.estimated_document_count() if not self._query else sum(1 for _ in self.collection._scan(self._query, 1))
+        return min(self._count, self._limit) if with_limit_and_skip and self._limit else self._count
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._docs is None:
+            docs = self.collection._scan(self._query, self._order)
+            self._docs = islice(docs, self._limit) if self._limit else docs
+        doc = project(next(self._docs), self._projection)
+        return doc if isinstance(doc, RawBSONDocument) else deepcopy(doc)
+
+def write_archive(docs, path, name, chunk_size=10000, compresslevel=6):
+    '''Write documents to a new archive in the directory **path**, in chunks of **chunk_size** documents.
+
+    The documents must be in ascending id order. The index is written last, so an interrupted
+    write does not leave a readable archive behind.
+
+    Returns:
+        :class:`PartitionArchive`: the archive.
+
+    Raises:
+        :class:`FileExistsError`: If **path** already holds an archive.
+    '''
+    if os.path.exists(os.path.join(path, PartitionArchive.index_file)):
+        raise FileExistsError('{} already holds an archive'.format(path))
+    os.makedirs(path, exist_ok=True)
+    chunks, count, docs = [], 0, iter(docs)
+    while True:
+        batch = list(islice(docs, chunk_size))
+        if not batch:
+            break
+        file_name = PartitionArchive.chunk_file.format(len(chunks))
+        with open(os.path.join(path, file_name), 'wb') as chunk:
+            chunk.write(gzip.compress(b''.join(BSON.encode(doc) for doc in batch), compresslevel))
+        chunks.append({'file' : file_name, 'min' : batch[0]['_id'], 'max' : batch[-1]['_id'], 'n' : len(batch)})
+        count += len(batch)
+    temp_file = os.path.join(path, PartitionArchive.index_file + '.tmp')
+    with open(temp_file, 'wb') as index:
+        index.write(BSON.encode({'name' : name, 'count' : count, 'chunks' : chunks}))
+    os.replace(temp_file, os.path.join(path, PartitionArchive.index_file))
+    return PartitionArchive(path)
+
+def remove_archive(path):
+    '''Remove the archive written by :func:`write_archive` in the directory **path**.
+
+    The index is removed first, so an interrupted removal does not leave a readable archive with missing chunks.
+    Only the files of the archive are removed, and the directory too if nothing else is left in it.
+    '''
+    chunks = PartitionArchive(path).get_chunks()
+    os.remove(os.path.join(path, PartitionArchive.index_file))
+    for chunk in chunks:
+        os.remove(os.path.join(path, chunk['file']))
+    if not os.listdir(path):
+        os.rmdir(path)
+
+def id_bounds(query, field='_id'):
+    '''Get the inclusive (lower, upper) bounds a query puts on **field**, with :class:`None` for no bound.'''
+    bounds = [id_bounds(sub_query, field) for sub_query in query.get('$and', [])]
+    if field in query:
+        condition = query[field]
+        if is_operator_condition(condition):
+            values = list(condition.get('$in', []))
+            lowers = [condition[op] for op in ['$gt', '$gte', '$eq'] if op in condition] + ([min(values)] if values else [])
+            uppers = [condition[op] for op in ['$lt', '$lte', '$eq'] if op in condition] + ([max(values)] if values else [])
+            bounds.append((max(lowers) if lowers else None, min(uppers) if uppers else None))
+        else:
+            bounds.append((condition, condition))
+    lowers, uppers = [lower for lower, _ in bounds if lower is not None], [upper for _, upper in bounds if upper is not None]
+    try:
+        return (max(lowers) if lowers else None, min(uppers) if uppers else None)
+    except TypeError:
+        return (None, None)
+
+def _in_range(chunk, lower, upper):
+    try:
+        return (lower is None or chunk['max'] >= lower) and (upper is None or chunk['min'] <= upper)
+    except TypeError:
+        return True
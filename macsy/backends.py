@@ -0,0 +1,751 @@
+'''Backends are the storage engines the blackboards' managers read and write their collections through.
+
+The managers only use a subset of the :class:`pymongo.MongoClient` interface (databases, collections, cursors and bulk writes),
+so a backend is any client class providing it, passed to :class:`BlackboardAPI<macsy.api.BlackboardAPI>` as **MongoClient**.
+Besides :class:`pymongo.MongoClient`, this module provides :class:`MemoryClient`, an in-memory engine with secondary indexes.
+'''
+
+import random
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from collections.abc import Mapping
+from datetime import datetime
+from itertools import islice
+from bson import BSON, ObjectId
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.raw_bson import RawBSONDocument
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError, WriteError, OperationFailure
+from pymongo.results import InsertOneResult, InsertManyResult, UpdateResult, DeleteResult, BulkWriteResult
+from macsy.utils import match, project, resolve_path, is_operator_condition, listify
+
+class MemoryClient():
+    '''In-memory storage engine with the parts of the :class:`pymongo.MongoClient` interface used by the blackboards.
+
+    Documents are held in dictionaries keyed by ``_id``, with a sorted list of the ids for range scans and ordered reads,
+    and collections support secondary indexes (including multikey indexes on arrays, such as the tag fields), which are
+    created from the blackboards' required indexes like on a database server. Queries use the ``_id`` range and the
+    indexed equality, ``$in`` and ``$all`` conditions they contain to select candidate documents, and then check the
+    candidates with :func:`match()<macsy.utils.match>`. Documents are copied through BSON on the way in and out,
+    so stored documents cannot be changed by callers and codec options (e.g. raw documents) are honoured.
+
+    The data only lives in the client and the process which created it, so use it with in-process concurrency
+    (e.g. ``workers=0`` for :meth:`map()<macsy.blackboards.Blackboard.map>`).
+
+    Example:
+        >>> from macsy.backends import MemoryClient
+        >>> api = BlackboardAPI(settings, MongoClient=MemoryClient)
+        >>> blackboard = api.load_blackboard('ARTICLE', date_based=True)
+    '''
+
+    def __init__(self, host=None, *args, **kwargs):
+        self.host = host
+        self._databases = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        return self.get_database(name)
+
+    def get_database(self, name, codec_options=None, **kwargs):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(self, name)
+            return self._databases[name]
+
+    def list_database_names(self):
+        return sorted(self._databases)
+
+    def drop_database(self, name):
+        self._databases.pop(getattr(name, 'name', name), None)
+
+    def close(self):
+        pass
+
+class MemoryDatabase():
+    '''Database of a :class:`MemoryClient`. Collections are created by their first write or index.'''
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._stores = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        return self.get_collection(name)
+
+    def get_collection(self, name, codec_options=None, **kwargs):
+        return MemoryCollection(self, name, codec_options or DEFAULT_CODEC_OPTIONS)
+
+    def list_collection_names(self):
+        return sorted(self._stores)
+
+    def drop_collection(self, name):
+        with self._lock:
+            self._stores.pop(getattr(name, 'name', name), None)
+
+    def _get_store(self, name, create=False):
+        store = self._stores.get(name)
+        if store is None and create:
+            with self._lock:
+                store = self._stores.setdefault(name, _Store())
+        return store
+
+class MemoryCollection():
+    '''Collection of a :class:`MemoryDatabase`, supporting the reads, writes, aggregations and indexes used by the blackboards.'''
+
+    in_memory = True
+
+    def __init__(self, database, name, codec_options=DEFAULT_CODEC_OPTIONS):
+        self.database = database
+        self.name = name
+        self.codec_options = codec_options
+
+    @property
+    def full_name(self):
+        return '{}.{}'.format(self.database.name, self.name)
+
+    def with_options(self, codec_options=None, **kwargs):
+        return MemoryCollection(self.database, self.name, codec_options or self.codec_options)
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0, **kwargs):
+        cursor = MemoryCursor(self, filter, projection).skip(skip).limit(limit)
+        return cursor.sort(sort) if sort else cursor
+
+    def find_one(self, filter=None, projection=None, *args, **kwargs):
+        if filter is not None and not isinstance(filter, Mapping):
+            filter = {'_id' : filter}
+        return next(iter(self.find(filter, projection, *args, **kwargs).limit(1)), None)
+
+    def count(self, filter=None, **kwargs):
+        return self.count_documents(filter or {})
+
+    def count_documents(self, filter, **kwargs):
+        store = self._get_store()
+        return sum(1 for _ in store.select(filter)) if store else 0
+
+    def estimated_document_count(self, **kwargs):
+        store = self._get_store()
+        return len(store.docs) if store else 0
+
+    def distinct(self, key, filter=None):
+        values = OrderedDict()
+        for doc in self._get_docs(filter):
+            for value in resolve_path(doc, key.split('.')):
+                for item in listify(value):
+                    values.setdefault(_sort_key(item), item)
+        return list(values.values())
+
+    def insert_one(self, document, **kwargs):
+        return InsertOneResult(self._get_store(True).insert(_prepare(document)), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        store = self._get_store(True)
+        return InsertManyResult([store.insert(_prepare(doc)) for doc in documents], True)
+
+    def insert(self, doc_or_docs, **kwargs):
+        if isinstance(doc_or_docs, list):
+            return self.insert_many(doc_or_docs).inserted_ids
+        return self.insert_one(doc_or_docs).inserted_id
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        return UpdateResult(self._get_store(True).update(filter, update, upsert, False), True)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        return UpdateResult(self._get_store(True).update(filter, update, upsert, True), True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        if any(key.startswith('$') for key in replacement):
+            raise ValueError('Replacement documents cannot contain update operators')
+        return UpdateResult(self._get_store(True).update(filter, replacement, upsert, False), True)
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        result = self._get_store(True).update(spec, document, upsert, multi)
+        return dict(result, ok=1.0, updatedExisting=result['n'] > 0 and 'upserted' not in result)
+
+    def delete_one(self, filter, **kwargs):
+        return DeleteResult({'n' : self._delete(filter, False)}, True)
+
+    def delete_many(self, filter, **kwargs):
+        return DeleteResult({'n' : self._delete(filter, True)}, True)
+
+    def remove(self, spec_or_id=None, multi=True, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, Mapping):
+            spec_or_id = {'_id' : spec_or_id}
+        return {'n' : self._delete(spec_or_id or {}, multi), 'ok' : 1.0}
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, return_document=ReturnDocument.BEFORE, **kwargs):
+        return self._find_and_modify(filter, projection, sort, return_document,
+            lambda store, query: store.update(query, update, upsert, False).get('upserted'))
+
+    def find_one_and_replace(self, filter, replacement, projection=None, sort=None, upsert=False, return_document=ReturnDocument.BEFORE, **kwargs):
+        if any(key.startswith('$') for key in replacement):
+            raise ValueError('Replacement documents cannot contain update operators')
+        return self._find_and_modify(filter, projection, sort, return_document,
+            lambda store, query: store.update(query, replacement, upsert, False).get('upserted'))
+
+    def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        return self._find_and_modify(filter, projection, sort, ReturnDocument.BEFORE, lambda store, query: store.delete(query, False) and None)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        '''Apply a list of :class:`pymongo.InsertOne`, :class:`pymongo.UpdateOne`, :class:`pymongo.UpdateMany`,
+        :class:`pymongo.ReplaceOne`, :class:`pymongo.DeleteOne` and :class:`pymongo.DeleteMany` operations.
+
+        Raises:
+            :class:`pymongo.errors.BulkWriteError`: If any operation fails, with the server's error details.
+        '''
+        result = {'nInserted' : 0, 'nUpserted' : 0, 'nMatched' : 0, 'nModified' : 0, 'nRemoved' : 0, 'upserted' : [], 'writeErrors' : [], 'writeConcernErrors' : []}
+        store = self._get_store(True)
+        for index, request in enumerate(requests):
+            try:
+                self._apply_request(store, request, index, result)
+            except (WriteError, ValueError) as error:
+                result['writeErrors'].append({'index' : index, 'code' : getattr(error, 'code', None) or 2, 'errmsg' : str(error),
+                    'op' : {'q' : getattr(request, '_filter', None), 'u' : getattr(request, '_doc', None)}})
+                if ordered:
+                    break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def aggregate(self, pipeline, **kwargs):
+        '''Run an aggregation pipeline of $match, $project, $unwind, $group, $sort, $skip, $limit, $sample and $count stages.'''
+        pipeline = list(pipeline)
+        if pipeline and '$match' in pipeline[0]:
+            docs, pipeline = self._get_docs(pipeline[0]['$match']), pipeline[1:]
+        else:
+            docs = self._get_docs({})
+        for stage in pipeline:
+            (operation, argument), = stage.items()
+            if operation not in _stages:
+                raise OperationFailure('Unsupported aggregation stage: {}'.format(operation))
+            docs = _stages[operation](docs, argument)
+        return iter([_copy(doc, self.codec_options) for doc in docs])
+
+    def create_index(self, keys, unique=False, name=None, **kwargs):
+        keys = [(keys, 1)] if isinstance(keys, str) else [tuple(key) for key in keys]
+        return self._get_store(True).create_index(keys, unique, name or '_'.join('{}_{}'.format(*key) for key in keys))
+
+    def create_indexes(self, indexes, **kwargs):
+        return [self.create_index(index.document['key'].items(), **{key : value for key, value in index.document.items() if key != 'key'}) for index in indexes]
+
+    def index_information(self):
+        store = self._get_store()
+        indexes = store.indexes.items() if store else []
+        return OrderedDict([('_id_', {'key' : [('_id', 1)], 'v' : 2})] + [(name, dict({'key' : list(index.keys), 'v' : 2}, **({'unique' : True} if index.unique else {})))
+            for name, index in indexes])
+
+    def drop_index(self, index_or_name):
+        store = self._get_store()
+        if store is None or store.indexes.pop(index_or_name, None) is None:
+            raise OperationFailure('index not found with name [{}]'.format(index_or_name))
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    def _get_store(self, create=False):
+        return self.database._get_store(self.name, create)
+
+    def _get_docs(self, filter):
+        store = self._get_store()
+        return [store.docs[key] for key in store.select(filter)] if store else []
+
+    def _find_and_modify(self, filter, projection, sort, return_document, modify):
+        store = self._get_store(True)
+        with store.lock:
+            doc_id = next((doc['_id'] for doc in self.find(filter, {'_id' : 1}, sort=sort).limit(1)), None)
+            before = self.find_one({'_id' : doc_id}, projection) if doc_id is not None else None
+            upserted = modify(store, filter if doc_id is None else {'_id' : doc_id})
+            if return_document == ReturnDocument.BEFORE:
+                return before
+            doc_id = doc_id if doc_id is not None else upserted
+            return self.find_one({'_id' : doc_id}, projection) if doc_id is not None else None
+
+    def _delete(self, filter, multi):
+        store = self._get_store()
+        return store.delete(filter, multi) if store else 0
+
+    def _apply_request(self, store, request, index, result):
+        name = type(request).__name__
+        if name == 'InsertOne':
+            store.insert(_prepare(request._doc))
+            result['nInserted'] += 1
+        elif name in ['UpdateOne', 'UpdateMany', 'ReplaceOne']:
+            response = store.update(request._filter, request._doc, request._upsert, name == 'UpdateMany')
+            result['nMatched'] += response['n'] - (1 if 'upserted' in response else 0)
+            result['nModified'] += response['nModified']
+            if 'upserted' in response:
+                result['nUpserted'] += 1
+                result['upserted'].append({'index' : index, '_id' : response['upserted']})
+        elif name in ['DeleteOne', 'DeleteMany']:
+            result['nRemoved'] += store.delete(request._filter, name == 'DeleteMany')
+        else:
+            raise ValueError('Unsupported bulk write operation: {}'.format(name))
+
+class MemoryCursor():
+    '''Cursor over the documents of a :class:`MemoryCollection`. Documents are returned in ``_id`` order unless sorted otherwise.'''
+
+    def __init__(self, collection, filter, projection):
+        self.collection = collection
+        self._filter = filter or {}
+        self._projection = projection
+        self._sort = None
+        self._limit = 0
+        self._skip = 0
+        self._docs = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = [(key_or_list, direction or 1)] if isinstance(key_or_list, str) else list(key_or_list)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        count = self.collection.count_documents(self._filter)
+        if with_limit_and_skip:
+            count = max(count - self._skip, 0)
+            return min(count, self._limit) if self._limit else count
+        return count
+
+    def close(self):
+        self._docs = iter([])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._docs is None:
+            self._docs = self._generate()
+        return next(self._docs)
+
+    def _generate(self):
+        store = self.collection._get_store()
+        if store is None:
+            return iter([])
+        if self._sort and [key for key, _ in self._sort] != ['_id']:
+            docs = [store.docs[key] for key in store.select(self._filter)]
+            for key, direction in reversed(self._sort):
+                docs.sort(key=lambda doc: _sort_key(next(iter(resolve_path(doc, key.split('.'))), None)), reverse=direction < 0)
+        else:
+            docs = (store.docs[key] for key in store.select(self._filter, reverse=bool(self._sort) and self._sort[0][1] < 0))
+        docs = islice(docs, self._skip, self._skip + self._limit if self._limit else None)
+        return (_copy(project(doc, self._projection), self.collection.codec_options) for doc in docs)
+
+class _Index():
+
+    def __init__(self, keys, unique):
+        self.keys = keys
+        self.field = keys[0][0]
+        self.path = self.field.split('.')
+        self.unique = unique
+        self.entries = {}
+
+    def get_keys(self, doc):
+        values = resolve_path(doc, self.path) or [None]
+        return set(_sort_key(item) for value in values for item in (value if isinstance(value, list) and value else [value]))
+
+    def check(self, doc_key, doc):
+        '''Raise a :class:`DuplicateKeyError` if adding the document would break the index's uniqueness (other than with itself).'''
+        if self.unique and len(self.keys) == 1 and any(self.entries.get(key, set()) - {doc_key} for key in self.get_keys(doc)):
+            raise DuplicateKeyError('E11000 duplicate key error index: {} dup key: {}'.format(self.field, doc.get(self.field)), 11000)
+
+    def add(self, doc_key, doc):
+        self.check(doc_key, doc)
+        for key in self.get_keys(doc):
+            self.entries.setdefault(key, set()).add(doc_key)
+
+    def remove(self, doc_key, doc):
+        for key in self.get_keys(doc):
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.discard(doc_key)
+                if not entry:
+                    del self.entries[key]
+
+class _Store():
+
+    def __init__(self):
+        self.docs = {}
+        self.ids = []
+        self.indexes = OrderedDict()
+        self.lock = threading.RLock()
+
+    def create_index(self, keys, unique, name):
+        with self.lock:
+            if name not in self.indexes:
+                index = _Index(keys, unique)
+                for doc_key, doc in self.docs.items():
+                    index.add(doc_key, doc)
+                self.indexes[name] = index
+        return name
+
+    def insert(self, doc):
+        with self.lock:
+            if '_id' not in doc:
+                doc['_id'] = ObjectId()
+            doc_key = _sort_key(doc['_id'])
+            if doc_key in self.docs:
+                raise DuplicateKeyError('E11000 duplicate key error index: _id_ dup key: {}'.format(doc['_id']), 11000)
+            self._add(doc_key, doc)
+        return doc['_id']
+
+    def update(self, filter, update, upsert, multi):
+        replace = not any(key.startswith('$') for key in update)
+        response = {'n' : 0, 'nModified' : 0}
+        with self.lock:
+            for doc_key in list(self.select(filter)):
+                doc = self.docs[doc_key]
+                updated = _replace(doc, update) if replace else _apply_update(doc, update, False)
+                response['n'] += 1
+                if updated != doc:
+                    # Checked before the old version is removed, so a rejected update leaves the document as it was
+                    self._check(doc_key, updated)
+                    self._remove(doc_key, doc)
+                    self._add(doc_key, updated)
+                    response['nModified'] += 1
+                if not multi:
+                    break
+            if response['n'] == 0 and upsert:
+                doc = _replace(_get_upsert_base(filter), update) if replace else _apply_update(_get_upsert_base(filter), update, True)
+                response['upserted'] = self.insert(doc)
+                response['n'] = 1
+        return response
+
+    def delete(self, filter, multi):
+        with self.lock:
+            keys = list(self.select(filter))[:None if multi else 1]
+            for doc_key in keys:
+                self._remove(doc_key, self.docs[doc_key])
+        return len(keys)
+
+    def select(self, filter, reverse=False):
+        '''Generate the keys of the documents matching a query, in id order, using the id range and indexes to find candidates.'''
+        filter = filter or {}
+        with self.lock:
+            candidates = self._get_candidates(filter)
+            keys = self._get_id_range(filter) if candidates is None else sorted(candidates)
+        for doc_key in (reversed(keys) if reverse else keys):
+            doc = self.docs.get(doc_key)
+            if doc is not None and match(doc, filter):
+                yield doc_key
+
+    def _get_id_range(self, filter):
+        lower, upper, exact = None, None, []
+        for condition in _get_conditions(filter, '_id'):
+            if not is_operator_condition(condition):
+                exact.append(condition)
+                continue
+            for operation, value in condition.items():
+                if operation in ['$gt', '$gte']:
+                    lower = max(lower, _sort_key(value)) if lower is not None else _sort_key(value)
+                elif operation in ['$lt', '$lte']:
+                    upper = min(upper, _sort_key(value)) if upper is not None else _sort_key(value)
+        if exact:
+            return [key for key in sorted(set(_sort_key(value) for value in exact)) if key in self.docs]
+        start = bisect_left(self.ids, lower) if lower is not None else 0
+        end = bisect_right(self.ids, upper) if upper is not None else len(self.ids)
+        return self.ids[start:end]
+
+    def _get_candidates(self, filter):
+        candidates = None
+        for condition in _get_conditions(filter, '_id'):
+            keys = self._lookup(self.docs, condition, True)
+            candidates = keys if candidates is None or keys is None else (candidates & keys if keys is not None else candidates)
+        for index in self.indexes.values():
+            for condition in _get_conditions(filter, index.field):
+                keys = self._lookup(index.entries, condition, False)
+                if keys is not None:
+                    candidates = keys if candidates is None else candidates & keys
+        return candidates
+
+    def _lookup(self, entries, condition, primary):
+        def get(value):
+            key = _sort_key(value)
+            return ({key} if key in entries else set()) if primary else set(entries.get(key, ()))
+        if not is_operator_condition(condition):
+            return get(condition) if _is_indexable(condition) else None
+        sets = [get(condition['$eq'])] if _is_indexable(condition.get('$eq')) and '$eq' in condition else []
+        if '$in' in condition and all(_is_indexable(value) for value in condition['$in']):
+            sets.append(set().union(*[get(value) for value in condition['$in']]))
+        if '$all' in condition and condition['$all'] and all(_is_indexable(value) for value in condition['$all']) and not primary:
+            sets.extend(get(value) for value in condition['$all'])
+        if not sets:
+            return None
+        result = sets[0]
+        for keys in sets[1:]:
+            result = result & keys
+        return result
+
+    def _check(self, doc_key, doc):
+        for index in self.indexes.values():
+            index.check(doc_key, doc)
+
+    def _add(self, doc_key, doc):
+        self._check(doc_key, doc)
+        for index in self.indexes.values():
+            index.add(doc_key, doc)
+        self.docs[doc_key] = doc
+        position = bisect_left(self.ids, doc_key)
+        self.ids.insert(position, doc_key)
+
+    def _remove(self, doc_key, doc):
+        for index in self.indexes.values():
+            index.remove(doc_key, doc)
+        del self.docs[doc_key]
+        position = bisect_left(self.ids, doc_key)
+        del self.ids[position]
+
+def _sort_key(value):
+    '''Key ordering BSON values of different types as a database server does (null, numbers, strings, documents, arrays, ...).'''
+    if value is None:
+        return (1,)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, Mapping):
+        return (4, tuple((key, _sort_key(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (5, tuple(_sort_key(item) for item in value))
+    if isinstance(value, bytes):
+        return (6, value)
+    if isinstance(value, ObjectId):
+        return (7, value.binary)
+    if isinstance(value, datetime):
+        return (9, value.replace(tzinfo=None) - value.utcoffset() if value.utcoffset() else value.replace(tzinfo=None))
+    return (10, str(value))
+
+def _is_indexable(value):
+    return value is not None and not isinstance(value, (Mapping, list)) and not hasattr(value, 'search')
+
+def _get_conditions(filter, field):
+    conditions = [filter[field]] if field in filter else []
+    return conditions + [condition for sub_filter in filter.get('$and', []) for condition in _get_conditions(sub_filter, field)]
+
+def _prepare(document):
+    '''Copy a document to be stored, through BSON so it holds the same types as one read back from a server.'''
+    raw = document.raw if isinstance(document, RawBSONDocument) else None
+    if raw is None and '_id' not in document:
+        document['_id'] = ObjectId()
+    return BSON(raw or BSON.encode(document)).decode()
+
+def _copy(doc, codec_options):
+    return BSON.encode(doc).decode(codec_options) if codec_options.document_class is not RawBSONDocument else RawBSONDocument(BSON.encode(doc))
+
+def _replace(doc, replacement):
+    replaced = _prepare(dict(replacement))
+    if '_id' in doc:
+        if '_id' in replacement and _sort_key(replacement['_id']) != _sort_key(doc['_id']):
+            raise WriteError('The _id field cannot be changed', 66)
+        replaced['_id'] = doc['_id']
+    return replaced
+
+def _get_upsert_base(filter):
+    base = {}
+    for key, value in filter.items():
+        if key == '$and':
+            for sub_filter in value:
+                base.update(_get_upsert_base(sub_filter))
+        elif not key.startswith('$') and '.' not in key:
+            if not is_operator_condition(value):
+                base[key] = value
+            elif '$eq' in value:
+                base[key] = value['$eq']
+    return base
+
+def _apply_update(doc, update, inserting):
+    updated = BSON(BSON.encode(doc)).decode()
+    for operation, fields in update.items():
+        if operation == '$setOnInsert' and not inserting:
+            continue
+        if operation not in _updates:
+            raise WriteError('Unsupported update operator: {}'.format(operation), 9)
+        for path, value in fields.items():
+            parent, key = _get_parent(updated, path.split('.'))
+            _updates[operation](parent, key, value)
+    if not inserting and _sort_key(updated.get('_id')) != _sort_key(doc['_id']):
+        raise WriteError('The _id field cannot be changed', 66)
+    return _prepare(updated)
+
+def _get_parent(doc, path):
+    for part in path[:-1]:
+        if isinstance(doc, list):
+            doc = doc[int(part)]
+        else:
+            doc = doc.setdefault(part, {})
+    return doc, (int(path[-1]) if isinstance(doc, list) else path[-1])
+
+def _set(parent, key, value):
+    if isinstance(parent, list):
+        parent.extend([None] * (key + 1 - len(parent)))
+    parent[key] = value
+
+def _unset(parent, key, value):
+    if isinstance(parent, list):
+        if key < len(parent):
+            parent[key] = None
+    else:
+        parent.pop(key, None)
+
+def _get_array(parent, key):
+    current = parent.get(key) if isinstance(parent, Mapping) else parent[key]
+    if current is None:
+        current = []
+        _set(parent, key, current)
+    if not isinstance(current, list):
+        raise WriteError('Cannot apply an array operator to the non-array field {}'.format(key), 2)
+    return current
+
+def _add_to_set(parent, key, value):
+    current = _get_array(parent, key)
+    for item in (value['$each'] if isinstance(value, Mapping) and '$each' in value else [value]):
+        if all(_sort_key(item) != _sort_key(existing) for existing in current):
+            current.append(item)
+
+def _push(parent, key, value):
+    _get_array(parent, key).extend(value['$each'] if isinstance(value, Mapping) and '$each' in value else [value])
+
+def _pull(parent, key, value):
+    current = _get_array(parent, key)
+    test = (lambda item: match({'v' : item}, {'v' : value})) if is_operator_condition(value) else \
+        (lambda item: (match(item, value) if isinstance(item, Mapping) and isinstance(value, Mapping) else _sort_key(item) == _sort_key(value)))
+    current[:] = [item for item in current if not test(item)]
+
+def _pull_all(parent, key, value):
+    removed = set(_sort_key(item) for item in value)
+    current = _get_array(parent, key)
+    current[:] = [item for item in current if _sort_key(item) not in removed]
+
+def _inc(parent, key, value):
+    current = parent.get(key, 0) if isinstance(parent, Mapping) else parent[key]
+    _set(parent, key, (current or 0) + value)
+
+def _compare_set(keep):
+    def update(parent, key, value):
+        current = parent.get(key) if isinstance(parent, Mapping) else parent[key]
+        if current is None or keep(_sort_key(value), _sort_key(current)):
+            _set(parent, key, value)
+    return update
+
+def _rename(parent, key, value):
+    if key in parent:
+        parent[value] = parent.pop(key)
+
+_updates = {'$set' : _set, '$setOnInsert' : _set, '$unset' : _unset, '$inc' : _inc, '$addToSet' : _add_to_set, '$push' : _push, '$pull' : _pull,
+    '$pullAll' : _pull_all, '$min' : _compare_set(lambda a, b: a < b), '$max' : _compare_set(lambda a, b: a > b), '$rename' : _rename}
+
+def _evaluate(expression, doc):
+    '''Evaluate an aggregation expression: a field path ('$field'), a literal, an expression object or an operator.'''
+    if isinstance(expression, str) and expression.startswith('$'):
+        return next(iter(resolve_path(doc, expression[1:].split('.'))), None)
+    if isinstance(expression, list):
+        return [_evaluate(item, doc) for item in expression]
+    if isinstance(expression, Mapping):
+        if len(expression) == 1 and next(iter(expression)).startswith('$'):
+            (operation, argument), = expression.items()
+            if operation not in _operators:
+                raise OperationFailure('Unsupported aggregation operator: {}'.format(operation))
+            return _operators[operation](argument, doc)
+        return {key : _evaluate(value, doc) for key, value in expression.items()}
+    return expression
+
+def _compare_operator(comparison):
+    return lambda argument, doc: comparison(*[_sort_key(_evaluate(item, doc)) for item in argument])
+
+def _cond(argument, doc):
+    if isinstance(argument, Mapping):
+        argument = [argument['if'], argument['then'], argument['else']]
+    return _evaluate(argument[1] if _evaluate(argument[0], doc) else argument[2], doc)
+
+_operators = {'$lt' : _compare_operator(lambda a, b: a < b), '$lte' : _compare_operator(lambda a, b: a <= b),
+    '$gt' : _compare_operator(lambda a, b: a > b), '$gte' : _compare_operator(lambda a, b: a >= b),
+    '$eq' : _compare_operator(lambda a, b: a == b), '$ne' : _compare_operator(lambda a, b: a != b), '$cond' : _cond,
+    '$and' : lambda argument, doc: all(_evaluate(item, doc) for item in argument), '$or' : lambda argument, doc: any(_evaluate(item, doc) for item in argument),
+    '$not' : lambda argument, doc: not _evaluate(argument[0] if isinstance(argument, list) else argument, doc),
+    '$size' : lambda argument, doc: len(_evaluate(argument, doc)), '$literal' : lambda argument, doc: argument,
+    '$ifNull' : lambda argument, doc: next((value for value in (_evaluate(item, doc) for item in argument) if value is not None), None),
+    '$in' : lambda argument, doc: _evaluate(argument[0], doc) in _evaluate(argument[1], doc)}
+
+def _project_stage(docs, projection):
+    computed = {key : value for key, value in projection.items() if not isinstance(value, (bool, int))}
+    fields = {key : value for key, value in projection.items() if key not in computed}
+    results = []
+    for doc in docs:
+        result = project(doc, fields or ({'_id' : 1} if computed else None)) if fields or computed else doc
+        result = dict(result, **{key : _evaluate(value, doc) for key, value in computed.items()})
+        results.append(result)
+    return results
+
+def _unwind_stage(docs, argument):
+    path = (argument['path'] if isinstance(argument, Mapping) else argument)[1:]
+    keep_empty = isinstance(argument, Mapping) and argument.get('preserveNullAndEmptyArrays', False)
+    results = []
+    for doc in docs:
+        values = doc.get(path)
+        if isinstance(values, list) and values:
+            results.extend(dict(doc, **{path : value}) for value in values)
+        elif keep_empty or (values is not None and not isinstance(values, list)):
+            results.append(doc)
+    return results
+
+def _group_stage(docs, argument):
+    groups = OrderedDict()
+    accumulators = [(field, next(iter(spec.items()))) for field, spec in argument.items() if field != '_id']
+    for doc in docs:
+        group_id = _evaluate(argument['_id'], doc)
+        key = _sort_key(group_id)
+        if key not in groups:
+            groups[key] = dict({'_id' : group_id}, **{field : _accumulators[operation][0]() for field, (operation, _) in accumulators})
+        for field, (operation, expression) in accumulators:
+            groups[key][field] = _accumulators[operation][1](groups[key][field], _evaluate(expression, doc))
+    results = list(groups.values())
+    for result in results:
+        for field, (operation, _) in accumulators:
+            if operation == '$avg':
+                total, count = result[field]
+                result[field] = total / count if count else None
+    return results
+
+def _add_value(values, value):
+    if all(_sort_key(value) != _sort_key(existing) for existing in values):
+        values.append(value)
+    return values
+
+def _numeric(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+_accumulators = {'$sum' : (lambda: 0, lambda total, value: total + _numeric(value)),
+    '$avg' : (lambda: (0, 0), lambda total, value: (total[0] + _numeric(value), total[1] + 1) if isinstance(value, (int, float)) else total),
+    '$min' : (lambda: None, lambda current, value: value if current is None or (value is not None and _sort_key(value) < _sort_key(current)) else current),
+    '$max' : (lambda: None, lambda current, value: value if current is None or (value is not None and _sort_key(value) > _sort_key(current)) else current),
+    '$first' : (lambda: _missing, lambda current, value: value if current is _missing else current),
+    '$last' : (lambda: None, lambda current, value: value),
+    '$push' : (list, lambda values, value: values + [value]),
+    '$addToSet' : (list, _add_value)}
+_missing = object()
+
+def _sort_stage(docs, argument):
+    docs = list(docs)
+    for key, direction in reversed(list(argument.items())):
+        docs.sort(key=lambda doc: _sort_key(next(iter(resolve_path(doc, key.split('.'))), None)), reverse=direction < 0)
+    return docs
+
+_stages = {'$match' : lambda docs, query: [doc for doc in docs if match(doc, query)], '$project' : _project_stage,
+    '$unwind' : _unwind_stage, '$group' : _group_stage, '$sort' : _sort_stage,
+    '$skip' : lambda docs, n: list(docs)[n:], '$limit' : lambda docs, n: list(docs)[:n],
+    '$sample' : lambda docs, argument: random.sample(list(docs), min(argument['size'], len(docs))),
+    '$count' : lambda docs, field: [{field : len(docs)}] if docs else []}
@@ -0,0 +1,315 @@
+'''Bitmap indexes answer tag queries locally, from compressed per-tag bitmaps of the documents of each partition.'''
+
+import os
+import shutil
+import numpy as np
+from bson import BSON, ObjectId
+from macsy.managers import Partition
+from macsy.utils import listify
+
+class TagBitmapIndex():
+    '''Local, memory-mapped index of the tags of the documents of a blackboard, answering :meth:`count` and
+    :meth:`find_ids` queries with the same **tags** and **without_tags** semantics as the blackboard, using
+    vectorised set operations instead of queries on the database.
+
+    The index is made of immutable segments stored in the directory **path**, each holding the ids of a run of documents
+    of one partition (e.g. a year collection) in id order, and a container for each tag listing the positions
+    (ordinals) of the documents having it: a sorted array of ordinals for sparse tags, or a packed bitmap for dense ones,
+    whichever is smaller. The segments are memory-mapped, so only the containers of the tags queried are read.
+
+    :meth:`refresh` indexes the documents inserted after the last indexed id of each partition into new segments
+    (merging the segments of a partition once there are more than **max_segments**), and drops the segments of
+    partitions which no longer exist, e.g. after repartitioning. Changes to the tags of documents which are already
+    indexed, deleted documents and archived partitions are not seen by refreshes: use :meth:`rebuild` to re-read them.
+
+    Example:
+        >>> index = TagBitmapIndex(api.load_blackboard('ARTICLE'), '/data/indexes/ARTICLE')
+        >>> index.refresh()
+        >>> index.count(tags=['Tag_1', 'Tag_2'], without_tags=['Tag_3'], min_date=['2016-01-01'], max_date=['2017-01-01'])
+        1250
+    '''
+
+    ids_file = 'ids.npy'
+    containers_file = 'containers.npy'
+    index_file = 'index.bson'
+    segment_dir = '{}-{:06d}'
+    segment_size = 1000000
+    max_segments = 16
+
+    def __init__(self, blackboard, path):
+        '''Constructor for the TagBitmapIndex.
+
+        Args:
+            blackboard (:class:`Blackboard<macsy.blackboards.Blackboard>`): the blackboard to index.
+            path (:class:`str`): directory holding the segments of the index, created if it does not exist.
+        '''
+        self._blackboard = blackboard
+        self.path = path
+        self._segments = None
+        os.makedirs(path, exist_ok=True)
+
+    def refresh(self, batch_size=1000):
+        '''Index the documents inserted since the last refresh, reading only their ids and tags.
+
+        Returns:
+            :class:`int`: number of documents indexed.
+        '''
+        doc_m = self._blackboard.document_manager
+        keys = [partition.key for partition in doc_m.get_partitions()]
+        for segment in self._get_segments():
+            if segment.key not in keys:
+                shutil.rmtree(segment.path)
+        self._segments = None
+        indexed = 0
+        for key in keys:
+            segments = [segment for segment in self._get_segments() if segment.key == key]
+            last = segments[-1].last if segments else None
+            cursor = doc_m.find_partition(Partition(key, None, None), projection={doc_m.doc_tags : 1, doc_m.doc_control_tags : 1}, after_id=last).batch_size(batch_size)
+            batch = []
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= TagBitmapIndex.segment_size:
+                    indexed += self._add_segment(key, batch)
+                    batch = []
+            indexed += self._add_segment(key, batch)
+            segments = [segment for segment in self._get_segments() if segment.key == key]
+            if len(segments) > TagBitmapIndex.max_segments:
+                self._merge(key, segments)
+        return indexed
+
+    def rebuild(self, batch_size=1000):
+        '''Remove all the segments and index all the documents again.
+
+        Returns:
+            :class:`int`: number of documents indexed.
+        '''
+        for segment in self._get_segments():
+            shutil.rmtree(segment.path)
+        self._segments = None
+        return self.refresh(batch_size)
+
+    def count(self, **kwargs):
+        '''Count the indexed documents matching the filters.
+
+        Args:
+            **kwargs: the **tags** and **without_tags** (ids or names), **min_date** and **max_date** filters of
+                :meth:`count()<macsy.blackboards.Blackboard.count>`, and **after_id** and **before_id**.
+
+        Returns:
+            :class:`int`: number of matching documents.
+
+        Raises:
+            :class:`ValueError`: If a tag does not exist, or an unsupported filter is used.
+        '''
+        return sum(len(ordinals) for _, ordinals in self._evaluate(**kwargs))
+
+    def find_ids(self, **kwargs):
+        '''Find the ids of the indexed documents matching the filters, in ascending order within each partition.
+
+        Args:
+            **kwargs: the same filters as :meth:`count`.
+
+        Returns:
+            :class:`list`: ids of the matching documents.
+        '''
+        return [_decode_id(segment.ids[ordinal]) for segment, ordinals in self._evaluate(**kwargs) for ordinal in ordinals]
+
+    def get_size(self):
+        '''Get the number of documents in the index.'''
+        return sum(segment.size for segment in self._get_segments())
+
+    def _evaluate(self, **kwargs):
+        unsupported = set(kwargs).difference(['tags', 'without_tags', 'min_date', 'max_date', 'after_id', 'before_id'])
+        if unsupported:
+            raise ValueError('Unsupported filters for the tag index: {}'.format(sorted(unsupported)))
+        include = [self._get_tag_key(tag) for tag in kwargs.get('tags', [])]
+        exclude = [self._get_tag_key(tag) for tag in kwargs.get('without_tags', [])]
+        bounds = self._blackboard.document_manager._query_builder.build_id_bounds(**kwargs)
+        return [(segment, segment.evaluate(include, exclude, bounds)) for segment in self._get_segments()]
+
+    def _get_tag_key(self, tag):
+        tag_m, doc_m = self._blackboard.tag_manager, self._blackboard.document_manager
+        full_tag = tag_m.get_canonical_tag(tag)
+        field = doc_m.doc_control_tags if full_tag.get(tag_m.tag_control) else doc_m.doc_tags
+        return (field, int(full_tag[tag_m.tag_id]))
+
+    def _get_segments(self):
+        if self._segments is None:
+            names = sorted(name for name in os.listdir(self.path) if os.path.exists(os.path.join(self.path, name, TagBitmapIndex.index_file)))
+            self._segments = sorted((_Segment(os.path.join(self.path, name)) for name in names), key=lambda segment: segment.sequence)
+        return self._segments
+
+    def _add_segment(self, key, docs):
+        if not docs:
+            return 0
+        doc_m = self._blackboard.document_manager
+        ids = _encode_ids([doc[doc_m.doc_id] for doc in docs])
+        postings = {field : _get_postings(doc.get(field, []) for doc in docs) for field in [doc_m.doc_tags, doc_m.doc_control_tags]}
+        self._write_segment(key, ids, postings)
+        return len(docs)
+
+    def _merge(self, key, segments):
+        fields = set(field for segment in segments for field in segment.fields)
+        offsets = np.cumsum([0] + [segment.size for segment in segments])
+        postings = {}
+        for field in fields:
+            keys = [(np.int64(tag_id) << 32) | (segment.get(field, tag_id).ordinals() + offset)
+                for segment, offset in zip(segments, offsets) for tag_id in segment.get_tags(field)]
+            keys = np.sort(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+            postings[field] = (keys >> 32, keys & 0xFFFFFFFF)
+        self._write_segment(key, np.concatenate([segment.ids for segment in segments]), postings)
+        for segment in segments:
+            shutil.rmtree(segment.path)
+        self._segments = None
+
+    def _write_segment(self, key, ids, postings):
+        sequence = max([segment.sequence for segment in self._get_segments()] + [0]) + 1
+        path = os.path.join(self.path, TagBitmapIndex.segment_dir.format('all' if key is None else key, sequence))
+        temp_path = path + '.tmp'
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        chunks, tags, offset = [], {}, 0
+        for field, (tag_ids, ordinals) in postings.items():
+            tags[field] = {}
+            boundaries = list(np.flatnonzero(np.diff(tag_ids)) + 1) if len(tag_ids) else []
+            for start, end in zip([0] + boundaries, boundaries + [len(tag_ids)]) if len(tag_ids) else []:
+                kind, data = _encode_container(ordinals[start:end], len(ids))
+                tags[field][str(int(tag_ids[start]))] = [kind, offset, len(data)]
+                chunks.append(data)
+                offset += len(data)
+        np.save(os.path.join(temp_path, TagBitmapIndex.ids_file), ids)
+        np.save(os.path.join(temp_path, TagBitmapIndex.containers_file), np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8))
+        with open(os.path.join(temp_path, TagBitmapIndex.index_file), 'wb') as index:
+            index.write(BSON.encode({'key' : key, 'sequence' : sequence, 'size' : len(ids), 'last' : _decode_id(ids[-1]), 'tags' : tags}))
+        os.replace(temp_path, path)
+        self._segments = None
+
+class _Segment():
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, TagBitmapIndex.index_file), 'rb') as index:
+            info = BSON(index.read()).decode()
+        self.key, self.sequence, self.size, self.last = info['key'], info['sequence'], info['size'], info['last']
+        self._tags = info['tags']
+        self._ids = None
+        self._containers = None
+
+    @property
+    def fields(self):
+        return list(self._tags)
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = np.load(os.path.join(self.path, TagBitmapIndex.ids_file), mmap_mode='r')
+        return self._ids
+
+    def get_tags(self, field):
+        return [int(tag_id) for tag_id in self._tags.get(field, {})]
+
+    def get(self, field, tag_id):
+        entry = self._tags.get(field, {}).get(str(tag_id))
+        if entry is None:
+            return None
+        if self._containers is None:
+            self._containers = np.load(os.path.join(self.path, TagBitmapIndex.containers_file), mmap_mode='r')
+        kind, offset, length = entry
+        return _Container(kind, self._containers[offset:offset + length], self.size)
+
+    def evaluate(self, include, exclude, bounds):
+        '''Get the ordinals of the documents of the segment having all the **include** tags, none of the **exclude** tags, and an id within **bounds**.'''
+        lower, upper = self._get_ordinal_range(bounds)
+        containers = [self.get(field, tag_id) for field, tag_id in include]
+        if lower >= upper or any(container is None for container in containers):
+            return np.zeros(0, dtype=np.int64)
+        excluded = [container for container in (self.get(field, tag_id) for field, tag_id in exclude) if container is not None]
+        sparse = sorted((container for container in containers if container.kind == _Container.array_kind), key=len)
+        if sparse:
+            ordinals = sparse[0].ordinals()
+            ordinals = ordinals[(ordinals >= lower) & (ordinals < upper)]
+            for container in containers:
+                if container is not sparse[0]:
+                    ordinals = ordinals[container.contains(ordinals)]
+            for container in excluded:
+                ordinals = ordinals[~container.contains(ordinals)]
+            return ordinals
+        bits = np.zeros(self.size, dtype=bool)
+        bits[lower:upper] = True
+        mask = np.packbits(bits)
+        for container in containers:
+            mask &= container.bitmap()
+        for container in excluded:
+            mask &= ~container.bitmap()
+        return np.flatnonzero(np.unpackbits(mask)[:self.size])
+
+    def _get_ordinal_range(self, bounds):
+        lower, upper = 0, self.size
+        for operation, bound in bounds.items():
+            value = _encode_ids([bound])[0]
+            if operation in ['$gte', '$gt']:
+                lower = max(lower, int(np.searchsorted(self.ids, value, 'left' if operation == '$gte' else 'right')))
+            elif operation in ['$lt', '$lte']:
+                upper = min(upper, int(np.searchsorted(self.ids, value, 'left' if operation == '$lt' else 'right')))
+        return (lower, upper)
+
+class _Container():
+
+    array_kind = 'a'
+    bitmap_kind = 'b'
+
+    def __init__(self, kind, data, size):
+        self.kind = kind
+        self._data = data
+        self._size = size
+
+    def __len__(self):
+        return len(self._data) // 4 if self.kind == _Container.array_kind else int(_bit_counts[self._data].sum())
+
+    def ordinals(self):
+        if self.kind == _Container.array_kind:
+            return self._data.view(np.uint32).astype(np.int64)
+        return np.flatnonzero(np.unpackbits(self._data)[:self._size])
+
+    def bitmap(self):
+        if self.kind == _Container.array_kind:
+            bits = np.zeros(self._size, dtype=bool)
+            bits[self.ordinals()] = True
+            return np.packbits(bits)
+        return np.array(self._data[:(self._size + 7) // 8])
+
+    def contains(self, ordinals):
+        if self.kind == _Container.array_kind:
+            return np.isin(ordinals, self.ordinals(), assume_unique=True)
+        return ((self._data[ordinals >> 3] >> (7 - (ordinals & 7))) & 1).astype(bool)
+
+def _get_postings(tag_arrays):
+    '''Get the (tag ids, ordinals) of the documents having each tag, sorted by tag id and then ordinal.'''
+    tag_ids, ordinals = [], []
+    for ordinal, tags in enumerate(tag_arrays):
+        tags = listify(tags)
+        tag_ids.extend(tags)
+        ordinals.extend([ordinal] * len(tags))
+    keys = np.unique((np.asarray(tag_ids, dtype=np.int64) << 32) | np.asarray(ordinals, dtype=np.int64))
+    return (keys >> 32, keys & 0xFFFFFFFF)
+
+def _encode_container(ordinals, size):
+    '''Encode the ordinals of a tag as a sorted array of 32 bit ordinals, or a packed bitmap if that is smaller, padded to 4 bytes.'''
+    if len(ordinals) * 4 < (size + 7) // 8:
+        return (_Container.array_kind, ordinals.astype(np.uint32).view(np.uint8))
+    bits = np.zeros(size, dtype=bool)
+    bits[ordinals] = True
+    packed = np.packbits(bits)
+    return (_Container.bitmap_kind, np.concatenate([packed, np.zeros(-len(packed) % 4, dtype=np.uint8)]))
+
+def _encode_ids(ids):
+    if all(isinstance(doc_id, ObjectId) for doc_id in ids):
+        return np.array([doc_id.binary for doc_id in ids], dtype='S12')
+    if all(isinstance(doc_id, int) and not isinstance(doc_id, bool) for doc_id in ids):
+        return np.array(ids, dtype=np.int64)
+    raise ValueError('Only ObjectId or integer document ids can be indexed')
+
+def _decode_id(value):
+    return ObjectId(bytes(value).ljust(12, b'\0')) if isinstance(value, bytes) else int(value)
+
+_bit_counts = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
@@ -2,7 +2,7 @@
 
 from macsy.utils import check_admin
 from macsy.cursors import BlackboardCursor
-from macsy.managers import TagManager, DocumentManager, DateBasedDocumentManager, CounterManager
+from macsy.managers import TagManager, DocumentManager, DateBasedDocumentManager, CounterManager, RollupManager
 
 class Blackboard():
     '''Blackboard object that acts as an interface for retrieving and inserting data from a standard blackboard.
@@ -21,10 +21,12 @@ class Blackboard():
             >>> api = BlackboardAPI(settings)
             >>> blackboard = api.load_blackboard('FEED')
         '''
-        self._db, self._name, self.admin_mode = settings
+        self._db, self._name, self.admin_mode = settings[0:3]
+        self._api = settings[3] if len(settings) > 3 else None
         self.counter_manager = CounterManager(self)
         self.document_manager = DocumentManager(self)
         self.tag_manager = TagManager(self)
+        self.rollup_manager = RollupManager(self)
 
     def count(self, **kwargs):
         '''Count the number of documents in the blackboard.
@@ -37,12 +39,41 @@ class Blackboard():
             min_date (:class:`list[str]`, optional): filter documents to those that occur after the given date.
             max_date (:class:`list[str]`, optional): filter documents to those that occur before the given date.
             query (:class:`dict`): raw mongo query, bypassing other arguments.
+            after_id (:class:`ObjectId` or :class:`int`, optional): only count documents with an id greater than the given id.
+            hint (:class:`dict`, optional): index to use for the query, one of the indexes declared in the blackboard's required indexes.
+            before_id (:class:`ObjectId` or :class:`int`, optional): only count documents with an id less than the given id.
+            approximate (:class:`bool`, optional): return the estimate from :meth:`estimate_count` rather than an exact count.
 
         Returns:
             :class:`int`: number of documents in blackboard.
         '''
+        if kwargs.pop('approximate', False):
+            return self.estimate_count(**kwargs).estimate
         return self.document_manager.count(**kwargs)
 
+    def estimate_count(self, sample_size=1000, z=1.96, **kwargs):
+        '''Estimate the number of documents in the blackboard, trading accuracy for speed.
+
+        Without filters, the count comes from the collection metadata, and date and id filters are answered from the
+        id index alone (or the metadata, for collections entirely inside the range). Other filters are estimated by
+        checking a random sample of **sample_size** documents from each collection, with a Wilson confidence interval.
+        Collections only partly inside a date or id range are sampled from the documents in the range, which scans
+        the range on the id index, so the estimate costs more than sampling a whole collection.
+
+        Args:
+            sample_size (:class:`int`, optional): number of documents to sample from each collection.
+            z (:class:`float`, optional): z-score of the confidence interval (1.96 for 95%).
+            **kwargs: the same filters as :meth:`count()<macsy.blackboards.Blackboard.count>`.
+
+        Returns:
+            :class:`CountEstimate<macsy.managers.CountEstimate>`: estimated count with lower and upper bounds.
+
+        Example:
+            >>> blackboard.estimate_count(tags=['Tag_1'], min_date=['2017-01-01'])
+            CountEstimate(estimate=120400, lower=115800, upper=125100, sampled=2000)
+        '''
+        return self.document_manager.estimate_count(sample_size, z, **kwargs)
+
     def find(self, **kwargs):
         '''Return a cursor for documents in the blackboard.
 
@@ -54,27 +85,232 @@ class Blackboard():
             min_date (:class:`list[str]`, optional): filter documents to those that occur after the given date.
             max_date (:class:`list[str]`, optional): filter documents to those that occur before the given date.
             query (:class:`dict`): raw mongo query, bypassing other arguments.
+            max (:class:`int`, optional): maximum number of documents to return (0 for no limit).
+            sort (:class:`int`, optional): sort direction by id, either 1 (ascending), -1 (descending, default), or :class:`None`
+                for the natural order of the collections, which avoids traversing the id index and reads the year collections in parallel.
+                Unsorted scans are not resumed automatically if the cursor is lost.
+            hint (:class:`dict`, optional): index to use for the query, one of the indexes declared in the blackboard's
+                required indexes, e.g. ``{'Tg' : 1, '_id' : 1}``.
+            after_id (:class:`ObjectId` or :class:`int`, optional): only return documents with an id greater than the given id,
+                also applied to raw queries. Used to resume ascending scans from :attr:`BlackboardCursor.last_id`.
+            before_id (:class:`ObjectId` or :class:`int`, optional): only return documents with an id less than the given id,
+                also applied to raw queries. Used to resume descending scans from :attr:`BlackboardCursor.last_id`.
+            raw (:class:`bool`, optional): return :class:`RawBSONDocument<bson.raw_bson.RawBSONDocument>` documents, which are
+                only decoded when a field is first accessed. They can be passed back to :meth:`insert` or :meth:`update` as they are.
+            projection (:class:`list[str]` or :class:`dict`, optional): fields to return (the id is always included).
 
         Returns:
             :class:`BlackboardCursor`: cursor of results from the database.
+
+        Raises:
+            :class:`ValueError`: If **hint** is not one of the blackboard's required indexes.
+
+        Example:
+            >>> cursor = blackboard.find(tags=['Tag_1'], sort=1)
+            >>> for doc in cursor:
+            >>> ... checkpoint(cursor.last_id)
+            >>> # after a crash, continue from the checkpoint rather than from the start
+            >>> cursor = blackboard.find(tags=['Tag_1'], sort=1, after_id=load_checkpoint())
         '''
         return BlackboardCursor(self.document_manager.find(**kwargs))
 
-    
+
+    def get(self, doc_id, projection=None):
+        '''Get a single document by id, reading only the collection which holds it.
+
+        Args:
+            doc_id (:class:`ObjectId` or :class:`int`): id of the document.
+            projection (:class:`list[str]` or :class:`dict`, optional): fields to return.
+
+        Returns:
+            :class:`dict` or :class:`None`: the document, or :class:`None` if it does not exist.
+        '''
+        docs, missing = self.get_many([doc_id], projection)
+        return docs[0] if docs else None
+
+    def get_many(self, ids, projection=None):
+        '''Get a batch of documents by id.
+
+        The ids are grouped by the collection which holds them (the year, for date-based blackboards),
+        and each collection is queried once, concurrently.
+
+        Args:
+            ids (:class:`list`): ids of the documents.
+            projection (:class:`list[str]` or :class:`dict`, optional): fields to return (the id is always included).
+
+        Returns:
+            :class:`tuple`: list of the documents found, in the order of **ids**, and list of the ids which were not found.
+
+        Example:
+            >>> docs, missing = blackboard.get_many([result['_id'] for result in results], projection=['T', 'Tg'])
+        '''
+        return self.document_manager.get_many(ids, projection)
+
+    def enable_cache(self, maxsize=10000, ttl=300.0):
+        '''Cache the documents read by id with :meth:`get` and :meth:`get_many` in memory, so documents read repeatedly
+        (e.g. feeds and outlets) are only fetched from the database once in a while.
+
+        The cache holds up to **maxsize** whole documents (projections are applied to the cached copies), discarding the least
+        recently used ones, and documents are fetched again **ttl** seconds after they were cached. Writes made through this blackboard
+        (e.g. :meth:`update`, :meth:`add_tag`, :meth:`remove_tag` and :meth:`delete`) drop the documents they change from the cache;
+        writes made elsewhere are seen once the cached documents expire.
+
+        Args:
+            maxsize (:class:`int`, optional): maximum number of documents cached.
+            ttl (:class:`float`, optional): number of seconds documents are cached for.
+
+        Returns:
+            :class:`TTLCache<macsy.utils.TTLCache>`: the cache, whose **hits** and **misses** count the documents read from the cache
+            and from the database.
+
+        Example:
+            >>> cache = feeds.enable_cache(maxsize=50000, ttl=3600)
+            >>> feed = feeds.get(article['Fds'][0])
+            >>> print(cache.hits, cache.misses)
+        '''
+        from macsy.utils import TTLCache
+        cache = TTLCache(maxsize, ttl)
+        self.document_manager.set_cache(cache)
+        return cache
+
+    def disable_cache(self):
+        '''Stop caching the documents read by id, see :meth:`enable_cache`.'''
+        self.document_manager.set_cache(None)
+
+    def sample(self, n, seed=None, stratify=None, **kwargs):
+        '''Get a random sample of the documents in the blackboard.
+
+        The sample is split between the partition collections in proportion to the number of matching documents in each,
+        and drawn on the database server with $sample, so only the sampled documents are transferred. Giving a **seed**
+        makes the sample reproducible, at the cost of reading the ids (but not the contents) of all matching documents.
+
+        Args:
+            n (:class:`int`): number of documents to sample (all matching documents are returned if there are fewer).
+            seed (:class:`int` or :class:`str`, optional): seed for a reproducible sample.
+            stratify (:class:`list`, optional): tags (by id or name) to sample **n** documents for each, separately.
+            **kwargs: the same filters as :meth:`count()<macsy.blackboards.Blackboard.count>`.
+
+        Returns:
+            :class:`list[dict]` or :class:`dict`: sampled documents, or a list of sampled documents for each tag when stratified.
+
+        Example:
+            >>> training = blackboard.sample(500, seed=42, stratify=['Tag_1', 'Tag_2'], min_date=['2017-01-01'])
+            >>> len(training['Tag_1'])
+            500
+        '''
+        if stratify is None:
+            return self.document_manager.sample(n, seed, **kwargs)
+        return {tag : self.document_manager.sample(n, seed, **dict(kwargs, tags=kwargs.get('tags', []) + [tag])) for tag in stratify}
+
+    def map(self, func, workers=None, batch_size=500, progress=None, **kwargs):
+        '''Apply a function to every document matching the filters in parallel, writing the changes it returns back in bulk.
+
+        The matching documents are split into partitions (partition collections, or id ranges within a collection),
+        which are processed by a pool of **workers** processes, each with its own database connection.
+        **func** receives each document and returns :class:`None` for no change, or a :class:`dict` with any of the keys
+        'fields' (fields to update, as in :meth:`update()<macsy.blackboards.Blackboard.update>`), 'add_tags' and
+        'remove_tags' (tag ids). Changes are written back with unordered bulk updates every **batch_size** changes,
+        so a worker never holds more than one batch of pending changes in memory.
+
+        .. note:: On platforms which spawn rather than fork processes, **func** must be picklable (a module level function).
+
+        Args:
+            func (:class:`callable`): function to apply to each document.
+            workers (:class:`int`, optional): number of worker processes, defaults to the number of CPUs.
+                Use 0 to process the partitions in the calling process.
+            batch_size (:class:`int`, optional): number of pending updates which triggers a bulk write.
+            progress (:class:`callable`, optional): called with each :class:`PartitionResult<macsy.mappers.PartitionResult>` as it completes.
+            **kwargs: the same filters as :meth:`find()<macsy.blackboards.Blackboard.find>`.
+
+        Returns:
+            :class:`MapReport<macsy.mappers.MapReport>`: per-partition results, including any failures.
+
+        Raises:
+            :class:`ValueError`: If worker processes are requested for a blackboard not loaded through the :class:`BlackboardAPI<macsy.api.BlackboardAPI>`.
+
+        Example:
+            >>> def classify(doc):
+            >>> ... return {'add_tags' : [topic_tag]} if is_about_topic(doc['T']) else None
+            >>> report = blackboard.map(classify, workers=8, min_date=['2016-01-01'])
+            >>> print(report.processed, report.failed)
+        '''
+        from macsy.mappers import BlackboardMapper, PartitionRunner
+        return BlackboardMapper(self, PartitionRunner(func, batch_size), workers, progress).run(**kwargs)
+
+    def buffered(self, max_docs=1000, max_delay=5.0):
+        '''Get a write-behind writer for the blackboard, which queues and coalesces updates and tag changes.
+
+        Args:
+            max_docs (:class:`int`, optional): number of documents with queued changes which triggers a flush.
+            max_delay (:class:`float`, optional): seconds after the last flush at which the next change triggers a flush.
+
+        Returns:
+            :class:`BufferedBlackboard<macsy.writers.BufferedBlackboard>`: writer to use as a context manager.
+
+        Example:
+            >>> with blackboard.buffered() as writer:
+            >>> ... for doc in blackboard.find(tags=['Tag_1']):
+            >>> ...     writer.add_tag(doc['_id'], 2)
+        '''
+        from macsy.writers import BufferedBlackboard
+        return BufferedBlackboard(self, max_docs, max_delay)
+
     def insert(self, doc):
         '''Insert a new document into the blackboard.
 
         Documents which do not contain an id field ('_id') will have a new id auto-generated for them.
         If the id for the document already exists, the document is updated with the new details (upsert).
+        Raw documents (see :meth:`find`) which have an id and a hash are written as they are, replacing any document with the same id.
 
         Args:
-            doc (:class:`dict`): dictionary containing the fields and values to insert into the blackboard.
+            doc (:class:`dict` or :class:`RawBSONDocument<bson.raw_bson.RawBSONDocument>`): dictionary containing the fields and values to insert into the blackboard.
 
         Returns:
             :class:`ObjectId` or :class:`int`: id of the inserted document in the blackboard.
         '''
         return self.document_manager.insert(doc)
 
+    def existing_hashes(self, docs):
+        '''Find which of a batch of documents are already in the blackboard, by their hash.
+
+        Hashes are generated from the blackboard's hash components for documents which do not have one,
+        and checked with a single query per collection.
+
+        Args:
+            docs (:class:`list[dict]`): documents to check.
+
+        Returns:
+            :class:`dict`: id of the stored document for each hash which already exists.
+        '''
+        return self.document_manager.find_hashes(self.document_manager.get_hashes(docs)) if docs else {}
+
+    def filter_new(self, docs):
+        '''Split a batch of documents into those which are new and those already in the blackboard.
+
+        Documents with the same hash as an earlier document in the batch are dropped.
+
+        Args:
+            docs (:class:`list[dict]`): documents to check.
+
+        Returns:
+            :class:`tuple`: list of the new documents, and a list of (document, existing id) pairs for the rest.
+
+        Example:
+            >>> new, existing = blackboard.filter_new(items)
+            >>> for doc in new:
+            >>> ... blackboard.insert(fetch_body(doc))
+        '''
+        hashes = self.document_manager.get_hashes(docs)
+        existing_ids = self.document_manager.find_hashes(hashes) if docs else {}
+        new, existing, seen = [], [], set()
+        for doc, hsh in zip(docs, hashes):
+            if hsh in existing_ids:
+                existing.append((doc, existing_ids[hsh]))
+            elif hsh not in seen:
+                new.append(doc)
+            seen.add(hsh)
+        return new, existing
+
     def update(self, doc_id, updated_fields):
         '''Update an existing document in the blackboard.
 
@@ -83,7 +319,7 @@ class Blackboard():
 
         Args:
             doc_id (:class:`int`): id of the document to update.
-            updated_fields (:class:`dict`): dictionary containing the fields to be updated, along with their new values.
+            updated_fields (:class:`dict` or :class:`RawBSONDocument<bson.raw_bson.RawBSONDocument>`): dictionary containing the fields to be updated, along with their new values.
 
         Returns:
             :class:`ObjectId` or :class:`int` or :class:`None`: id of the updated document in the blackboard, or :class:`None` if id does not exist.
@@ -107,6 +343,141 @@ class Blackboard():
         '''
         return self.document_manager.delete(doc_id)
 
+    def update_where(self, update, **kwargs):
+        '''Update all the documents which match the filters, with one update per collection.
+
+        Args:
+            update (:class:`dict`): fields to update with their new values, as for :meth:`update`,
+                or an update document of MongoDB operators (e.g. {'$unset' : {'Field' : 1}}).
+            **kwargs: the same filters as :meth:`count()<macsy.blackboards.Blackboard.count>`.
+
+        Returns:
+            :class:`dict`: number of documents 'matched' and 'modified'.
+
+        Raises:
+            :class:`ValueError`: If **update** mixes operators and fields.
+
+        Example:
+            >>> blackboard.update_where({'Outlet' : 'The Times'}, tags=['Source>Times'])
+            {'matched': 1520, 'modified': 1497}
+        '''
+        return self.document_manager.update_where(update, **kwargs)
+
+    @check_admin('Admin rights required to delete documents.')
+    def delete_where(self, delete_all=False, **kwargs):
+        '''Delete all the documents which match the filters, with one delete per collection.
+
+        Documents can only be deleted by admin users.
+
+        Args:
+            delete_all (:class:`bool`, optional): allow deleting without any filters, i.e. every document in the blackboard.
+            **kwargs: the same filters as :meth:`count()<macsy.blackboards.Blackboard.count>`.
+
+        Returns:
+            :class:`dict`: number of documents 'deleted'.
+
+        Raises:
+            :class:`PermissionError`: If the user does not have admin privileges.
+            :class:`ValueError`: If no filters are given and **delete_all** is not set.
+        '''
+        return self.document_manager.delete_where(delete_all, **kwargs)
+
+    def count_tags(self, control=False, **kwargs):
+        '''Count the number of documents annotated with each tag, using an aggregation on the database server.
+
+        Args:
+            control (:class:`bool`, optional): count control tags rather than normal tags.
+            **kwargs: the same filters as :meth:`count()<macsy.blackboards.Blackboard.count>`.
+
+        Returns:
+            :class:`dict`: number of documents for each tag name (or tag id, for tags which no longer exist).
+
+        Example:
+            >>> blackboard.count_tags(min_date=['2017-01-01'])
+            {'Tag_1': 1250, 'Tag_2': 56, ...}
+        '''
+        names = self.tag_manager.get_tag_names()
+        return {names.get(tag_id, tag_id) : count for tag_id, count in self.document_manager.count_tags(control, **kwargs).items()}
+
+    def count_cooccurrences(self, control=False, **kwargs):
+        '''Count the number of documents in which each pair of tags occur together.
+
+        Only the tag arrays of the matching documents are retrieved from the database, and the
+        pair counts are accumulated incrementally in a sparse matrix, streaming each year collection concurrently.
+
+        Args:
+            control (:class:`bool`, optional): count control tags rather than normal tags.
+            **kwargs: the same filters as :meth:`count()<macsy.blackboards.Blackboard.count>`.
+
+        Returns:
+            :class:`CooccurrenceMatrix<macsy.analytics.CooccurrenceMatrix>`: sparse matrix of co-occurrence counts, with tag names.
+        '''
+        from macsy.analytics import count_cooccurrences
+        field = self.document_manager.doc_control_tags if control else self.document_manager.doc_tags
+        return count_cooccurrences(self.document_manager.find_field(field, **kwargs), field, self.tag_manager.get_tag_names())
+
+    def refresh_tag_statistics(self, max_age=None):
+        '''Count the documents with each tag in each partition (e.g. year collection), and store the counts in the counter collection.
+
+        The statistics are used to plan queries by tags: the rarest tag is matched first, an index on its field is
+        hinted when it is rare enough, and partitions with none of the documents with a required tag are not read.
+        Once counted, they are recounted automatically by the query planning when the stored statistics are older than
+        :attr:`DocumentManager.statistics_max_age<macsy.managers.DocumentManager.statistics_max_age>` (a day by default,
+        :class:`None` to only recount them here). Partitions are only skipped after checking the index, so stale statistics
+        make queries slower but never wrong.
+
+        Args:
+            max_age (:class:`datetime.timedelta`, optional): keep the stored statistics if they are more recent than this.
+
+        Returns:
+            :class:`TagStatistics<macsy.managers.TagStatistics>`: the statistics.
+
+        Example:
+            >>> blackboard.refresh_tag_statistics(max_age=timedelta(days=1))
+        '''
+        return self.document_manager.refresh_tag_statistics(max_age)
+
+    def load_tag_index(self, path, refresh=True):
+        '''Load a local bitmap index of the tags of the documents in this blackboard, to count and find documents
+        by their tags without querying the database, see :class:`TagBitmapIndex<macsy.bitmaps.TagBitmapIndex>`.
+
+        Args:
+            path (:class:`str`): directory holding the index, which is created if it does not exist.
+            refresh (:class:`bool`, optional): index the documents inserted since the index was last refreshed.
+
+        Returns:
+            :class:`TagBitmapIndex<macsy.bitmaps.TagBitmapIndex>`: the index.
+
+        Example:
+            >>> index = blackboard.load_tag_index('/data/indexes/ARTICLE')
+            >>> index.count(tags=['Tag_1', 'Tag_2'], without_tags=['Tag_3'], min_date=['2016-01-01'])
+        '''
+        from macsy.bitmaps import TagBitmapIndex
+        index = TagBitmapIndex(self, path)
+        if refresh:
+            index.refresh()
+        return index
+
+    def replicate(self, path, fields=None, full=False):
+        '''Copy the documents inserted since the last replication, and the tags and counter settings, into a local replica file,
+        which can be read offline with :class:`ReplicaBlackboard<macsy.replicas.ReplicaBlackboard>`, see :class:`ReplicaSync<macsy.replicas.ReplicaSync>`.
+
+        Args:
+            path (:class:`str`): path of the replica file, which is created if it does not exist.
+            fields (:class:`list[str]`, optional): fields of the documents to copy (the tags are always copied), defaults to all the fields.
+            full (:class:`bool`, optional): copy the whole blackboard again, e.g. to pick up changes to documents which were already copied.
+
+        Returns:
+            :class:`SyncReport<macsy.replicas.SyncReport>`: number of partitions read, documents copied and tags.
+
+        Example:
+            >>> blackboard.replicate('/data/replicas/ARTICLE.db', fields=['T', 'D'])
+            >>> replica = ReplicaBlackboard('/data/replicas/ARTICLE.db')
+            >>> replica.count(tags=['Tag_1'], min_date=['2017-01-01'])
+        '''
+        from macsy.replicas import ReplicaSync
+        return ReplicaSync(self, path, fields).run(full)
+
     def get_all_tags(self):
         '''Get a list of all the tags in the blackboard.
 
@@ -243,6 +614,54 @@ class Blackboard():
         '''
         return self.tag_manager.check_tag_type(tag, self.tag_manager.is_inheritable_tag)
 
+    def join(self, docs, target, field, into=None, projection=None, batch_size=1000, cache_size=10000):
+        '''Add the documents of another blackboard referenced by a stream of documents of this blackboard, e.g. the feeds of articles.
+
+        The references of each batch of **batch_size** documents are fetched with one $in query, and the referenced documents
+        are kept in a bounded LRU cache, see :class:`BlackboardJoin<macsy.joins.BlackboardJoin>`.
+
+        Args:
+            docs (iterable): documents of this blackboard, e.g. from :meth:`find`.
+            target (:class:`Blackboard`): the blackboard holding the referenced documents.
+            field (:class:`str`): field of the documents holding the id, or list of ids, of the referenced documents, e.g. 'Fds' or 'oID'.
+            into (:class:`str`, optional): field to add the referenced documents to, defaults to the name of **target**.
+            projection (:class:`list[str]` or :class:`dict`, optional): fields of the referenced documents to fetch.
+            batch_size (:class:`int`, optional): number of documents whose references are fetched together.
+            cache_size (:class:`int`, optional): maximum number of referenced documents cached.
+
+        Returns:
+            :class:`BlackboardJoin<macsy.joins.BlackboardJoin>`: iterable of the documents with the referenced documents added.
+
+        Example:
+            >>> feeds = api.load_blackboard('FEED')
+            >>> for doc in articles.join(articles.find(tags=['Tag_1']), feeds, 'Fds', into='Feeds', projection=['Nm']):
+            >>> ... print(doc['T'], [feed['Nm'] for feed in doc['Feeds']])
+        '''
+        from macsy.joins import BlackboardJoin
+        return BlackboardJoin(docs, target, field, into, projection, batch_size, cache_size=cache_size)
+
+    def propagate_tags(self, child, link_field='Fds', full=False, remove=False):
+        '''Propagate the inheritable tags of the documents in this blackboard to the documents of a child blackboard which link to them.
+
+        Only the documents whose inheritable tags changed since the last propagation to **child** are processed,
+        and documents with the same inheritable tags are applied together, see :class:`TagPropagator<macsy.inheritance.TagPropagator>`.
+
+        Args:
+            child (:class:`Blackboard`): the blackboard to propagate tags to.
+            link_field (:class:`str`, optional): field of the child documents holding the ids of the documents in this blackboard.
+            full (:class:`bool`, optional): process all the documents with inheritable tags, e.g. after changing which tags are inheritable.
+            remove (:class:`bool`, optional): also remove tags which documents have lost from their children.
+
+        Returns:
+            :class:`PropagationReport<macsy.inheritance.PropagationReport>`: number of documents processed, updates sent, and children matched and modified.
+
+        Example:
+            >>> feeds = api.load_blackboard('FEED')
+            >>> feeds.propagate_tags(api.load_blackboard('ARTICLE'), link_field='Fds')
+        '''
+        from macsy.inheritance import TagPropagator
+        return TagPropagator(self, child, link_field, remove).run(full)
+
 
 class DateBasedBlackboard(Blackboard):
     '''DateBasedBlackboard object that acts as an interface for retrieving and inserting data from a date-based blackboard.
@@ -261,7 +680,7 @@ class DateBasedBlackboard(Blackboard):
             >>> api = BlackboardAPI(settings)
             >>> blackboard = api.load_blackboard('ARTICLE')
         '''
-        super().__init__((settings[0], settings[1].upper(), settings[2]))
+        super().__init__((settings[0], settings[1].upper()) + tuple(settings[2:]))
         self.document_manager = DateBasedDocumentManager(self)
 
     def get_date(self, doc):
@@ -278,6 +697,49 @@ class DateBasedBlackboard(Blackboard):
         '''
         return self.document_manager.get_date(doc)
 
+    def count_by_period(self, interval='day', **kwargs):
+        '''Count the number of documents in each day, week or month, using an aggregation on the database server.
+
+        Periods are derived from the document ids, and every period between the earliest and latest
+        date (or **min_date** and **max_date**) is included, even if it has no documents.
+        The partition collections are aggregated concurrently.
+
+        Args:
+            interval (:class:`str`, optional): length of the periods: 'day', 'week' (starting on Mondays), 'month' or 'year'.
+            **kwargs: the same filters as :meth:`count()<macsy.blackboards.Blackboard.count>`.
+
+        Returns:
+            :class:`dict`: number of documents for each period, keyed by the :class:`datetime.datetime` the period starts at.
+
+        Raises:
+            :class:`ValueError`: If **interval** is not a valid interval.
+        '''
+        periods, counts = self.document_manager.count_by_period(interval, **kwargs)
+        return dict(zip(periods, counts))
+
+    def count_tags_by_period(self, interval='month', rows=None, **kwargs):
+        '''Count the number of documents annotated with each tag in each day, week or month, using an aggregation on the database server.
+
+        Args:
+            interval (:class:`str`, optional): length of the periods: 'day', 'week' (starting on Mondays), 'month' or 'year'.
+            rows (:class:`list[int]` or :class:`list[str]`, optional): the tags (ids or names) to count, defaults to all tags.
+            **kwargs: the same filters as :meth:`count()<macsy.blackboards.Blackboard.count>`.
+
+        Returns:
+            :class:`TagPeriodMatrix<macsy.analytics.TagPeriodMatrix>`: matrix of counts with a row per tag and a column per period.
+
+        Raises:
+            :class:`ValueError`: If **interval** is not a valid interval, or one of the **rows** does not exist.
+
+        Example:
+            >>> matrix = blackboard.count_tags_by_period('week', rows=['Tag_1', 'Tag_2'], min_date=['2017-01-01'])
+            >>> matrix.counts.sum(axis=1) # total for each tag
+        '''
+        from macsy.analytics import build_tag_period_matrix
+        tag_ids = [self.tag_manager.get_canonical_tag(tag)[self.tag_manager.tag_id] for tag in rows] if rows else None
+        periods, counts = self.document_manager.count_tags_by_period(interval, tag_ids, **kwargs)
+        return build_tag_period_matrix(periods, counts, self.tag_manager.get_tag_names())
+
     def get_earliest_date(self):
         '''Retrieve the oldest document date in the blackboard.
 
@@ -293,3 +755,186 @@ class DateBasedBlackboard(Blackboard):
             :class:`datetime.datetime`: the most recent datetime stored in the blackboard.
         '''
         return self.document_manager.get_latest_date()
+
+    def get_partitioning(self):
+        '''Get the granularity of the collections new documents are stored in.
+
+        Returns:
+            :class:`str`: 'year', 'month' or 'week'.
+        '''
+        return self.document_manager._partitioning
+
+    @check_admin('Admin rights required to change the partitioning of a blackboard.')
+    def set_partitioning(self, granularity):
+        '''Set the granularity of the collections new documents are stored in, in the blackboard's counter collection.
+
+        Collections are named after the period they hold, e.g. ARTICLE_2017, ARTICLE_201703 or ARTICLE_20170306 (the Monday a week starts on).
+        Existing collections keep working: documents are always routed to the finest existing collection for their date,
+        and a collection of the configured granularity is only created when none exists. Use :meth:`repartition`
+        to move the documents of an existing collection into finer ones.
+
+        Args:
+            granularity (:class:`str`): 'year', 'month' or 'week'.
+
+        Raises:
+            :class:`ValueError`: If **granularity** is not a valid granularity.
+            :class:`PermissionError`: If the user does not have admin privileges.
+        '''
+        self.counter_manager.set_partitioning(granularity)
+        self.document_manager._partitioning = granularity
+        self.document_manager._invalidate_catalog()
+
+    @check_admin('Admin rights required to repartition a blackboard.')
+    def repartition(self, key, granularity=None, batch_size=1000):
+        '''Move the documents of a collection into finer-grained collections, while the blackboard stays in use.
+
+        Documents are moved in batches, in id order, by copying them to their new collection and then removing them from the old one,
+        which is dropped once empty. Updates made through :meth:`update`, :meth:`add_tag` and :meth:`remove_tag` during the move
+        find the documents in either collection. The move can be resumed by running it again.
+        The granularity becomes the blackboard's partitioning (see :meth:`set_partitioning`), so documents for periods
+        of the key which have no collection yet are stored at that granularity too, rather than recreating the split collection.
+
+        Args:
+            key (:class:`int`): key of the collection to split, e.g. 2017 for ARTICLE_2017.
+            granularity (:class:`str`, optional): 'month' or 'week', defaults to the configured partitioning.
+            batch_size (:class:`int`, optional): number of documents moved at a time.
+
+        Returns:
+            :class:`int`: number of documents moved.
+
+        Raises:
+            :class:`ValueError`: If **granularity** is not finer than the collection.
+            :class:`PermissionError`: If the user does not have admin privileges.
+
+        Example:
+            >>> blackboard.set_partitioning('month')
+            >>> blackboard.repartition(2017)
+        '''
+        return self.document_manager.repartition(key, granularity, batch_size)
+
+    @check_admin('Admin rights required to archive a partition of a blackboard.')
+    def archive(self, key, path, chunk_size=10000):
+        '''Move a cold collection out of the database into compressed chunk files in a local directory.
+
+        The documents are written in id order to gzip-compressed chunks of **chunk_size** documents, with an index of the
+        id range of each chunk, and the collection is dropped once they are all written. The directory is recorded in the
+        blackboard's counter collection, and :meth:`find`, :meth:`count` and :meth:`get_many` keep returning the archived
+        documents, reading only the chunks overlapping the requested dates. Other queries and writes only see the collections
+        in the database, so new documents for an archived period go into a new collection, and duplicates of archived documents
+        are not detected. Use :meth:`restore` to move the documents back into the database.
+
+        Args:
+            key (:class:`int`): key of the collection to archive, e.g. 2009 for ARTICLE_2009.
+            path (:class:`str`): directory to write the archive to, which should be readable by all the blackboard's users.
+            chunk_size (:class:`int`, optional): number of documents in each chunk file.
+
+        Returns:
+            :class:`int`: number of documents archived.
+
+        Raises:
+            :class:`ValueError`: If the collection is already archived.
+            :class:`FileExistsError`: If **path** already holds an archive.
+            :class:`RuntimeError`: If documents were added to the collection while it was archived, in which case it is not dropped.
+            :class:`PermissionError`: If the user does not have admin privileges.
+
+        Example:
+            >>> for year in range(2009, 2014):
+            >>> ... blackboard.archive(year, '/data/archives/ARTICLE_{}'.format(year))
+        '''
+        return self.document_manager.archive(key, path, chunk_size)
+
+    @check_admin('Admin rights required to restore a partition of a blackboard.')
+    def restore(self, key, batch_size=1000):
+        '''Move the documents of an archived collection back into the database.
+
+        Documents are written in batches, replacing any copies already in the collection, so an interrupted restore can be run again.
+        The chunk files are left in place.
+
+        Args:
+            key (:class:`int`): key of the archived collection, e.g. 2009 for ARTICLE_2009.
+            batch_size (:class:`int`, optional): number of documents written at a time.
+
+        Returns:
+            :class:`int`: number of documents restored.
+
+        Raises:
+            :class:`KeyError`: If the collection is not archived.
+            :class:`PermissionError`: If the user does not have admin privileges.
+        '''
+        return self.document_manager.restore(key, batch_size)
+
+    def rollup_count(self, tags=None, min_date=None, max_date=None, by_day=False):
+        '''Count the documents in each day, or with each tag, from the rollup counters rather than the document collections.
+
+        Reads one counter document per day in the date range, so is much faster than :meth:`count` or :meth:`count_tags`
+        over long periods. Dates are rounded to whole days (in UTC), and documents with several of the **tags** are counted once for each tag.
+
+        Args:
+            tags (:class:`list[int or str]`, optional): ids or names of the tags to count, rather than all the documents.
+            min_date (:class:`list[str]`, optional): count documents from this date, e.g. ['2017-01-01'].
+            max_date (:class:`list[str]`, optional): count documents before this date.
+            by_day (:class:`bool`, optional): return the counts of each day rather than their totals.
+
+        Returns:
+            :class:`int` or :class:`dict`: number of documents, or for each of the **tags** when given. With **by_day**, an
+            :class:`collections.OrderedDict` of these for each day (as a :class:`datetime.datetime`) which has documents.
+
+        Raises:
+            :class:`ValueError`: If rollups are not enabled for the blackboard, or one of the **tags** does not exist.
+
+        Example:
+            >>> blackboard.rollup_count(tags=['Tag_1', 'Tag_2'], min_date=['2017-01-01'], max_date=['2018-01-01'])
+            {'Tag_1': 1250, 'Tag_2': 56}
+        '''
+        return self.rollup_manager.count(tags, min_date, max_date, by_day)
+
+    @check_admin('Admin rights required to enable the rollups of a blackboard.')
+    def enable_rollups(self):
+        '''Maintain counters of the documents in each day, and with each tag, which are read by :meth:`rollup_count`.
+
+        The counters are kept in the blackboard's rollup collection, and are updated with one batch of increments by every
+        insert, update, deletion or change of tags made through the blackboard (including :meth:`update_where`, :meth:`delete_where`
+        and bulk writes), at the cost of reading the tags of the changed documents first. They are built from the existing documents
+        when enabled. Blackboards loaded elsewhere start updating them within
+        :attr:`RollupManager.enabled_reload<macsy.managers.RollupManager.enabled_reload>` seconds, so changes they make in
+        that time are only counted by :meth:`rebuild_rollups`.
+
+        Returns:
+            :class:`list[datetime.datetime]`: the days whose counters were written.
+
+        Raises:
+            :class:`PermissionError`: If the user does not have admin privileges.
+        '''
+        self.rollup_manager.set_enabled(True)
+        return self.rollup_manager.rebuild()
+
+    @check_admin('Admin rights required to disable the rollups of a blackboard.')
+    def disable_rollups(self):
+        '''Stop maintaining the rollup counters of the blackboard, and drop them.
+
+        Raises:
+            :class:`PermissionError`: If the user does not have admin privileges.
+        '''
+        self.rollup_manager.set_enabled(False)
+
+    @check_admin('Admin rights required to rebuild the rollups of a blackboard.')
+    def rebuild_rollups(self):
+        '''Recount the documents in each day, and with each tag, reading the collections and archives concurrently,
+        and rewrite the rollup counters of the days which differ.
+
+        Returns:
+            :class:`list[datetime.datetime]`: the days whose counters were rewritten.
+
+        Raises:
+            :class:`PermissionError`: If the user does not have admin privileges.
+        '''
+        return self.rollup_manager.rebuild()
+
+    def verify_rollups(self):
+        '''Recount the documents in each day, and with each tag, like :meth:`rebuild_rollups`, without changing the rollup counters.
+
+        Returns:
+            :class:`list[datetime.datetime]`: the days whose counters are wrong, e.g. because of writes by blackboards loaded before
+            rollups were enabled, or made directly to the database.
+        '''
+        return self.rollup_manager.rebuild(verify=True)
@@ -0,0 +1,146 @@
+'''Catalogs describe the blackboards in a database, so they can be discovered without querying each one.'''
+
+from collections import namedtuple, OrderedDict
+from macsy.utils import run_concurrently, partition_range
+
+BlackboardInfo = namedtuple('BlackboardInfo', ['name', 'type', 'collections', 'required_indexes', 'partitioning', 'archives'])
+BlackboardInfo.__doc__ = '''Description of a blackboard in the :class:`BlackboardCatalog`.
+
+    The **collections** map each partition key (e.g. 2017, 201703 or 20170306 for the year, month or week
+    collections of date-based blackboards, or :class:`None`) to the name of the collection holding its documents,
+    **required_indexes** are the indexes the blackboard's counter collection asks for, and **partitioning**
+    is the granularity new collections are created with ('year', 'month' or 'week', or :class:`None` for standard blackboards),
+    and **archives** map the keys of archived partitions to the directories holding their chunk files.
+'''
+
+class BlackboardCatalog():
+    '''Cached catalog of the blackboards in a database, read with one listing of the collections
+    and one query per counter collection (run concurrently).
+
+    The catalog is read when first used, and re-read by :meth:`refresh`. Blackboards which are not in the
+    cached catalog are looked up individually, so blackboards created since the last refresh are still found.
+    Loading a blackboard re-reads its own description (see :meth:`get`), as other clients may have added
+    partitions or dropped it since, while the names and the count and index summaries are only re-read by :meth:`refresh`.
+
+    Example:
+        >>> catalog = api.get_catalog()
+        >>> catalog.get('ARTICLE').collections
+        OrderedDict([(2009, 'ARTICLE_2009'), (2010, 'ARTICLE_2010'), ...])
+        >>> catalog.get_estimated_count('ARTICLE')
+    '''
+
+    def __init__(self, db):
+        '''This should not be called directly, see :meth:`get_catalog()<macsy.api.BlackboardAPI.get_catalog>`.'''
+        self._db = db
+        self._entries = None
+        self._counts = {}
+        self._indexes = {}
+
+    def refresh(self):
+        '''Re-read the catalog from the database, discarding any cached counts and index states.
+
+        Returns:
+            :class:`BlackboardCatalog`: the catalog.
+        '''
+        groups = group_collections(self._db.list_collection_names())
+        infos = run_concurrently(lambda item: self._read_info(*item), list(groups.items()))
+        self._entries = OrderedDict((info.name, info) for info in infos if info is not None)
+        self._counts, self._indexes = {}, {}
+        return self
+
+    def get_names(self):
+        '''Get the names of all the blackboards.
+
+        Returns:
+            :class:`list[str]`: names of the blackboards, in alphabetical order.
+        '''
+        return list(self._get_entries())
+
+    def get(self, blackboard_name, refresh=False):
+        '''Get the description of a blackboard by name.
+
+        Args:
+            blackboard_name (:class:`str`): the name of the blackboard.
+            refresh (:class:`bool`, optional): re-read the description of the blackboard from the database,
+                rather than using the cached one which may miss changes made by other clients.
+
+        Returns:
+            :class:`BlackboardInfo` or :class:`None`: description of the blackboard, or :class:`None` if it does not exist.
+        '''
+        fresh = self._entries is None
+        entries = self._get_entries()
+        if not fresh and (refresh or blackboard_name not in entries):
+            collections = group_collections(self._db.list_collection_names()).get(blackboard_name)
+            info = self._read_info(blackboard_name, collections) if collections else None
+            if info != entries.get(blackboard_name):
+                self.invalidate(blackboard_name)
+            if info is None:
+                return None
+            entries[blackboard_name] = info
+        return entries.get(blackboard_name)
+
+    def invalidate(self, blackboard_name):
+        '''Forget the cached description of a blackboard, e.g. after it has been dropped.'''
+        for cache in [self._get_entries(), self._counts, self._indexes]:
+            cache.pop(blackboard_name, None)
+
+    def get_estimated_count(self, blackboard_name):
+        '''Get the estimated number of documents in a blackboard, from the metadata of its collections.
+
+        Returns:
+            :class:`int`: estimated number of documents, or 0 if the blackboard does not exist.
+        '''
+        if blackboard_name not in self._counts:
+            info = self.get(blackboard_name)
+            names = list(info.collections.values()) if info else []
+            self._counts[blackboard_name] = sum(run_concurrently(lambda name: self._db[name].estimated_document_count(), names))
+        return self._counts[blackboard_name]
+
+    def get_index_state(self, blackboard_name):
+        '''Get the required indexes which are missing from each collection of a blackboard.
+
+        Returns:
+            :class:`dict`: list of the missing index keys (each a list of (field, direction) pairs) for each collection name.
+        '''
+        if blackboard_name not in self._indexes:
+            info = self.get(blackboard_name)
+            names = list(info.collections.values()) if info else []
+            required = [list(index.items()) for index in info.required_indexes] if info else []
+            existing = run_concurrently(lambda name: [index['key'] for index in self._db[name].index_information().values()], names)
+            self._indexes[blackboard_name] = {name : [index for index in required if index not in keys] for name, keys in zip(names, existing)}
+        return self._indexes[blackboard_name]
+
+    def _get_entries(self):
+        if self._entries is None:
+            self.refresh()
+        return self._entries
+
+    def _read_info(self, blackboard_name, collections):
+        from macsy.managers import CounterManager
+        counter = self._db[blackboard_name + CounterManager.counter_suffix]
+        settings = {doc[CounterManager.counter_id] : doc for doc in counter.find(
+            {CounterManager.counter_id : {'$in' : [CounterManager.counter_type, CounterManager.counter_indexes, CounterManager.counter_partitioning, CounterManager.counter_archives]}})}
+        if CounterManager.counter_type not in settings:
+            return None
+        blackboard_type = settings[CounterManager.counter_type].get(CounterManager.counter_type)
+        partitioning, archives = None, {}
+        if blackboard_type == CounterManager.counter_type_date_based:
+            keys = sorted((int(suffix) for suffix in collections if suffix.isdigit()), key=partition_range)
+            partitions = OrderedDict((key, collections[str(key)]) for key in keys)
+            partitioning = settings.get(CounterManager.counter_partitioning, {}).get(CounterManager.counter_partitioning, CounterManager.counter_partitioning_default)
+            archives = {int(key) : path for key, path in settings.get(CounterManager.counter_archives, {}).get(CounterManager.counter_archives, {}).items()}
+        else:
+            partitions = OrderedDict([(None, blackboard_name)])
+        required = settings.get(CounterManager.counter_indexes, {}).get(CounterManager.counter_indexes, [])
+        return BlackboardInfo(blackboard_name, blackboard_type, partitions, required, partitioning, archives)
+
+def group_collections(collection_names):
+    '''Group collection names by the blackboard they belong to, mapping each suffix (e.g. 'COUNTER' or '2017') to the collection name.
+
+    Blackboard names cannot contain underscores, so the blackboard of a collection is the part of its name before the first underscore.
+    '''
+    groups = {}
+    for name in collection_names:
+        blackboard_name, _, suffix = name.partition('_')
+        groups.setdefault(blackboard_name, {})[suffix] = name
+    return OrderedDict(sorted(groups.items()))
@@ -1,41 +1,229 @@
 '''Cursors are used for iterating over database query results.'''
 
+import time
+import heapq
+import queue
+import threading
+from pymongo.errors import AutoReconnect, CursorNotFound
+from macsy.archives import ArchiveCursor
+
 class BlackboardCursor:
     '''Cursor object for iterating through results pulled from the database.
     Returned when calling :meth:`find()<macsy.blackboards.Blackboard.find>` on a :class:`Blackboard<macsy.blackboards.Blackboard>`.
 
+    If the database discards the cursor (:class:`CursorNotFound`) or the connection drops (:class:`AutoReconnect`),
+    the cursor transparently reopens the scan from the last retrieved id.
+
     Example:
         >>> cursor = blackboard.find()
         >>> for doc in cursor:
         >>> ... print(doc)
+        >>> # resume a descending scan later on, e.g. from a checkpoint
+        >>> cursor = blackboard.find(before_id=cursor.last_id)
     '''
 
-    def __init__(self, cursors_and_max_docs):
-        cursors, max_docs = cursors_and_max_docs
-        self.__cursors = [x for x in cursors if x.count() > 0] if(isinstance(cursors,list)) else [cursors]
+    reopen_attempts = 3
+    reopen_delay = 0.5
+
+    def __init__(self, cursors_max_docs_and_reopen):
+        cursors, max_docs, reopen = cursors_max_docs_and_reopen
+        self.__cursors = [x for x in cursors if not _is_empty(x)] if(isinstance(cursors,list)) else [cursors]
         self.__current = 0
         self.__retrieved = 0
         self.__max_docs = max_docs
+        self.__reopen = reopen
+        self.__failures = 0
+        self.__last_id = None
+
+    @property
+    def last_id(self):
+        '''The id of the last document retrieved from the cursor, or :class:`None` if nothing has been retrieved yet.
+
+        Pass it as **after_id** (ascending scans) or **before_id** (descending scans) to
+        :meth:`find()<macsy.blackboards.Blackboard.find>` to resume the scan where it stopped.
+        '''
+        return self.__last_id
+
+    def close(self):
+        '''Close the database cursors, e.g. to stop reading a scan which was not read to the end.
+
+        Called automatically once the cursor is exhausted or has returned **max** documents.
+        '''
+        for cursor in self.__cursors:
+            close = getattr(cursor, 'close', None)
+            if close is not None:
+                close()
 
     def __iter__(self):
         return self
 
+    def __del__(self):
+        self.close()
+
     def __next__(self):
         while self.__current < len(self.__cursors):
             self._retrieved_max()
             try:
-                return next(self.__cursors[self.__current])
+                doc = next(self.__cursors[self.__current])
+                self.__last_id = doc.get('_id', self.__last_id)
+                self.__failures = 0
+                return doc
             except StopIteration:
                 self.__retrieved -= 1
                 self.__current += 1
+            except (CursorNotFound, AutoReconnect) as error:
+                self.__retrieved -= 1
+                self._reopen_current(error)
             finally:
                 self.__retrieved += 1
+        self.close()
         raise StopIteration()
 
     def __len__(self):
-        count = sum([x.count() for x in self.__cursors]) 
+        count = sum([x.count() for x in self.__cursors])
         return count if self.__max_docs == 0 or count < self.__max_docs else self.__max_docs
 
     def _retrieved_max(self):
         if self.__max_docs > 0 and self.__retrieved >= self.__max_docs:
+            self.close()
             raise StopIteration()
+
+    def _reopen_current(self, error):
+        self.__failures += 1
+        if self.__reopen is None or self.__failures > BlackboardCursor.reopen_attempts:
+            raise error
+        time.sleep(BlackboardCursor.reopen_delay * (self.__failures - 1))
+        self.__cursors[self.__current] = self.__reopen(self.__cursors[self.__current], self.__last_id)
+
+class ParallelCursor:
+    '''Cursor reading several database cursors concurrently, returning their documents in the order they arrive.
+
+    Used by :meth:`find()<macsy.blackboards.Blackboard.find>` for unsorted scans (``sort=None``) over several collections,
+    so the year collections are read in parallel rather than one after the other. Each cursor is read by a thread of a
+    pool of up to **max_workers** threads, into a queue of up to **queue_size** documents. An error reading one of
+    the cursors is raised when the cursor reaches it. The threads stop once the cursor is closed (or garbage collected),
+    so scans which are not read to the end do not keep them running.
+    '''
+
+    max_workers = 16
+    queue_size = 1000
+
+    def __init__(self, cursors):
+        self.__cursors = cursors
+        self.__queue = None
+        self.__running = 0
+        self.__closed = threading.Event()
+
+    def count(self, *args, **kwargs):
+        return sum(cursor.count(*args, **kwargs) for cursor in self.__cursors)
+
+    def close(self):
+        '''Stop reading the cursors.'''
+        self.__closed.set()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.__queue is None:
+            self._start()
+        while self.__running > 0:
+            item = self.__queue.get()
+            if item is _finished:
+                self.__running -= 1
+            elif isinstance(item, _Failure):
+                self.close()
+                raise item.error
+            else:
+                return item
+        raise StopIteration()
+
+    def __del__(self):
+        self.close()
+
+    def _start(self):
+        self.__queue = queue.Queue(ParallelCursor.queue_size)
+        self.__running = len(self.__cursors)
+        pending = queue.Queue()
+        for cursor in self.__cursors:
+            pending.put(cursor)
+        # The threads only hold the queues and the closed flag, not the cursor, so an abandoned cursor is still collected
+        for _ in range(max(1, min(len(self.__cursors), ParallelCursor.max_workers))):
+            threading.Thread(target=_read_cursors, args=(pending, self.__queue, self.__closed), daemon=True).start()
+
+class MergedCursor:
+    '''Cursor merging several database cursors sorted by id into a single stream in id order, without duplicate ids.
+
+    Used by :meth:`find()<macsy.blackboards.Blackboard.find>` for partitions whose date ranges overlap, e.g. a year
+    collection and the month collections it is being repartitioned into, or an archived year and the collection
+    of documents added to it since. The documents stay in order, so the scan can be resumed from its last id.
+    '''
+
+    def __init__(self, cursors, order):
+        self.cursors = cursors
+        self.order = order
+        self.__merged = heapq.merge(*cursors, key=lambda doc: doc['_id'], reverse=order < 0)
+        self.__last_id = None
+
+    def count(self, *args, **kwargs):
+        return sum(cursor.count(*args, **kwargs) for cursor in self.cursors)
+
+    def close(self):
+        '''Close the merged cursors.'''
+        for cursor in self.cursors:
+            close = getattr(cursor, 'close', None)
+            if close is not None:
+                close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            doc = next(self.__merged)
+            # A document being moved between partitions can briefly be in both
+            if self.__last_id is None or doc['_id'] != self.__last_id:
+                self.__last_id = doc['_id']
+                return doc
+
+def _is_empty(cursor):
+    # Counting an archive's documents means reading its chunks, so archived sources are kept even when empty
+    if isinstance(cursor, ArchiveCursor):
+        return False
+    if isinstance(cursor, MergedCursor):
+        return all(_is_empty(x) for x in cursor.cursors)
+    return cursor.count() == 0
+
+def _read_cursors(pending, results, closed):
+    while not closed.is_set():
+        try:
+            cursor = pending.get_nowait()
+        except queue.Empty:
+            return
+        _read(cursor, results, closed)
+
+def _read(cursor, results, closed):
+    try:
+        for doc in cursor:
+            if closed.is_set() or not _put(doc, results, closed):
+                break
+    except Exception as error:
+        _put(_Failure(error), results, closed)
+    finally:
+        _put(_finished, results, closed)
+
+def _put(item, results, closed):
+    while not closed.is_set():
+        try:
+            results.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+class _Failure:
+
+    def __init__(self, error):
+        self.error = error
+
+_finished = object()
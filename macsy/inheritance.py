@@ -0,0 +1,153 @@
+'''Inheritance pushes the inheritable tags of parent documents down to the documents of a child blackboard which link to them.'''
+
+import pymongo
+from datetime import timedelta
+from itertools import islice, chain
+from collections import namedtuple, OrderedDict
+from bson import ObjectId
+from macsy.utils import listify
+
+PropagationReport = namedtuple('PropagationReport', ['parents', 'updates', 'matched', 'modified'])
+PropagationReport.__doc__ = '''Summary of a run of a :class:`TagPropagator`.
+
+    The **parents** are the number of parent documents processed, **updates** the number of grouped updates sent
+    to the child blackboard, and **matched** and **modified** the number of child documents they matched and changed.
+'''
+
+class TagPropagator():
+    '''Propagates the inheritable tags of the documents of a parent blackboard to the documents of a child blackboard,
+    e.g. from FEED to ARTICLE, where each child links to its parents by id in **link_field** (e.g. 'Fds' or 'oID').
+
+    Parents with the same inheritable tags are grouped, and each group is applied to the children with one update per
+    child collection, which only matches the children missing some of the tags (or holding tags to remove). Tags are
+    matched between the blackboards by name, and created (as inheritable tags) in the child blackboard when missing,
+    so propagation can be chained, e.g. FEED to ARTICLE to SENTENCE.
+
+    Changes to the inheritable tags of a document are marked on the document when they are written, and runs are incremental:
+    after the first (full) run, only the parents marked since the previous run are processed, so the work grows with the
+    number of changes rather than the size of the blackboards. The first run adds an index on the marker field, 'TgC',
+    to the parent blackboard's required indexes for this. The state of each run is kept in the parent blackboard's
+    propagation collection. Children linked to a parent after its tags were propagated, and changes to which tags are
+    inheritable, are only picked up by a full run.
+
+    Example:
+        >>> propagator = TagPropagator(api.load_blackboard('FEED'), api.load_blackboard('ARTICLE'), link_field='Fds')
+        >>> report = propagator.run()
+        >>> print(report.parents, report.modified)
+    '''
+
+    state_suffix = '_PROPAGATION'
+    overlap = timedelta(minutes=5)
+
+    def __init__(self, parent, child, link_field='Fds', remove=False, batch_size=1000):
+        '''Constructor for the TagPropagator.
+
+        Args:
+            parent (:class:`Blackboard<macsy.blackboards.Blackboard>`): the blackboard to propagate tags from.
+            child (:class:`Blackboard<macsy.blackboards.Blackboard>`): the blackboard to propagate tags to.
+            link_field (:class:`str`, optional): field of the child documents holding the ids of their parents.
+            remove (:class:`bool`, optional): also remove the tags which parents have lost since they were last propagated
+                from their children (including from children which have the tag from another parent).
+            batch_size (:class:`int`, optional): maximum number of parents in each grouped update.
+        '''
+        self._parent = parent
+        self._child = child
+        self._link_field = link_field
+        self._remove = remove
+        self._batch_size = batch_size
+        self._target = '{}.{}'.format(child._name, link_field)
+        self._state = parent._db[parent._name + TagPropagator.state_suffix]
+
+    def run(self, full=False):
+        '''Propagate the inheritable tags of the parents which changed since the last run.
+
+        Args:
+            full (:class:`bool`, optional): process all the parents with inheritable tags, rather than only those which changed.
+                The first run is always full.
+
+        Returns:
+            :class:`PropagationReport`: summary of the run.
+        '''
+        started = ObjectId()
+        doc_m = self._parent.document_manager
+        inheritable = self._parent.tag_manager.get_inheritable_tags()
+        # Only the tags of the parents are read, in batches, so a full run does not hold every parent in memory
+        parents = self._get_parents(inheritable, full, [doc_m.doc_tags, doc_m.doc_control_tags])
+        additions, removals, count = OrderedDict(), OrderedDict(), 0
+        for batch in iter(lambda: list(islice(parents, self._batch_size)), []):
+            previous = self._get_previous([doc[doc_m.doc_id] for doc in batch])
+            states = []
+            for doc in batch:
+                doc_id = doc[doc_m.doc_id]
+                tags = sorted(set(inheritable[tag] for tag in self._get_tags(doc) if tag in inheritable))
+                lost = sorted(set(previous.get(doc_id, [])).difference(tags))
+                if tags:
+                    additions.setdefault(tuple(tags), []).append(doc_id)
+                if lost and self._remove:
+                    removals.setdefault(tuple(lost), []).append(doc_id)
+                states.append(pymongo.ReplaceOne({'_id' : self._state_id(doc_id)}, {'target' : self._target, 'parent' : doc_id, 'tags' : tags}, upsert=True))
+            self._state.bulk_write(states, ordered=False)
+            count += len(batch)
+        results = [self._apply(tags, ids, 'add_tags') for tags, ids in additions.items()]
+        results += [self._apply(tags, ids, 'remove_tags') for tags, ids in removals.items()]
+        self._state.update_one({'_id' : self._target}, {'$set' : {'target' : self._target, 'last' : started}}, upsert=True)
+        return PropagationReport(count, *[sum(x) for x in zip((0, 0, 0), *results)])
+
+    def reset(self):
+        '''Remove the state of the propagation, so that the next run is full.'''
+        return self._state.delete_many({'target' : self._target}).deleted_count
+
+    def _get_parents(self, inheritable, full, projection):
+        last = self._state.find_one({'_id' : self._target})
+        doc_m = self._parent.document_manager
+        if last is None:
+            # Incremental runs query the parents by the marker of their last tag change
+            doc_m.require_index({doc_m.doc_tags_changed : 1})
+        if full or last is None:
+            tagged = self._parent.find(query={'$or' : [{field : {'$in' : list(inheritable)}} for field in [doc_m.doc_tags, doc_m.doc_control_tags]]}, projection=projection)
+            return chain(tagged, self._get_untagged_parents(inheritable, projection))
+        since = ObjectId.from_datetime(last['last'].generation_time - TagPropagator.overlap)
+        return iter(self._parent.find(query={doc_m.doc_tags_changed : {'$gte' : since}}, projection=projection))
+
+    def _get_untagged_parents(self, inheritable, projection):
+        # Parents which lost all their inheritable tags since they were propagated are found from the state, read in batches
+        # of ids rather than as one query of every parent ever propagated, which would not fit in a query document
+        states = self._state.find({'target' : self._target, 'parent' : {'$exists' : True}, 'tags' : {'$ne' : []}}, {'parent' : 1}).sort('_id', pymongo.ASCENDING)
+        parent_ids = (state['parent'] for state in states)
+        for batch in iter(lambda: list(islice(parent_ids, self._batch_size)), []):
+            docs, _ = self._parent.get_many(batch, projection)
+            for doc in docs:
+                if not any(tag in inheritable for tag in self._get_tags(doc)):
+                    yield doc
+
+    def _get_previous(self, parent_ids):
+        states = self._state.find({'_id' : {'$in' : [self._state_id(doc_id) for doc_id in parent_ids]}})
+        return {state['parent'] : state['tags'] for state in states}
+
+    def _get_tags(self, doc):
+        doc_m = self._parent.document_manager
+        return [tag for field in [doc_m.doc_tags, doc_m.doc_control_tags] for tag in listify(doc.get(field, []))]
+
+    def _apply(self, tag_names, parent_ids, changes_key):
+        tag_ids = [self._get_child_tag(name) for name in tag_names]
+        updates = self._child.document_manager.get_changes_updates(None, {changes_key : tag_ids})
+        count, matched, modified = 0, 0, 0
+        for start in range(0, len(parent_ids), self._batch_size):
+            link = {self._link_field : {'$in' : parent_ids[start:start + self._batch_size]}}
+            for update in updates:
+                result = self._child.document_manager.update_where(update, query={'$and' : [link, _get_pending_query(update)]})
+                count, matched, modified = count + 1, matched + result['matched'], modified + result['modified']
+        return (count, matched, modified)
+
+    def _get_child_tag(self, tag_name):
+        tag = self._child.tag_manager.get_tag(tag_name=tag_name)
+        return tag[self._child.tag_manager.tag_id] if tag is not None else self._child.tag_manager.insert_tag(tag_name, inheritable=True)
+
+    def _state_id(self, parent_id):
+        return '{}:{}'.format(self._target, parent_id)
+
+def _get_pending_query(update):
+    '''Query for the documents which an update of tags would change, so documents which are already up to date are not rewritten.'''
+    conditions = [{field : {'$not' : {'$all' : value['$each']}}} for field, value in update.get('$addToSet', {}).items() if value['$each']]
+    conditions += [{field : {'$in' : value}} for field, value in update.get('$pullAll', {}).items() if value]
+    return {'$or' : conditions}
@@ -0,0 +1,86 @@
+'''Joins resolve the references of the documents of one blackboard to the documents of another, in batches.'''
+
+from itertools import islice
+from macsy.utils import LRUCache, listify
+
+class BlackboardJoin():
+    '''Iterates over a stream of documents, adding the documents of a target blackboard which they reference by id in
+    **field** (e.g. the feeds of articles in 'Fds', or their outlet in 'oID').
+
+    The stream is read in batches of **batch_size** documents, and the referenced ids of each batch which are not cached
+    are fetched with one $in query (per target collection), so resolving a stream costs one query per batch rather than one per document.
+    The resolved documents are kept in a bounded LRU cache, as many documents reference the same few, e.g. articles from the same feed.
+    Ids which are not found are cached too, so are not fetched again.
+
+    Each document gets the resolved documents in **into**: a list for a list of references, or a single document
+    (or :class:`None` if it was not found) for a single reference. Resolved documents are shared between the documents
+    referencing them, so should not be modified. Joins can be chained to resolve several fields.
+
+    Example:
+        >>> articles, feeds, outlets = [api.load_blackboard(name) for name in ['ARTICLE', 'FEED', 'OUTLET']]
+        >>> docs = BlackboardJoin(articles.find(min_date=['2017-01-01']), feeds, 'Fds', into='Feeds', projection=['Nm'])
+        >>> for doc in BlackboardJoin(docs, outlets, 'oID', into='Outlet'):
+        >>> ... print(doc['T'], [feed['Nm'] for feed in doc['Feeds']], doc['Outlet'])
+    '''
+
+    _missing = object()
+
+    def __init__(self, docs, target, field, into=None, projection=None, batch_size=1000, cache=None, cache_size=10000):
+        '''Constructor for the BlackboardJoin.
+
+        Args:
+            docs (iterable): the documents to resolve the references of, e.g. a :class:`BlackboardCursor<macsy.cursors.BlackboardCursor>`.
+            target (:class:`Blackboard<macsy.blackboards.Blackboard>`): the blackboard holding the referenced documents.
+            field (:class:`str`): field of the documents holding the id, or list of ids, of the referenced documents.
+            into (:class:`str`, optional): field to add the referenced documents to, defaults to the name of the target blackboard.
+            projection (:class:`list[str]` or :class:`dict`, optional): fields of the referenced documents to fetch (the id is always included).
+            batch_size (:class:`int`, optional): number of documents whose references are fetched together.
+            cache (:class:`LRUCache<macsy.utils.LRUCache>`, optional): cache of referenced documents to share between joins
+                to the same blackboard with the same **projection**.
+            cache_size (:class:`int`, optional): maximum number of referenced documents cached, when **cache** is not given.
+        '''
+        self._docs = docs
+        self._target = target
+        self._field = field
+        self._into = into or target._name
+        self._projection = projection
+        self._batch_size = batch_size
+        self.cache = cache if cache is not None else LRUCache(cache_size)
+        self.queries = 0
+
+    def __iter__(self):
+        docs = iter(self._docs)
+        while True:
+            batch = [doc if isinstance(doc, dict) else dict(doc) for doc in islice(docs, self._batch_size)]
+            if not batch:
+                return
+            resolved = self._resolve(set(ref for doc in batch for ref in listify(doc.get(self._field)) if ref is not None))
+            for doc in batch:
+                refs = doc.get(self._field)
+                if isinstance(refs, list):
+                    doc[self._into] = [resolved[ref] for ref in refs if ref is not None and resolved[ref] is not None]
+                else:
+                    doc[self._into] = resolved[refs] if refs is not None else None
+                yield doc
+
+    @property
+    def hits(self):
+        ''':class:`int`: number of references resolved from the cache.'''
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        ''':class:`int`: number of references which had to be fetched.'''
+        return self.cache.misses
+
+    def _resolve(self, refs):
+        resolved = {ref : self.cache.get(ref, BlackboardJoin._missing) for ref in refs}
+        missing = [ref for ref, doc in resolved.items() if doc is BlackboardJoin._missing]
+        if missing:
+            found, _ = self._target.get_many(missing, self._projection)
+            self.queries += 1
+            found = {doc[self._target.document_manager.doc_id] : doc for doc in found}
+            for ref in missing:
+                resolved[ref] = found.get(ref)
+                self.cache.put(ref, resolved[ref])
+        return resolved
@@ -1,11 +1,41 @@
+import os
+import math
+import time
+import random
 import inspect
+import bisect
 import pymongo
-from macsy.utils import suppress_print_if_mocking
-from datetime import datetime
+from functools import partial
+from copy import deepcopy
+from itertools import islice
+from collections import namedtuple, Counter, OrderedDict
+from datetime import timedelta
+from macsy.utils import suppress_print_if_mocking, split_id_range, interval_boundaries, run_concurrently, period_index_expression, wilson_interval, allocate_sample, \
+    partition_key_formats, partition_key, partition_range, project, scan_raw, split_raw, listify
+from macsy.cursors import ParallelCursor, MergedCursor
+from datetime import datetime, timezone
 from dateutil import parser as dtparser
 from bson import ObjectId
 from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import BulkWriteError
 codec_options = DEFAULT_CODEC_OPTIONS.with_options(unicode_decode_error_handler='ignore')
+raw_codec_options = codec_options.with_options(document_class=RawBSONDocument)
+
+Partition = namedtuple('Partition', ['key', 'lower', 'upper'])
+CountEstimate = namedtuple('CountEstimate', ['estimate', 'lower', 'upper', 'sampled'])
+CountEstimate.__doc__ = '''Approximate number of documents, with the bounds of its confidence interval.
+
+    The **sampled** count is the number of documents the estimate was based on, which is 0 when
+    the count came from the collection metadata and index bounds alone.
+'''
+TagStatistics = namedtuple('TagStatistics', ['counts', 'totals', 'updated'])
+TagStatistics.__doc__ = '''Number of documents with each tag in each partition, used to plan queries.
+
+    The **counts** map each partition key (e.g. the year, or :class:`None` for standard blackboards) to a
+    :class:`collections.Counter` of the documents with each (field, tag id), the **totals** map each partition key
+    to its number of documents, and **updated** is when the statistics were counted.
+'''
 
 class BaseManager():
 
@@ -38,6 +68,12 @@ class CounterManager(BaseManager):
     counter_tag = "tag_counter"
     counter_doc = "doc_counter"
     counter_hash_fields = 'fields'
+    counter_partitioning = 'PARTITIONING'
+    counter_partitioning_default = 'year'
+    counter_archives = 'ARCHIVES'
+    counter_tag_statistics = 'TAG_STATISTICS'
+    counter_rollups = 'ROLLUPS'
+    counter_tag_version = 'TAG_VERSION'
 
     def __init__(self, blackboard):
         super().__init__(blackboard, CounterManager.counter_suffix)
@@ -59,13 +95,75 @@ class CounterManager(BaseManager):
         # fallback to ensure that ids are indexed.
         return [{self._blackboard.document_manager.doc_id : 1}]
 
+    def add_required_index(self, index):
+        self._collection.update_one({CounterManager.counter_id : CounterManager.counter_indexes},
+            {'$addToSet' : {CounterManager.counter_indexes : index}}, upsert=True)
+
     def get_hash_field(self):
-        result = self._collection.find_one({CounterManager.counter_id : CounterManager.counter_hash})
-        return 'HSH' if result is None else result[CounterManager.counter_hash]
+        return self.get_hash_settings()[0]
 
     def get_hash_components(self):
+        return self.get_hash_settings()[1]
+
+    def get_hash_settings(self):
         result = self._collection.find_one({CounterManager.counter_id : CounterManager.counter_hash})
-        return [self._blackboard.document_manager.doc_id] if result is None else result[CounterManager.counter_hash_fields]
+        if result is None:
+            return 'HSH', [self._blackboard.document_manager.doc_id]
+        return result[CounterManager.counter_hash], result[CounterManager.counter_hash_fields]
+
+    def get_tag_version(self):
+        result = self._collection.find_one({CounterManager.counter_id : CounterManager.counter_tag_version})
+        return 0 if result is None else result[CounterManager.counter_tag_version]
+
+    def increment_tag_version(self):
+        result = self._collection.find_one_and_update({CounterManager.counter_id : CounterManager.counter_tag_version},
+            {'$inc' : {CounterManager.counter_tag_version : 1}}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        return result[CounterManager.counter_tag_version]
+
+    def get_partitioning(self):
+        result = self._collection.find_one({CounterManager.counter_id : CounterManager.counter_partitioning})
+        return CounterManager.counter_partitioning_default if result is None else result[CounterManager.counter_partitioning]
+
+    def set_partitioning(self, granularity):
+        if granularity not in partition_key_formats:
+            raise ValueError('Partitioning must be one of {}: {}'.format(list(partition_key_formats), granularity))
+        self._collection.update_one({CounterManager.counter_id : CounterManager.counter_partitioning},
+            {'$set' : {CounterManager.counter_partitioning : granularity}}, upsert=True)
+
+    def get_archives(self):
+        result = self._collection.find_one({CounterManager.counter_id : CounterManager.counter_archives})
+        return {} if result is None else {int(key) : path for key, path in result.get(CounterManager.counter_archives, {}).items()}
+
+    def set_archive(self, key, path):
+        field = '{}.{}'.format(CounterManager.counter_archives, key)
+        update = {'$unset' : {field : ''}} if path is None else {'$set' : {field : path}}
+        self._collection.update_one({CounterManager.counter_id : CounterManager.counter_archives}, update, upsert=True)
+
+    def get_tag_statistics(self):
+        result = self._collection.find_one({CounterManager.counter_id : CounterManager.counter_tag_statistics})
+        if result is None:
+            return None
+        partitions = result[CounterManager.counter_tag_statistics]
+        keys = {name : int(name) if name.isdigit() else None for name in partitions}
+        counts = {keys[name] : Counter({(field, int(tag_id)) : count for field, tags in partition['tags'].items() for tag_id, count in tags.items()})
+            for name, partition in partitions.items()}
+        return TagStatistics(counts, {keys[name] : partition['n'] for name, partition in partitions.items()}, result['updated'])
+
+    def set_tag_statistics(self, statistics):
+        partitions = {'' if key is None else str(key) : {'n' : statistics.totals[key], 'tags' : {}} for key in statistics.counts}
+        for key, counts in statistics.counts.items():
+            for (field, tag_id), count in counts.items():
+                partitions['' if key is None else str(key)]['tags'].setdefault(field, {})[str(tag_id)] = count
+        self._collection.update_one({CounterManager.counter_id : CounterManager.counter_tag_statistics},
+            {'$set' : {CounterManager.counter_tag_statistics : partitions, 'updated' : statistics.updated}}, upsert=True)
+
+    def get_rollups(self):
+        result = self._collection.find_one({CounterManager.counter_id : CounterManager.counter_rollups})
+        return False if result is None else bool(result[CounterManager.counter_rollups])
+
+    def set_rollups(self, enabled):
+        self._collection.update_one({CounterManager.counter_id : CounterManager.counter_rollups},
+            {'$set' : {CounterManager.counter_rollups : enabled}}, upsert=True)
 
     def _increment_next_id(self, current_id, field):
         next_id = {"$set" : {field : int(current_id+1)}}
@@ -79,24 +177,41 @@ class TagManager(BaseManager):
     tag_control = 'Ctrl'
     tag_inherit = 'DInh'
     control_tags = ['FOR>', 'POST>']
+    version_reload = 1.0
 
     def __init__(self, blackboard):
         suffix = TagManager.tag_suffix
         super().__init__(blackboard, suffix)
+        self._version = (None, 0.0)
+
+    @property
+    def version(self):
+        # Tag changes bump the version in the counter collection, so changes made by other processes are seen too,
+        # within version_reload seconds (the version is read again at most that often)
+        version, read = self._version
+        if version is None or time.monotonic() - read >= TagManager.version_reload:
+            self._version = (self._blackboard.counter_manager.get_tag_version(), time.monotonic())
+        return self._version[0]
 
     def insert_tag(self, tag_name, inheritable=False):
         tag = {TagManager.tag_id : self._blackboard.counter_manager.get_next_id_and_increment(self._blackboard.counter_manager.counter_tag)}
         self._annotate_tag(tag, tag_name, inheritable)
-        return self._collection.insert(tag)
+        response = self._collection.insert(tag)
+        self._changed()
+        return response
 
     def update_tag(self, tag_id, tag_name, inheritable=None):
         tag = self.get_tag(tag_id)
         self._annotate_tag(tag, tag_name, inheritable)
-        return self._collection.update({self.tag_id : tag_id}, {"$set" : tag})
+        response = self._collection.update({self.tag_id : tag_id}, {"$set" : tag})
+        self._changed()
+        return response
 
     def delete_tag(self, tag_id):
         self._remove_tag_from_all(tag_id)
-        return self._collection.remove({self.tag_id : tag_id})
+        response = self._collection.remove({self.tag_id : tag_id})
+        self._changed()
+        return response
 
     def get_tag(self, tag_id=None, tag_name=None):
         return self._collection.find_one({self.tag_id : tag_id}) if tag_id is not None else self._collection.find_one({self.tag_name : tag_name})
@@ -104,6 +219,15 @@ class TagManager(BaseManager):
     def get_all_tags(self):
         return self._collection.find()
 
+    def get_inheritable_tags(self):
+        return {tag[self.tag_id] : tag.get(self.tag_name) for tag in self._collection.find({self.tag_inherit : {'$in' : [1, True]}}, {self.tag_name : 1})}
+
+    def get_control_tags(self):
+        return {tag[self.tag_id] : tag.get(self.tag_name) for tag in self._collection.find({self.tag_control : {'$in' : [1, True]}}, {self.tag_name : 1})}
+
+    def get_tag_names(self):
+        return {tag[self.tag_id] : tag.get(self.tag_name) for tag in self._collection.find({}, {self.tag_name : 1})}
+
     def is_control_tag(self, tag_id=None, tag_name=None):
         return self._tag_has_property(self.tag_control, tag_id, tag_name)
 
@@ -128,6 +252,9 @@ class TagManager(BaseManager):
         test = tag[tag_property] if (tag is not None and tag_property in tag) else False
         return bool(test)
 
+    def _changed(self):
+        self._version = (self._blackboard.counter_manager.increment_tag_version(), time.monotonic())
+
     def _remove_tag_from_all(self, tag_id):
         for doc in self._blackboard.find(tags=[tag_id]):
             self._blackboard.remove_tag(doc[self._blackboard.document_manager.doc_id], tag_id)
@@ -138,28 +265,149 @@ class TagManager(BaseManager):
         tag[self.tag_control] = 1 if any(map(tag_name.startswith, self.control_tags)) else 0
         return tag
 
+class RollupManager(BaseManager):
+
+    rollup_suffix = '_ROLLUPS'
+    rollup_id = '_id'
+    rollup_count = 'n'
+    enabled_reload = 1.0
+
+    def __init__(self, blackboard):
+        super().__init__(blackboard, RollupManager.rollup_suffix)
+        self._enabled = (None, 0.0)
+
+    @property
+    def enabled(self):
+        # Like the tag version, the flag is read again at most every enabled_reload seconds,
+        # so blackboards loaded before the rollups were enabled (or disabled) elsewhere start (or stop) recording them
+        enabled, read = self._enabled
+        if enabled is None or time.monotonic() - read >= RollupManager.enabled_reload:
+            self._enabled = (self._blackboard.counter_manager.get_rollups(), time.monotonic())
+        return self._enabled[0]
+
+    def set_enabled(self, enabled):
+        self._blackboard.counter_manager.set_rollups(enabled)
+        self._enabled = (enabled, time.monotonic())
+        if not enabled:
+            self._collection.drop()
+
+    def count(self, tags=None, min_date=None, max_date=None, by_day=False):
+        if not self.enabled:
+            raise ValueError('Rollups are not enabled for the blackboard {}'.format(self._blackboard._name))
+        paths = [self._get_tag_path(tag) for tag in tags or []]
+        bounds = {operation : _get_day(dtparser.parse(str(dates[0])), operation == '$lt') for operation, dates in [('$gte', min_date), ('$lt', max_date)] if dates}
+        days = OrderedDict()
+        for doc in self._collection.find({RollupManager.rollup_id : bounds} if bounds else {}).sort(RollupManager.rollup_id, pymongo.ASCENDING):
+            days[doc[RollupManager.rollup_id]] = doc.get(RollupManager.rollup_count, 0) if tags is None else \
+                {tag : doc.get(field, {}).get(tag_id, 0) for tag, (field, tag_id) in zip(tags, paths)}
+        if by_day:
+            return days
+        return sum(days.values()) if tags is None else {tag : sum(counts[tag] for counts in days.values()) for tag in tags}
+
+    def record(self, changes):
+        if not self.enabled:
+            return
+        increments = OrderedDict()
+        for before, after in changes:
+            for doc, sign in [(before, -1), (after, 1)]:
+                if doc is None:
+                    continue
+                counts = increments.setdefault(_get_day(self._blackboard.document_manager.get_date(doc)), Counter())
+                counts[RollupManager.rollup_count] += sign
+                counts.update({'{}.{}'.format(field, tag_id) : sign for field, tag_id in self._get_tags(doc)})
+        requests = [pymongo.UpdateOne({RollupManager.rollup_id : day}, {'$inc' : {path : n for path, n in counts.items() if n}}, upsert=True)
+            for day, counts in increments.items() if any(counts.values())]
+        if requests:
+            self._collection.bulk_write(requests, ordered=False)
+
+    def changes_tags(self, update):
+        return self.enabled and any(field in self._get_fields() for values in update.values() for field in values)
+
+    def apply_updates(self, doc, updates):
+        doc_m = self._blackboard.document_manager
+        tags = {field : set(listify(doc.get(field, []))) for field in self._get_fields()}
+        for update in updates:
+            for operation, values in update.items():
+                for field, value in ((field, value) for field, value in values.items() if field in tags):
+                    items = value['$each'] if isinstance(value, dict) and '$each' in value else value['$in'] if isinstance(value, dict) and '$in' in value else listify(value)
+                    if operation in ['$addToSet', '$push']:
+                        tags[field].update(items)
+                    elif operation in ['$pull', '$pullAll']:
+                        tags[field].difference_update(items)
+                    elif operation in ['$set', '$unset']:
+                        tags[field] = set(items) if operation == '$set' else set()
+        return dict({field : sorted(values) for field, values in tags.items()}, **{doc_m.doc_id : doc[doc_m.doc_id]})
+
+    def rebuild(self, verify=False):
+        doc_m = self._blackboard.document_manager
+        projection = {field : 1 for field in self._get_fields()}
+        def count(source):
+            rollups = {}
+            for doc in source.find({}, projection):
+                day = rollups.setdefault(_get_day(doc_m.get_date(doc)), Counter())
+                day.update([RollupManager.rollup_count] + ['{}.{}'.format(field, tag_id) for field, tag_id in self._get_tags(doc)])
+            return rollups
+        expected = {}
+        for rollups in run_concurrently(count, doc_m._get_sources()):
+            for day, counts in rollups.items():
+                expected.setdefault(day, Counter()).update(counts)
+        stored = {doc[RollupManager.rollup_id] : _flatten_counts(doc) for doc in self._collection.find()}
+        mismatched = sorted(day for day in set(expected) | set(stored) if expected.get(day, Counter()) != stored.get(day, Counter()))
+        if not verify:
+            requests = [pymongo.ReplaceOne({RollupManager.rollup_id : day}, _nest_counts(expected[day]), upsert=True) if day in expected
+                else pymongo.DeleteOne({RollupManager.rollup_id : day}) for day in mismatched]
+            if requests:
+                self._collection.bulk_write(requests, ordered=False)
+        return mismatched
+
+    def _get_fields(self):
+        return [self._blackboard.document_manager.doc_tags, self._blackboard.document_manager.doc_control_tags]
+
+    def _get_tags(self, doc):
+        return set((field, tag_id) for field in self._get_fields() for tag_id in listify(doc.get(field, [])))
+
+    def _get_tag_path(self, tag):
+        tag_m = self._blackboard.tag_manager
+        full_tag = tag_m.get_canonical_tag(tag)
+        field = self._get_fields()[1] if full_tag.get(tag_m.tag_control) else self._get_fields()[0]
+        return (field, str(full_tag[tag_m.tag_id]))
+
 class DocumentManager(BaseManager):
 
     doc_id = '_id'
     doc_tags = 'Tg'
     doc_control_tags = 'FOR'
+    doc_tags_changed = 'TgC'
+    statistics_reload = timedelta(minutes=10)
+    statistics_max_age = timedelta(days=1)
+    selective_fraction = 0.1
 
     def __init__(self, blackboard):
         super().__init__(blackboard, '')
         self.array_fields = [self.doc_tags, self.doc_control_tags]
+        self._statistics = (None, None)
+        self._cache = None
         self._ensure_indexes(self._collection)
         
     def find(self, **kwargs):
-        query = kwargs.get('query', self._query_builder.build_document_query(**kwargs))
-        sort = [(self.doc_id, kwargs.pop('sort', pymongo.DESCENDING))]
+        raw = kwargs.pop('raw', False)
+        hint = self._get_hint(kwargs.pop('hint', None))
+        projection = self._get_projection(kwargs.pop('projection', None))
+        query, _, planned_hint = self._plan_query([None], **kwargs)
+        hint = hint or planned_hint
+        sort = self._get_sort(kwargs.pop('sort', pymongo.DESCENDING))
         max_docs = kwargs.pop('max', 0)
-        return (self._collection.find(query).sort(sort).limit(max_docs), max_docs)
+        return (self._open_cursor(self._read_collection(self._collection, raw), query, sort, max_docs, hint, projection), max_docs,
+            self._get_reopen(query, sort, max_docs, hint, projection))
 
     def count(self, **kwargs):
-        query = kwargs.get('query', self._query_builder.build_document_query(**kwargs))
-        return self._collection.find(query).count()
+        hint = self._get_hint(kwargs.pop('hint', None))
+        query, _, planned_hint = self._plan_query([None], **kwargs)
+        return self._open_cursor(self._collection, query, None, 0, hint or planned_hint).count()
 
     def insert(self, doc):
+        if isinstance(doc, RawBSONDocument):
+            return self._insert_raw(doc)
         doc[self.doc_id] = self._get_or_generate_id(doc)
         self._ensure_array_fields(doc)
         exists, ident = self._doc_exists_and_id(doc)
@@ -167,33 +415,448 @@ class DocumentManager(BaseManager):
             return self.update(ident, doc)
         else:
             doc[self._blackboard.counter_manager.get_hash_field()] = self._get_or_generate_hash(doc)
-            return self._collection.insert(doc)
+            doc.update(self._query_builder.build_tags_changed_fields(listify(doc[self.doc_tags]) + listify(doc[self.doc_control_tags])))
+            response = self._collection.insert(doc)
+            self._blackboard.rollup_manager.record([(None, doc)])
+            return response
 
     def update(self, doc_id, updated_fields):
         update = self._query_builder.build_document_update(doc_id, updated_fields)
-        response = self._collection.update({self.doc_id : doc_id}, update)
-        return doc_id if response['updatedExisting'] else None
+        return self._update_tracked(doc_id, update)
 
     def delete(self, doc_id):
-        return self._collection.remove({self.doc_id : doc_id})
+        colls = self._get_doc_collections(doc_id)
+        if self._blackboard.rollup_manager.enabled:
+            # The deletes return the documents they removed, so the change recorded is exactly the one made
+            before = [doc for doc in (coll.find_one_and_delete({self.doc_id : doc_id}, self._get_rollup_projection()) for coll in colls) if doc is not None]
+            responses = [{'n' : len(before), 'ok' : 1.0}]
+        else:
+            before, responses = [], [coll.remove({self.doc_id : doc_id}) for coll in colls]
+        self._evict([doc_id])
+        self._blackboard.rollup_manager.record([(self._get_rollup_doc(doc), None) for doc in before])
+        return responses[0] if len(responses) == 1 else {'n' : sum(response['n'] for response in responses), 'ok' : 1.0}
 
     def update_document_tags(self, ids, operations):
         doc_id, tag_id = ids
         update = self._get_document_tag_update(tag_id, operations)
-        response = self._collection.update({self.doc_id : doc_id}, update)
-        return doc_id if response['updatedExisting'] else None
+        return self._update_tracked(doc_id, update)
+
+    def bulk_update(self, updates):
+        requests, tracked = {}, OrderedDict()
+        rollup_m = self._blackboard.rollup_manager
+        routes = self._route_docs([doc_id for doc_id, _ in updates])
+        for doc_id, update in updates:
+            coll = routes[doc_id]
+            requests.setdefault(coll.name, (coll, [], []))
+            requests[coll.name][1].append(pymongo.UpdateOne({self.doc_id : doc_id}, update))
+            requests[coll.name][2].append((doc_id, update))
+            if rollup_m.changes_tags(update):
+                tracked.setdefault(doc_id, (coll, []))
+        before = {doc[self.doc_id] : doc for coll, ids in self._group_by_collection(tracked) for doc in self._find_rollup_docs([coll], {self.doc_id : {'$in' : ids}})}
+        response = {'matched' : 0, 'modified' : 0, 'errors' : []}
+        for coll, operations, sent in requests.values():
+            result = self._bulk_write(coll, operations)
+            for key in response:
+                response[key] += result[key]
+            # Only the updates which were applied are recorded in the rollups
+            failed = set(error['index'] for error in result['errors'])
+            for index, (doc_id, update) in enumerate(sent):
+                if doc_id in tracked and index not in failed:
+                    tracked[doc_id][1].append(update)
+        self._evict([doc_id for doc_id, _ in updates])
+        rollup_m.record([(doc, rollup_m.apply_updates(doc, tracked[doc_id][1])) for doc_id, doc in before.items() if tracked[doc_id][1]])
+        return response
+
+    def count_tags(self, control=False, **kwargs):
+        field = self.doc_control_tags if control else self.doc_tags
+        pipeline = [{'$match' : self._build_query(**kwargs)}, {'$project' : {field : 1}}, {'$unwind' : '$' + field},
+            {'$group' : {'_id' : '$' + field, 'n' : {'$sum' : 1}}}]
+        counts = Counter()
+        for results in run_concurrently(lambda coll: list(coll.aggregate(pipeline)), self._get_collections(**kwargs)):
+            counts.update({result['_id'] : result['n'] for result in results})
+        return dict(counts)
+
+    def estimate_count(self, sample_size=1000, z=1.96, **kwargs):
+        bounds = self._query_builder.build_id_bounds(**kwargs)
+        filters = {key : value for key, value in kwargs.items() if key not in ['min_date', 'max_date', 'after_id', 'before_id']}
+        query = filters.get('query', self._query_builder.build_document_query(**filters))
+        estimates = run_concurrently(lambda key: self._estimate_partition_count(key, bounds, query, sample_size, z), self._get_partition_keys(**kwargs))
+        return CountEstimate(*[sum(x) for x in zip(CountEstimate(0, 0, 0, 0), *estimates)])
+
+    def sample(self, n, seed=None, **kwargs):
+        query = self._build_query(**kwargs)
+        keys = self._get_partition_keys(**kwargs)
+        counts = run_concurrently(lambda key: self._get_partition_collection(key).find(query).count(), keys)
+        sizes = allocate_sample(n, counts)
+        samples = run_concurrently(lambda key_size: self._sample_partition(key_size[0], query, key_size[1], seed), list(zip(keys, sizes)))
+        return [doc for docs in samples for doc in docs]
+
+    def update_where(self, update, **kwargs):
+        operators = [key for key in update if key.startswith('$')]
+        if operators and len(operators) != len(update):
+            raise ValueError('Update cannot mix operators and fields: {}'.format(list(update)))
+        if not operators:
+            update = self._query_builder.build_document_update(None, dict(update))
+        query = self._build_query(**kwargs)
+        colls = self._get_collections(**kwargs)
+        rollup_m = self._blackboard.rollup_manager
+        before = self._find_rollup_docs(colls, query) if rollup_m.changes_tags(update) else []
+        response = {'matched' : 0, 'modified' : 0}
+        for result in run_concurrently(lambda coll: coll.update_many(query, update), colls):
+            response['matched'] += result.matched_count
+            response['modified'] += result.modified_count
+        self._evict(None)
+        rollup_m.record([(doc, rollup_m.apply_updates(doc, [update])) for doc in before])
+        return response
+
+    def delete_where(self, delete_all=False, **kwargs):
+        query = self._build_query(**kwargs)
+        if not query and not delete_all:
+            raise ValueError('Deleting without filters deletes every document, which requires delete_all=True')
+        colls = self._get_collections(**kwargs)
+        before = self._find_rollup_docs(colls, query)
+        results = run_concurrently(lambda coll: coll.delete_many(query), colls)
+        self._evict(None)
+        self._blackboard.rollup_manager.record([(doc, None) for doc in before])
+        return {'deleted' : sum(result.deleted_count for result in results)}
+
+    def get_many(self, ids, projection=None):
+        if self._cache is None:
+            return self._fetch_many(ids, projection)
+        cached = OrderedDict((doc_id, self._cache.get(doc_id)) for doc_id in OrderedDict.fromkeys(ids))
+        fetched, _ = self._fetch_many([doc_id for doc_id, doc in cached.items() if doc is None])
+        for doc in fetched:
+            cached[doc[self.doc_id]] = doc
+            self._cache.put(doc[self.doc_id], doc)
+        found = {doc_id : deepcopy(project(doc, projection)) for doc_id, doc in cached.items() if doc is not None}
+        return [found[doc_id] for doc_id in ids if doc_id in found], [doc_id for doc_id in ids if doc_id not in found]
+
+    def set_cache(self, cache):
+        self._cache = cache
+
+    def _fetch_many(self, ids, projection=None):
+        groups = OrderedDict()
+        for doc_id in ids:
+            try:
+                sources = self._get_doc_sources(doc_id)
+            except (KeyError, ValueError):
+                continue
+            for source in sources:
+                groups.setdefault(id(source), (source, []))[1].append(doc_id)
+        if isinstance(projection, dict):
+            projection = dict(projection, **{self.doc_id : 1})
+        found = {}
+        for docs in run_concurrently(lambda group: list(group[0].find({self.doc_id : {'$in' : group[1]}}, projection)), list(groups.values())):
+            found.update((doc[self.doc_id], doc) for doc in docs if doc[self.doc_id] not in found)
+        return [found[doc_id] for doc_id in ids if doc_id in found], [doc_id for doc_id in ids if doc_id not in found]
+
+    def get_hashes(self, docs):
+        settings = self._blackboard.counter_manager.get_hash_settings()
+        return [self._get_or_generate_hash(doc, settings) for doc in docs]
+
+    def find_hashes(self, hashes):
+        hash_field = self._blackboard.counter_manager.get_hash_field()
+        query = {hash_field : {'$in' : list(OrderedDict.fromkeys(hashes))}}
+        existing = {}
+        for results in run_concurrently(lambda coll: list(coll.find(query, {hash_field : 1})), self._get_collections()):
+            existing.update((doc[hash_field], doc[self.doc_id]) for doc in results if doc[hash_field] not in existing)
+        return existing
+
+    def find_field(self, field, batch_size=1000, **kwargs):
+        query = self._build_query(**kwargs)
+        return [coll.find(query, {field : 1, self.doc_id : 0}).batch_size(batch_size) for coll in self._get_collections(**kwargs)]
+
+    def refresh_tag_statistics(self, max_age=None):
+        current = self._blackboard.counter_manager.get_tag_statistics()
+        if current is not None and max_age is not None and not _is_older(current, max_age):
+            self._statistics = (datetime.utcnow(), current)
+            return current
+        pipelines = [(field, [{'$project' : {field : 1}}, {'$unwind' : '$' + field}, {'$group' : {'_id' : '$' + field, 'n' : {'$sum' : 1}}}])
+            for field in [self.doc_tags, self.doc_control_tags]]
+        def count(key):
+            coll = self._get_partition_collection(key)
+            counts = Counter({(field, result['_id']) : result['n'] for field, pipeline in pipelines for result in coll.aggregate(pipeline) if isinstance(result['_id'], int)})
+            return (counts, coll.estimated_document_count())
+        keys = self._get_partition_keys()
+        results = run_concurrently(count, keys)
+        statistics = TagStatistics({key : counts for key, (counts, _) in zip(keys, results)}, {key : total for key, (_, total) in zip(keys, results)},
+            datetime.utcnow().replace(microsecond=0))
+        self._blackboard.counter_manager.set_tag_statistics(statistics)
+        self._statistics = (datetime.utcnow(), statistics)
+        return statistics
+
+    def get_tag_statistics(self, reload=False):
+        loaded, statistics = self._statistics
+        if reload or loaded is None or datetime.utcnow() - loaded > DocumentManager.statistics_reload:
+            statistics = self._blackboard.counter_manager.get_tag_statistics()
+            self._statistics = (datetime.utcnow(), statistics)
+            # Statistics which have been counted once are recounted when they get older than statistics_max_age
+            # (unless it is None); the stored age is checked again first, in case another process has just recounted them
+            max_age = DocumentManager.statistics_max_age
+            if statistics is not None and max_age is not None and _is_older(statistics, max_age):
+                statistics = self.refresh_tag_statistics(max_age)
+        return statistics
+
+    def get_changes_updates(self, doc_id, changes):
+        updates = []
+        if changes.get('fields'):
+            updates.append(self._query_builder.build_document_update(doc_id, dict(changes['fields'])))
+        for key, operation in [('add_tags', '$addToSet'), ('remove_tags', '$pullAll')]:
+            if changes.get(key):
+                updates.append(self._query_builder.build_tags_update_query(listify(changes[key]), operation))
+        return self._query_builder.merge_updates(updates)
+
+    def get_partitions(self, count=1, interval=None, **kwargs):
+        keys = self._get_partition_keys(**kwargs)
+        splits = -(-count // len(keys)) if keys else 1
+        return [Partition(key, lower, upper) for key in keys for lower, upper in \
+            (self._split_partition_by_interval(key, interval) if interval else self._split_partition(key, splits))]
+
+    def find_partition(self, partition, projection=None, **kwargs):
+        bounds = {operation : bound for operation, bound in [('$gte', partition.lower), ('$lt', partition.upper)] if bound is not None}
+        query = self._build_query(**kwargs)
+        query = {'$and' : [query, {self.doc_id : bounds}]} if bounds else query
+        return self._get_partition_collection(partition.key).find(query, projection).sort(self.doc_id, pymongo.ASCENDING)
+
+    def _build_query(self, **kwargs):
+        query = kwargs.get('query', self._query_builder.build_document_query(**kwargs))
+        return self._query_builder.build_keyset_query(query, **kwargs)
+
+    def _plan_query(self, keys, **kwargs):
+        '''Build the query with its required tags ordered from the rarest, and get the partitions which cannot match
+        (those which have no documents with one of the required tags) and an index hint for rare tags, from the tag statistics.'''
+        query = kwargs.get('query', self._query_builder.build_document_query(**kwargs))
+        required = self._query_builder.get_required_tags(query, [self.doc_tags, self.doc_control_tags])
+        statistics = self.get_tag_statistics() if required else None
+        if statistics is None:
+            return (self._query_builder.build_keyset_query(query, **kwargs), set(), None)
+        known = [key for key in keys if key in statistics.counts]
+        def count(field, tag_id):
+            return sum(statistics.counts[key][(field, tag_id)] for key in known)
+        query = self._query_builder.order_tags(query, count)
+        skipped = set(key for key in known if any(statistics.counts[key][tag] == 0 and self._is_tag_absent(key, *tag) for tag in required))
+        total = sum(statistics.totals[key] for key in known if key not in skipped)
+        rarest = min(required, key=lambda tag: count(*tag))
+        hint = self._get_field_hint(rarest[0]) if known and count(*rarest) <= total * DocumentManager.selective_fraction else None
+        return (self._query_builder.build_keyset_query(query, **kwargs), skipped, hint)
+
+    def _is_tag_absent(self, key, field, tag_id):
+        # The statistics may be out of date, so check with the index before skipping a partition
+        try:
+            coll = self._get_partition_collection(key)
+        except KeyError:
+            return False
+        return next(iter(coll.find({field : tag_id}, {self.doc_id : 1}).limit(1)), None) is None
+
+    def _get_field_hint(self, field):
+        indexes = [list(index.items()) for index in self._blackboard.counter_manager.get_required_indexes()]
+        candidates = [index for index in indexes if index[0][0] == field]
+        candidates.sort(key=lambda index: (len(index) < 2 or index[1][0] != self.doc_id, len(index)))
+        return candidates[0] if candidates else None
+
+    def _get_collections(self, **kwargs):
+        return [self._collection]
+
+    def _get_doc_collection(self, doc_id):
+        return self._collection
+
+    def _get_doc_collections(self, doc_id):
+        return [self._get_doc_collection(doc_id)]
+
+    def _get_doc_sources(self, doc_id):
+        return [self._get_doc_collection(doc_id)]
+
+    def _get_partition_keys(self, **kwargs):
+        return [None]
+
+    def _get_partition_collection(self, key):
+        return self._collection
+
+    def _split_partition(self, key, splits):
+        coll = self._get_partition_collection(key)
+        ends = [doc[self.doc_id] for order in [pymongo.ASCENDING, pymongo.DESCENDING] \
+            for doc in coll.find({}, {self.doc_id : 1}).sort(self.doc_id, order).limit(1)] if splits > 1 else []
+        edges = [None] + (split_id_range(ends[0], ends[1], splits) if len(ends) == 2 else []) + [None]
+        return list(zip(edges[:-1], edges[1:]))
+
+    def _split_partition_by_interval(self, key, interval):
+        return [(None, None)]
+
+    def _get_partition_id_range(self, key):
+        return (None, None)
+
+    def _sample_partition(self, key, query, size, seed):
+        coll = self._get_partition_collection(key)
+        if size == 0:
+            return []
+        if seed is None:
+            return list(coll.aggregate([{'$match' : query}, {'$sample' : {'size' : size}}]))
+        ids = sorted(doc[self.doc_id] for doc in coll.find(query, {self.doc_id : 1}))
+        chosen = random.Random('{}:{}'.format(seed, key)).sample(ids, min(size, len(ids)))
+        docs = {doc[self.doc_id] : doc for doc in coll.find({self.doc_id : {'$in' : chosen}})}
+        return [docs[doc_id] for doc_id in chosen if doc_id in docs]
+
+    def _estimate_partition_count(self, key, bounds, query, sample_size, z):
+        coll = self._get_partition_collection(key)
+        id_query = {self.doc_id : bounds} if bounds else {}
+        population = coll.estimated_document_count() if self._covers_partition(key, bounds) else coll.find(id_query).count()
+        if not query:
+            return CountEstimate(population, population, population, 0)
+        if population <= sample_size:
+            count = coll.find({'$and' : [id_query, query]}).count()
+            return CountEstimate(count, count, count, population)
+        # $sample only picks documents at random without a scan when it is the first stage, so a range which
+        # covers part of the collection is matched (on the id index) before sampling, while a whole collection is not
+        sample = [{'$sample' : {'size' : sample_size}}] if self._covers_partition(key, bounds) else [{'$match' : id_query}, {'$sample' : {'size' : sample_size}}]
+        pipeline = sample + [{'$match' : query}, {'$group' : {'_id' : None, 'n' : {'$sum' : 1}}}]
+        matched = sum(result['n'] for result in coll.aggregate(pipeline)) if sample_size > 0 else 0
+        lower, upper = wilson_interval(matched, sample_size, z)
+        return CountEstimate(int(round(population * matched / sample_size)) if sample_size else 0, int(math.floor(population * lower)), int(math.ceil(population * upper)), sample_size)
+
+    def _covers_partition(self, key, bounds):
+        start, end = self._get_partition_id_range(key)
+        if start is None:
+            return not bounds
+        lower = all(bound <= start if operation == '$gte' else bound < start for operation, bound in bounds.items() if operation in ['$gte', '$gt'])
+        return lower and all(bound >= end for operation, bound in bounds.items() if operation == '$lt')
+
+    def _bulk_write(self, coll, requests):
+        try:
+            result = coll.bulk_write(requests, ordered=False).bulk_api_result
+        except BulkWriteError as error:
+            result = error.details
+        return {'matched' : result.get('nMatched', 0), 'modified' : result.get('nModified', 0), 'errors' : result.get('writeErrors', [])}
+
+    def _read_collection(self, coll, raw):
+        return coll.with_options(codec_options=raw_codec_options) if raw else coll
+
+    def _insert_raw(self, doc):
+        hash_field = self._blackboard.counter_manager.get_hash_field()
+        if not {self.doc_id, hash_field}.issubset(scan_raw(doc)):
+            return self.insert(dict(doc))
+        doc_id = split_raw(doc, [self.doc_id])[0][self.doc_id]
+        coll = self._get_doc_collection(doc_id)
+        before = coll.find_one_and_replace({self.doc_id : doc_id}, doc, self._get_rollup_projection(), upsert=True)
+        self._evict([doc_id])
+        self._blackboard.rollup_manager.record([(self._get_rollup_doc(before) if before is not None else None, doc)])
+        return doc_id
+
+    def _route_docs(self, doc_ids):
+        # Like _update_routed, each document goes to the first of its partitions holding it, but the documents are
+        # only looked up (a query per collection) when they can be in several, i.e. while a partition is repartitioned
+        candidates = OrderedDict((doc_id, self._get_doc_collections(doc_id) or [self._get_doc_collection(doc_id)]) for doc_id in doc_ids)
+        routes = {doc_id : colls[0] for doc_id, colls in candidates.items()}
+        lookups = OrderedDict()
+        for doc_id, colls in candidates.items():
+            for coll in (colls if len(colls) > 1 else []):
+                lookups.setdefault(coll.name, (coll, []))[1].append(doc_id)
+        found = set((coll.name, doc[self.doc_id]) for coll, ids in lookups.values() for doc in coll.find({self.doc_id : {'$in' : ids}}, {self.doc_id : 1}))
+        for doc_id, colls in candidates.items():
+            if len(colls) > 1:
+                routes[doc_id] = next((coll for coll in colls if (coll.name, doc_id) in found), colls[0])
+        return routes
+
+    def _update_routed(self, doc_id, update):
+        for coll in self._get_doc_collections(doc_id):
+            if coll.update({self.doc_id : doc_id}, update)['updatedExisting']:
+                return doc_id
+        return None
+
+    def _update_tracked(self, doc_id, update):
+        rollup_m = self._blackboard.rollup_manager
+        if not rollup_m.changes_tags(update):
+            updated = self._update_routed(doc_id, update)
+            self._evict([doc_id])
+            return updated
+        # The update returns the tags it replaced, so concurrent writers cannot record the same change twice
+        for coll in self._get_doc_collections(doc_id):
+            before = coll.find_one_and_update({self.doc_id : doc_id}, update, self._get_rollup_projection(), return_document=pymongo.ReturnDocument.BEFORE)
+            if before is not None:
+                self._evict([doc_id])
+                before = self._get_rollup_doc(before)
+                rollup_m.record([(before, rollup_m.apply_updates(before, [update]))])
+                return doc_id
+        self._evict([doc_id])
+        return None
+
+    def _evict(self, doc_ids):
+        # Cached documents changed by a write are dropped (all of them when **doc_ids** is None), to be read again
+        if self._cache is None:
+            return
+        if doc_ids is None:
+            self._cache.clear()
+        for doc_id in doc_ids or []:
+            self._cache.pop(doc_id)
+
+    def _find_rollup_docs(self, colls, query):
+        # Read the tags of the documents a write changes, so that it can be recorded in the rollups
+        if not self._blackboard.rollup_manager.enabled:
+            return []
+        return [self._get_rollup_doc(doc) for coll in colls for doc in coll.find(query, self._get_rollup_projection())]
+
+    def _get_rollup_projection(self):
+        return {self.doc_tags : 1, self.doc_control_tags : 1}
+
+    def _get_rollup_doc(self, doc):
+        # Copies the tag lists, which some clients share with the stored document
+        fields = [self.doc_tags, self.doc_control_tags]
+        return dict({field : list(listify(doc.get(field, []))) for field in fields}, **{self.doc_id : doc[self.doc_id]})
+
+    def _group_by_collection(self, tracked):
+        groups = OrderedDict()
+        for doc_id, (coll, _) in tracked.items():
+            groups.setdefault(id(coll), (coll, []))[1].append(doc_id)
+        return list(groups.values())
+
+    def _reopen_cursor(self, query, sort, max_docs, hint, projection, cursor, last_id):
+        bound = 'after_id' if sort[0][1] == pymongo.ASCENDING else 'before_id'
+        query = self._query_builder.build_keyset_query(query, **{bound : last_id})
+        sources = [x.collection for x in cursor.cursors] if isinstance(cursor, MergedCursor) else [cursor.collection]
+        return self._open_cursors(sources, query, sort, max_docs, hint, projection)
+
+    def _open_cursors(self, sources, query, sort, max_docs, hint, projection=None):
+        cursors = [self._open_cursor(source, query, sort, max_docs, hint, projection) for source in sources]
+        return cursors[0] if len(cursors) == 1 else MergedCursor(cursors, sort[0][1])
+
+    def _open_cursor(self, source, query, sort, max_docs, hint, projection=None):
+        cursor = source.find(query, projection)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        if hint is not None:
+            cursor = cursor.hint(hint)
+        return cursor.limit(max_docs)
+
+    def _get_reopen(self, query, sort, max_docs, hint, projection=None):
+        # Unsorted scans cannot be resumed from the last id retrieved
+        return partial(self._reopen_cursor, query, sort, max_docs, hint, projection) if sort is not None else None
+
+    def _get_projection(self, projection):
+        # The id is always returned, as cursors are resumed and merged by id
+        if projection is None:
+            return None
+        return dict(projection, **{self.doc_id : 1}) if isinstance(projection, dict) else list(projection)
+
+    def _get_sort(self, order):
+        return [(self.doc_id, order)] if order is not None else None
+
+    def _get_hint(self, hint):
+        if hint is None:
+            return None
+        keys = list(hint.items()) if isinstance(hint, dict) else [tuple(key) for key in hint]
+        if keys not in [list(index.items()) for index in self._blackboard.counter_manager.get_required_indexes()]:
+            raise ValueError('Hint is not one of the indexes declared for the blackboard: {}'.format(hint))
+        return keys
 
     def _doc_exists_and_id(self, doc):
         hsh = self._get_or_generate_hash(doc)
         results = [x for x in self._collection.find({self._blackboard.counter_manager.get_hash_field() : hsh})]
         return (True, results[0][self.doc_id]) if results else (False, None)
 
-    def _get_or_generate_hash(self, doc):
+    def _get_or_generate_hash(self, doc, settings=None):
         from macsy import utils
-        hash_field = self._blackboard.counter_manager.get_hash_field()
+        hash_field, components = settings or self._blackboard.counter_manager.get_hash_settings()
         if hash_field in doc:
             return doc[hash_field]
-        components = self._blackboard.counter_manager.get_hash_components()
         hsh = utils.java_string_hashcode("".join([str(doc[x]) for x in components if x in doc]))
         return hsh
 
@@ -208,6 +871,13 @@ class DocumentManager(BaseManager):
         return self._query_builder.build_tags_update_query(tag_id, operations[0]) if isinstance(tag_id, list) else \
             self._query_builder.build_tag_update_query(tag_id, operations[1])
 
+    def require_index(self, index):
+        counter_m = self._blackboard.counter_manager
+        if list(index.items()) not in [list(required.items()) for required in counter_m.get_required_indexes()]:
+            counter_m.add_required_index(index)
+        for coll in self._get_collections():
+            self._ensure_indexes(coll)
+
     @suppress_print_if_mocking
     def _ensure_indexes(self, collection):
         required = self._blackboard.counter_manager.get_required_indexes()
@@ -218,8 +888,8 @@ class DocumentManager(BaseManager):
             collection.create_index(index, background=True)
 
     def _find_missing_indexes(self, required, existing):
-        not_required = [index['key'] for index in existing if index['key'] in required]
-        return set(required).difference(not_required)
+        keys = [index['key'] for index in existing.values()]
+        return [list(index.items()) for index in required if list(index.items()) not in keys]
 
 class DateBasedDocumentManager(DocumentManager):
 
@@ -229,54 +899,138 @@ class DateBasedDocumentManager(DocumentManager):
         self.array_fields.extend(['Fds','LOC'])
 
     def _populate_collections(self):
-        colls = ((coll.split('_')[-1], coll) for coll in self._blackboard._db.collection_names() if self._blackboard._name in coll)
-        self._collections = {int(year): self._blackboard._db.get_collection(coll,codec_options=codec_options) for year, coll in colls if year.isdigit()}
-        self._max_year = max(self._collections.keys())
-        self._min_year = min(self._collections.keys())
+        from macsy.catalogs import group_collections
+        from macsy.archives import PartitionArchive
+        # load_blackboard has just re-read the catalog entry of the blackboard, so it has the partitions other clients created
+        info = self._blackboard._api.get_catalog().get(self._blackboard._name) if self._blackboard._api is not None else None
+        if info is not None:
+            colls = [(str(key), coll) for key, coll in info.collections.items()]
+            self._partitioning, archives = info.partitioning, info.archives
+        else:
+            colls = group_collections(self._blackboard._db.list_collection_names()).get(self._blackboard._name, {}).items()
+            self._partitioning = self._blackboard.counter_manager.get_partitioning()
+            archives = self._blackboard.counter_manager.get_archives()
+        self._collections = {int(key): self._blackboard._db.get_collection(coll,codec_options=codec_options) for key, coll in colls if key.isdigit()}
+        self._archives = {key : PartitionArchive(path, codec_options) for key, path in archives.items()}
         for coll in self._collections.values():
             self._ensure_indexes(coll)
 
     def find(self, **kwargs):
-        query = kwargs.get('query', self._query_builder.build_document_query(**kwargs))
-        sort = [(self.doc_id, kwargs.pop('sort', pymongo.DESCENDING))]
+        raw = kwargs.pop('raw', False)
+        hint = self._get_hint(kwargs.pop('hint', None))
+        order = kwargs.pop('sort', pymongo.DESCENDING)
+        sort = self._get_sort(order)
         max_docs = kwargs.pop('max', 0)
-        years = self._parse_year_range(**kwargs)
-        year_range = range(years[0], years[1]+1, pymongo.ASCENDING) if bool(sort[0][1] == pymongo.ASCENDING) else range(years[1], years[0]-1, pymongo.DESCENDING)
-        response = [self._collections[year].find(query).sort(sort).limit(max_docs) for year in year_range]
-        return (response, max_docs)
+        projection = self._get_projection(kwargs.pop('projection', None))
+        query, keyed, planned_hint = self._plan_sources(order, **kwargs)
+        hint = hint or planned_hint
+        if sort is None:
+            response = [self._open_cursor(self._read_collection(source, raw), query, sort, max_docs, hint, projection) for _, source in keyed]
+            response = ParallelCursor(response) if len(response) > 1 else response
+        else:
+            response = [self._open_cursors([self._read_collection(source, raw) for source in sources], query, sort, max_docs, hint, projection)
+                for sources in self._group_overlapping(keyed, order)]
+        return (response, max_docs, self._get_reopen(query, sort, max_docs, hint, projection))
 
     def count(self, **kwargs):
-        query = kwargs.get('query', self._query_builder.build_document_query(**kwargs))
-        min_year, max_year = self._parse_year_range(**kwargs)
-        return sum([self._collections[year].find(query).count() for year in range(max_year, min_year-1, pymongo.DESCENDING)])
+        hint = self._get_hint(kwargs.pop('hint', None))
+        query, keyed, planned_hint = self._plan_sources(pymongo.DESCENDING, **kwargs)
+        return sum([self._open_cursor(source, query, None, 0, hint or planned_hint).count() for _, source in keyed])
 
     def insert(self, doc):
+        if isinstance(doc, RawBSONDocument):
+            return self._insert_raw(doc)
         doc[self.doc_id] = self._get_or_generate_id(doc)
         self._ensure_array_fields(doc)
-        year = self._get_doc_year(doc)
+        key = self._get_doc_key(doc)
         exists, ident = self._doc_exists_and_id(doc)
         if exists:
             return self.update(ident, doc)
         else:
             doc[self._blackboard.counter_manager.get_hash_field()] = self._get_or_generate_hash(doc)
-            return self._collections[year].insert(doc)
+            doc.update(self._query_builder.build_tags_changed_fields(listify(doc[self.doc_tags]) + listify(doc[self.doc_control_tags])))
+            response = self._get_key_collection(key).insert(doc)
+            self._blackboard.rollup_manager.record([(None, doc)])
+            return response
 
-    def update(self, doc_id, updated_fields):
-        update = self._query_builder.build_document_update(doc_id, updated_fields)
-        year = self._get_doc_year({self.doc_id : doc_id})
-        response = self._collections[year].update({self.doc_id : doc_id}, update)
-        return doc_id if response['updatedExisting'] else None
+    def count_by_period(self, interval, **kwargs):
+        periods, results = self._aggregate_periods(interval, None, **kwargs)
+        counts = [0] * len(periods)
+        for result in results:
+            counts[result['_id']['p']] += result['n']
+        return periods, counts
 
-    def delete(self, doc_id):
-        year = self._get_doc_year({self.doc_id : doc_id})
-        return self._collections[year].remove({self.doc_id : doc_id})
+    def count_tags_by_period(self, interval, tag_ids=None, **kwargs):
+        periods, results = self._aggregate_periods(interval, tag_ids or [], **kwargs)
+        counts = {tag_id : [0] * len(periods) for tag_id in tag_ids or []}
+        for result in results:
+            counts.setdefault(result['_id']['t'], [0] * len(periods))[result['_id']['p']] += result['n']
+        return periods, counts
 
-    def update_document_tags(self, ids, operations):
-        doc_id, tag_id = ids
-        year = self._get_doc_year({self.doc_id : doc_id})
-        update = self._get_document_tag_update(tag_id, operations)
-        response = self._collections[year].update({self.doc_id : doc_id}, update)
-        return doc_id if response['updatedExisting'] else None
+    def repartition(self, key, granularity=None, batch_size=1000):
+        granularity = granularity or self._partitioning
+        source = self._collections[key]
+        start, end = partition_range(key)
+        if partition_range(partition_key(start, granularity))[1] - start >= end - start:
+            raise ValueError('{} partitions are not finer than the partition {}'.format(granularity, key))
+        if granularity != self._partitioning:
+            # Otherwise documents for periods of the key without a collection yet would recreate the split collection
+            self._blackboard.counter_manager.set_partitioning(granularity)
+            self._partitioning = granularity
+            self._invalidate_catalog()
+        moved, last_id = 0, None
+        while True:
+            query = {self.doc_id : {'$gt' : last_id}} if last_id is not None else {}
+            docs = list(source.find(query).sort(self.doc_id, pymongo.ASCENDING).limit(batch_size))
+            if not docs:
+                break
+            groups = {}
+            for doc in docs:
+                groups.setdefault(partition_key(self.get_date(doc), granularity), []).append(doc)
+            for target, target_docs in groups.items():
+                requests = [pymongo.ReplaceOne({self.doc_id : doc[self.doc_id]}, doc, upsert=True) for doc in target_docs]
+                self._get_key_collection(target).bulk_write(requests, ordered=False)
+            source.delete_many({self.doc_id : {'$in' : [doc[self.doc_id] for doc in docs]}})
+            moved, last_id = moved + len(docs), docs[-1][self.doc_id]
+        if source.find_one() is None:
+            del self._collections[key]
+            source.drop()
+            self._invalidate_catalog()
+        return moved
+
+    def archive(self, key, path, chunk_size=10000):
+        from macsy.archives import write_archive, remove_archive
+        if key in self._archives:
+            raise ValueError('The partition {} is already archived'.format(key))
+        coll = self._collections[key]
+        archive = write_archive(coll.find().sort(self.doc_id, pymongo.ASCENDING), os.path.abspath(path), coll.name, chunk_size)
+        count = coll.count_documents({})
+        if archive.estimated_document_count() != count:
+            # The archive is removed so the partition can be archived again, to the same path
+            remove_archive(archive.path)
+            raise RuntimeError('{} changed while it was archived ({} documents archived, {} in the collection)'.format(
+                coll.name, archive.estimated_document_count(), count))
+        self._blackboard.counter_manager.set_archive(key, archive.path)
+        self._archives[key] = archive.with_options(codec_options=codec_options)
+        del self._collections[key]
+        coll.drop()
+        self._invalidate_catalog()
+        return count
+
+    def restore(self, key, batch_size=1000):
+        archive = self._archives[key]
+        coll = self._get_key_collection(key)
+        restored, docs = 0, archive.find().sort(self.doc_id, pymongo.ASCENDING)
+        while True:
+            batch = list(islice(docs, batch_size))
+            if not batch:
+                break
+            coll.bulk_write([pymongo.ReplaceOne({self.doc_id : doc[self.doc_id]}, doc, upsert=True) for doc in batch], ordered=False)
+            restored += len(batch)
+        self._blackboard.counter_manager.set_archive(key, None)
+        del self._archives[key]
+        self._invalidate_catalog()
+        return restored
 
     def get_date(self, doc):
         if self.doc_id in doc and isinstance(doc[self.doc_id], ObjectId):
@@ -284,26 +1038,162 @@ class DateBasedDocumentManager(DocumentManager):
         raise ValueError('Document does not have an ObjectId in the {} field'.format(self.doc_id))
 
     def get_earliest_date(self):
-        return self._get_extremal_date(self._min_year, pymongo.ASCENDING)
+        return self._get_extremal_date(pymongo.ASCENDING)
 
     def get_latest_date(self):
-        return self._get_extremal_date(self._max_year, pymongo.DESCENDING)
+        return self._get_extremal_date(pymongo.DESCENDING)
 
     def _doc_exists_and_id(self, doc):
         hsh = self._get_or_generate_hash(doc)
-        results = [x for year in range(self._max_year, self._min_year-1, pymongo.DESCENDING) for x in self._collections[year].find({self._blackboard.counter_manager.get_hash_field() : hsh})]
+        results = [x for key in self._get_sorted_keys(pymongo.DESCENDING) for x in self._collections[key].find({self._blackboard.counter_manager.get_hash_field() : hsh})]
         return (True, results[0][self.doc_id]) if results else (False, None)
 
     def _get_or_generate_id(self, doc):
         return doc[self.doc_id] if self.doc_id in doc else ObjectId.from_datetime(datetime.now())
 
-    def _get_extremal_date(self, year, order):
-        return self.get_date(self._collections[year].find().sort(self.doc_id, order).limit(1)[0])
+    def _get_extremal_date(self, order):
+        ids = [doc[self.doc_id] for source in self._get_sources(sort=order) for doc in source.find().sort(self.doc_id, order).limit(1)]
+        if not ids:
+            raise ValueError('{} does not contain any documents'.format(self._blackboard._name))
+        return self.get_date({self.doc_id : (min if order == pymongo.ASCENDING else max)(ids)})
+
+    def _get_doc_key(self, doc):
+        date = self.get_date(doc)
+        keys = [partition_key(date, granularity) for granularity in partition_key_formats]
+        return next((key for key in keys if key in self._collections), partition_key(date, self._partitioning))
+
+    def _get_doc_collections(self, doc_id):
+        date = self.get_date({self.doc_id : doc_id})
+        keys = [partition_key(date, granularity) for granularity in partition_key_formats]
+        return [self._collections[key] for key in keys if key in self._collections]
+
+    def _get_doc_sources(self, doc_id):
+        date = self.get_date({self.doc_id : doc_id})
+        keys = [partition_key(date, granularity) for granularity in partition_key_formats]
+        return self._get_doc_collections(doc_id) + [self._archives[key] for key in keys if key in self._archives]
+
+    def _get_key_collection(self, key):
+        if key not in self._collections:
+            coll = self._blackboard._db.get_collection('{}_{}'.format(self._blackboard._name, key), codec_options=codec_options)
+            self._ensure_indexes(coll)
+            self._collections[key] = coll
+            self._invalidate_catalog()
+        return self._collections[key]
+
+    def _invalidate_catalog(self):
+        if self._blackboard._api is not None:
+            self._blackboard._api.get_catalog().invalidate(self._blackboard._name)
+
+    def _aggregate_periods(self, interval, tag_ids, **kwargs):
+        start, end = self._get_date_range(**kwargs)
+        boundaries = interval_boundaries(start, end, interval)
+        id_range = {self.doc_id : {'$gte' : ObjectId.from_datetime(boundaries[0]), '$lt' : ObjectId.from_datetime(boundaries[-1])}}
+        query = {'$and' : [self._build_query(**kwargs), id_range]}
+        def aggregate(key):
+            key_start, key_end = partition_range(key)
+            lower = max(bisect.bisect_right(boundaries, key_start) - 1, 0)
+            upper = min(bisect.bisect_left(boundaries, key_end), len(boundaries) - 1)
+            group = {'p' : period_index_expression('$' + self.doc_id, boundaries, lower, upper)}
+            pipeline = [{'$match' : query}]
+            if tag_ids is not None:
+                group['t'] = '$' + self.doc_tags
+                pipeline.extend([{'$project' : {self.doc_tags : 1}}, {'$unwind' : '$' + self.doc_tags}])
+                pipeline.extend([{'$match' : {self.doc_tags : {'$in' : tag_ids}}}] if tag_ids else [])
+            pipeline.append({'$group' : {'_id' : group, 'n' : {'$sum' : 1}}})
+            return list(self._collections[key].aggregate(pipeline))
+        results = run_concurrently(aggregate, self._get_partition_keys(**kwargs))
+        return boundaries[:-1], [result for year_results in results for result in year_results]
+
+    def _get_date_range(self, **kwargs):
+        start = dtparser.parse(kwargs['min_date'][0]) if 'min_date' in kwargs else self.get_earliest_date().replace(tzinfo=None)
+        end = dtparser.parse(kwargs['max_date'][0]) if 'max_date' in kwargs else self.get_latest_date().replace(tzinfo=None) + timedelta(seconds=1)
+        return (start, end)
+
+    def _get_doc_collection(self, doc_id):
+        return self._collections[self._get_doc_key({self.doc_id : doc_id})]
+
+    def _get_partition_keys(self, **kwargs):
+        start, end = self._parse_date_range(**kwargs)
+        return [key for key in self._get_sorted_keys(pymongo.ASCENDING) if self._key_overlaps(key, start, end)]
 
-    def _get_doc_year(self, doc):
-        return self.get_date(doc).year
+    def _get_partition_collection(self, key):
+        return self._collections[key]
+
+    def _get_partition_id_range(self, key):
+        return tuple(ObjectId.from_datetime(bound) for bound in partition_range(key))
+
+    def _split_partition_by_interval(self, key, interval):
+        start, end = partition_range(key)
+        edges = [ObjectId.from_datetime(min(max(bound, start), end)) for bound in interval_boundaries(start, end, interval)]
+        return [(lower, upper) for lower, upper in zip(edges[:-1], edges[1:]) if lower != upper]
+
+    def _get_collections(self, **kwargs):
+        keys = self._get_partition_keys(**kwargs)
+        return [self._collections[key] for key in (keys if kwargs.get('sort') == pymongo.ASCENDING else reversed(keys))]
+
+    def _get_sources(self, **kwargs):
+        return [source for _, source in self._get_keyed_sources(**kwargs)]
+
+    def _get_keyed_sources(self, **kwargs):
+        start, end = self._parse_date_range(**kwargs)
+        keys = sorted(set(self._collections) | set(self._archives), key=partition_range, reverse=kwargs.get('sort') != pymongo.ASCENDING)
+        return [(key, sources[key]) for key in keys if self._key_overlaps(key, start, end) for sources in [self._collections, self._archives] if key in sources]
+
+    def _plan_sources(self, order, **kwargs):
+        keyed = self._get_keyed_sources(sort=order, **kwargs)
+        query, skipped, hint = self._plan_query([key for key, _ in keyed], **kwargs)
+        # Archives are not counted in the statistics, so only live collections are skipped
+        return (query, [(key, source) for key, source in keyed if key not in skipped or source is not self._collections.get(key)], hint)
+
+    def _group_overlapping(self, keyed, order):
+        # Partitions overlap while one is repartitioned, or when documents are added to an archived partition
+        groups = []
+        for key, source in sorted(keyed, key=lambda key_source: partition_range(key_source[0])):
+            start, end = partition_range(key)
+            if groups and start < groups[-1][0]:
+                groups[-1] = (max(groups[-1][0], end), groups[-1][1] + [source])
+            else:
+                groups.append((end, [source]))
+        return [sources for _, sources in (groups if order == pymongo.ASCENDING else reversed(groups))]
+
+    def _get_sorted_keys(self, order):
+        return sorted(self._collections, key=partition_range, reverse=order == pymongo.DESCENDING)
+
+    def _key_overlaps(self, key, start, end):
+        key_start, key_end = partition_range(key)
+        return (start is None or key_end > start) and (end is None or key_start <= end)
+
+    def _parse_date_range(self, **kwargs):
+        starts = [dtparser.parse(kwargs['min_date'][0])] if 'min_date' in kwargs else []
+        ends = [dtparser.parse(kwargs['max_date'][0])] if 'max_date' in kwargs else []
+        starts += [kwargs['after_id'].generation_time] if isinstance(kwargs.get('after_id'), ObjectId) else []
+        ends += [kwargs['before_id'].generation_time] if isinstance(kwargs.get('before_id'), ObjectId) else []
+        return (max(map(_naive_utc, starts)) if starts else None, min(map(_naive_utc, ends)) if ends else None)
+
+def _naive_utc(date):
+    return date.astimezone(timezone.utc).replace(tzinfo=None) if date.tzinfo is not None else date
+
+def _is_older(statistics, max_age):
+    return datetime.utcnow() - _naive_utc(statistics.updated) >= max_age
+
+def _get_day(date, ceiling=False):
+    '''Get the day of a date, in UTC, rounded up to the next day when **ceiling** is set and the date is not midnight.'''
+    date = _naive_utc(date)
+    day = datetime(date.year, date.month, date.day)
+    return day + timedelta(days=1) if ceiling and day != date else day
+
+def _flatten_counts(doc):
+    counts = Counter({RollupManager.rollup_count : doc.get(RollupManager.rollup_count, 0)})
+    counts.update({'{}.{}'.format(field, tag_id) : n for field, tags in doc.items() if isinstance(tags, dict) for tag_id, n in tags.items()})
+    return +counts
+
+def _nest_counts(counts):
+    doc = {}
+    for path, n in counts.items():
+        field, _, tag_id = path.partition('.')
+        if tag_id:
+            doc.setdefault(field, {})[tag_id] = n
+        else:
+            doc[field] = n
+    return doc
 
-    def _parse_year_range(self, **kwargs):
-        min_date = kwargs.get('min_date', ["{}-01-01".format(self._min_year)])
-        max_date = kwargs.get('max_date', ["{}-01-01".format(self._max_year)])
-        return (dtparser.parse(min_date[0]).year, dtparser.parse(max_date[0]).year)
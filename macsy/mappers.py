@@ -0,0 +1,139 @@
+'''Mappers apply a function to every document in a blackboard in parallel, writing the changes back in bulk.'''
+
+import os
+import time
+import traceback
+import multiprocessing
+from collections import namedtuple
+
+PartitionResult = namedtuple('PartitionResult', ['partition', 'processed', 'changed', 'modified', 'last_id', 'seconds', 'write_errors', 'error'])
+PartitionResult.__doc__ = '''Result of mapping over a single partition of a blackboard.
+
+    The **last_id** is the id of the last document processed in the partition, and **error** holds the
+    formatted traceback if the partition failed part way through (changes made before the failure are kept).
+'''
+
+class MapReport():
+    '''Report returned by :meth:`map()<macsy.blackboards.Blackboard.map>`, with the results of each partition.
+
+    Example:
+        >>> report = blackboard.map(func, workers=4)
+        >>> for result in report.failed:
+        >>> ... print(result.partition, result.last_id, result.error)
+    '''
+
+    def __init__(self, results):
+        self.results = results
+
+    @property
+    def processed(self):
+        ''':class:`int`: number of documents processed.'''
+        return sum(result.processed for result in self.results)
+
+    @property
+    def changed(self):
+        ''':class:`int`: number of documents for which changes were returned.'''
+        return sum(result.changed for result in self.results)
+
+    @property
+    def modified(self):
+        ''':class:`int`: number of bulk updates which modified a document (adding and removing tags together takes two).'''
+        return sum(result.modified for result in self.results)
+
+    @property
+    def failed(self):
+        ''':class:`list[PartitionResult]`: results of partitions which raised an error or had write errors.'''
+        return [result for result in self.results if result.error is not None or result.write_errors]
+
+    def __repr__(self):
+        return 'MapReport(partitions={}, processed={}, changed={}, modified={}, failed={})'.format(
+            len(self.results), self.processed, self.changed, self.modified, len(self.failed))
+
+class BlackboardMapper():
+    '''Applies a :class:`PartitionRunner` over the partitions of a blackboard, using a pool of worker processes.
+
+    This should not be used directly, see :meth:`map()<macsy.blackboards.Blackboard.map>`.
+    '''
+
+    partitions_per_worker = 4
+
+    def __init__(self, blackboard, runner, workers=None, progress=None):
+        self._blackboard = blackboard
+        self._runner = runner
+        self._workers = os.cpu_count() if workers is None else workers
+        self._progress = progress
+
+    def run(self, **kwargs):
+        partitions = self._get_partitions(**kwargs)
+        results = self._run_in_pool(partitions, kwargs) if self._workers > 0 else \
+            (self._runner.run(self._blackboard, partition, kwargs) for partition in partitions)
+        return MapReport([self._report(result) for result in results])
+
+    def _get_partitions(self, **kwargs):
+        count = max(1, self._workers * BlackboardMapper.partitions_per_worker)
+        return self._blackboard.document_manager.get_partitions(count, **kwargs)
+
+    def _run_in_pool(self, partitions, kwargs):
+        if self._blackboard._api is None:
+            raise ValueError('Blackboards must be loaded through the BlackboardAPI to be mapped in parallel.')
+        initargs = (self._blackboard._api._get_connection(), self._blackboard._name, self._runner, kwargs)
+        with multiprocessing.Pool(self._workers, _init_worker, initargs) as pool:
+            for result in pool.imap_unordered(_run_worker_partition, partitions):
+                yield result
+
+    def _report(self, result):
+        if self._progress is not None:
+            self._progress(result)
+        return result
+
+class PartitionRunner():
+    '''Applies a function to the documents of a single partition, flushing the changes every **batch_size** updates.
+
+    Runners are sent to the worker processes, so they only hold the function and settings, never a database connection.
+    '''
+
+    def __init__(self, func, batch_size=500):
+        self._func = func
+        self._batch_size = batch_size
+
+    def run(self, blackboard, partition, kwargs):
+        doc_manager = blackboard.document_manager
+        start, processed, changed, last_id, error = time.time(), 0, 0, None, None
+        pending, written = [], {'matched' : 0, 'modified' : 0, 'errors' : []}
+        try:
+            for doc in doc_manager.find_partition(partition, **self._get_filters(blackboard, partition, kwargs)):
+                changes = self._func(doc)
+                processed, last_id = processed + 1, doc[doc_manager.doc_id]
+                if changes:
+                    changed += 1
+                    pending.extend((last_id, update) for update in doc_manager.get_changes_updates(last_id, changes))
+                if len(pending) >= self._batch_size:
+                    self._flush(blackboard, partition, pending, written, last_id)
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            self._flush(blackboard, partition, pending, written, last_id)
+        return PartitionResult(partition, processed, changed, written['modified'], last_id, time.time() - start, written['errors'], error)
+
+    def _get_filters(self, blackboard, partition, kwargs):
+        return kwargs
+
+    def _flush(self, blackboard, partition, pending, written, last_id):
+        if pending:
+            result = blackboard.document_manager.bulk_update(pending)
+            for key in written:
+                written[key] += result[key]
+            del pending[:]
+
+_worker = None
+
+def _init_worker(connection, blackboard_name, runner, kwargs):
+    global _worker
+    from macsy.api import BlackboardAPI
+    settings, mongo_client = connection
+    blackboard = BlackboardAPI(settings, MongoClient=mongo_client).load_blackboard(blackboard_name)
+    _worker = (blackboard, runner, kwargs)
+
+def _run_worker_partition(partition):
+    blackboard, runner, kwargs = _worker
+    return runner.run(blackboard, partition, kwargs)
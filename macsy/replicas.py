@@ -0,0 +1,357 @@
+'''Replicas are local, read-only copies of blackboards in SQLite files, for offline analysis away from the database.'''
+
+import os
+import sqlite3
+import threading
+from collections import namedtuple, Counter
+from itertools import islice
+from bson import BSON, ObjectId
+from bson.raw_bson import RawBSONDocument
+from dateutil import parser as dtparser
+from macsy.utils import match, project, listify
+from macsy.cursors import BlackboardCursor
+from macsy.managers import Partition, TagManager, CounterManager, DocumentManager
+
+SyncReport = namedtuple('SyncReport', ['partitions', 'documents', 'tags'])
+SyncReport.__doc__ = '''Summary of a run of a :class:`ReplicaSync`.
+
+    The **partitions** are the number of partitions (e.g. year collections) read, **documents** the number of
+    documents copied, and **tags** the number of tags in the replica.
+'''
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB);
+CREATE TABLE IF NOT EXISTS partitions (key TEXT PRIMARY KEY, last BLOB);
+CREATE TABLE IF NOT EXISTS documents (id PRIMARY KEY, doc BLOB) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS document_tags (field TEXT, tag INTEGER, id, PRIMARY KEY (field, tag, id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS document_tags_id ON document_tags (id);
+CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, name TEXT, doc BLOB);
+CREATE TABLE IF NOT EXISTS counters (id TEXT PRIMARY KEY, doc BLOB);
+'''
+
+class ReplicaSync():
+    '''Copies the documents, tags and counter settings of a blackboard into a replica file, read by :class:`ReplicaBlackboard`.
+
+    Each partition of the blackboard (e.g. year collection) is read in id order from the last id copied
+    by the previous run, so runs are incremental and only read the documents inserted since. The documents are
+    copied with the chosen **fields** (and always their tags), and each batch is committed with the position it
+    reached, so an interrupted run resumes where it stopped. The tags and counter settings are copied in full by every run.
+
+    Changes to documents which were already copied, and deleted documents, are only picked up by a full run,
+    which copies the blackboard again from scratch.
+
+    Example:
+        >>> sync = ReplicaSync(api.load_blackboard('ARTICLE'), '/data/replicas/ARTICLE.db', fields=['T', 'D'])
+        >>> sync.run()
+        >>> replica = ReplicaBlackboard('/data/replicas/ARTICLE.db')
+    '''
+
+    def __init__(self, blackboard, path, fields=None, batch_size=1000):
+        '''Constructor for the ReplicaSync.
+
+        Args:
+            blackboard (:class:`Blackboard<macsy.blackboards.Blackboard>`): the blackboard to copy.
+            path (:class:`str`): path of the replica file, which is created if it does not exist.
+            fields (:class:`list[str]`, optional): fields of the documents to copy, defaults to all the fields
+                (or the fields the replica was created with).
+            batch_size (:class:`int`, optional): number of documents copied in each transaction.
+        '''
+        self._blackboard = blackboard
+        self._replica = _connect(path)
+        self._fields = fields
+        self._batch_size = batch_size
+
+    def run(self, full=False):
+        '''Copy the documents inserted since the last run, and all the tags and counter settings.
+
+        Args:
+            full (:class:`bool`, optional): discard the copied documents and copy the whole blackboard again.
+
+        Returns:
+            :class:`SyncReport`: summary of the run.
+
+        Raises:
+            :class:`ValueError`: If the replica holds another blackboard, or was created with other fields and the run is not full.
+        '''
+        doc_m = self._blackboard.document_manager
+        fields = self._check_meta(full)
+        projection = dict({field : 1 for field in fields}, **{doc_m.doc_tags : 1, doc_m.doc_control_tags : 1}) if fields else None
+        keys = [partition.key for partition in doc_m.get_partitions()]
+        with self._replica:
+            self._replica.execute('DELETE FROM partitions WHERE key NOT IN ({})'.format(', '.join('?' * len(keys))), [_partition_name(key) for key in keys])
+        copied = sum(self._copy_partition(key, projection) for key in keys)
+        tags = self._copy_settings()
+        return SyncReport(len(keys), copied, tags)
+
+    def _check_meta(self, full):
+        meta = _read_meta(self._replica)
+        if meta.get('name', self._blackboard._name) != self._blackboard._name:
+            raise ValueError('The replica holds the blackboard {}'.format(meta['name']))
+        fields = sorted(self._fields) if self._fields is not None else meta.get('fields')
+        if not full and 'fields' in meta and fields != meta['fields']:
+            raise ValueError('The replica was created with the fields {}, run a full sync to change them'.format(meta['fields']))
+        with self._replica:
+            if full:
+                for table in ['documents', 'document_tags', 'partitions']:
+                    self._replica.execute('DELETE FROM {}'.format(table))
+            values = {'name' : self._blackboard._name, 'fields' : fields}
+            self._replica.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [(key, BSON.encode({'v' : value})) for key, value in values.items()])
+        return fields
+
+    def _copy_partition(self, key, projection):
+        doc_m = self._blackboard.document_manager
+        row = self._replica.execute('SELECT last FROM partitions WHERE key = ?', (_partition_name(key),)).fetchone()
+        last = BSON(row[0]).decode()['v'] if row else None
+        cursor = doc_m.find_partition(Partition(key, None, None), projection=projection, after_id=last).batch_size(self._batch_size)
+        copied = 0
+        while True:
+            docs = list(islice(cursor, self._batch_size))
+            if not docs:
+                return copied
+            ids = [_encode_id(doc[doc_m.doc_id]) for doc in docs]
+            tags = [(field, tag, doc_id) for doc, doc_id in zip(docs, ids) for field in [doc_m.doc_tags, doc_m.doc_control_tags]
+                for tag in set(listify(doc.get(field, [])))]
+            with self._replica:
+                self._replica.execute('DELETE FROM document_tags WHERE id IN ({})'.format(', '.join('?' * len(ids))), ids)
+                self._replica.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?)', [(doc_id, BSON.encode(doc)) for doc, doc_id in zip(docs, ids)])
+                self._replica.executemany('INSERT OR IGNORE INTO document_tags VALUES (?, ?, ?)', tags)
+                self._replica.execute('INSERT OR REPLACE INTO partitions VALUES (?, ?)', (_partition_name(key), BSON.encode({'v' : docs[-1][doc_m.doc_id]})))
+            copied += len(docs)
+
+    def _copy_settings(self):
+        db, name = self._blackboard._db, self._blackboard._name
+        tags = [(tag[TagManager.tag_id], tag.get(TagManager.tag_name), BSON.encode(tag)) for tag in db[name + TagManager.tag_suffix].find()]
+        counters = [(str(doc[CounterManager.counter_id]), BSON.encode(doc)) for doc in db[name + CounterManager.counter_suffix].find()]
+        with self._replica:
+            self._replica.execute('DELETE FROM tags')
+            self._replica.execute('DELETE FROM counters')
+            self._replica.executemany('INSERT INTO tags VALUES (?, ?, ?)', tags)
+            self._replica.executemany('INSERT INTO counters VALUES (?, ?)', counters)
+        return len(tags)
+
+class ReplicaBlackboard():
+    '''Read-only blackboard reading from a replica file written by :class:`ReplicaSync`, without a database connection.
+
+    It supports the reading methods of :class:`Blackboard<macsy.blackboards.Blackboard>` with the same filters:
+    the tag and id (and date) filters are answered by SQLite from the replica's indexes, while the **fields**,
+    **without_fields** and raw **query** filters are evaluated on the documents in the range, with
+    :func:`match()<macsy.utils.match>`. The writing methods raise a :class:`PermissionError`.
+
+    Example:
+        >>> replica = ReplicaBlackboard('/data/replicas/ARTICLE.db')
+        >>> replica.count(tags=['Tag_1'], without_tags=['Tag_2'], min_date=['2017-01-01'])
+        >>> for doc in replica.find(tags=['Tag_1'], max=10):
+        >>> ... print(doc['T'])
+    '''
+
+    doc_id = '_id'
+    fetch_size = 1000
+
+    def __init__(self, path):
+        '''Constructor for the ReplicaBlackboard.
+
+        Args:
+            path (:class:`str`): path of the replica file.
+
+        Raises:
+            :class:`FileNotFoundError`: If the replica file does not exist.
+        '''
+        if not os.path.exists(path):
+            raise FileNotFoundError('No replica at {}'.format(path))
+        self._replica = _connect(path)
+        meta = _read_meta(self._replica)
+        self._name = meta.get('name')
+        self._fields = meta.get('fields')
+        self._lock = threading.Lock()
+
+    def count(self, **kwargs):
+        '''Count the number of documents in the replica, with the same filters as :meth:`count()<macsy.blackboards.Blackboard.count>`.'''
+        kwargs.pop('approximate', None)
+        return self._count(*self._build_query(**kwargs))
+
+    def find(self, **kwargs):
+        '''Return a cursor for the documents in the replica, with the same arguments as :meth:`find()<macsy.blackboards.Blackboard.find>`.
+
+        Returns:
+            :class:`BlackboardCursor<macsy.cursors.BlackboardCursor>`: cursor of the documents.
+        '''
+        max_docs, sort, raw = kwargs.pop('max', 0), kwargs.pop('sort', -1), kwargs.pop('raw', False)
+        where, params, query = self._build_query(**kwargs)
+        return BlackboardCursor((ReplicaCursor(self, where, params, query, sort, max_docs, raw), max_docs, None))
+
+    def get(self, doc_id, projection=None):
+        '''Get a single document by id.'''
+        docs, missing = self.get_many([doc_id], projection)
+        return docs[0] if docs else None
+
+    def get_many(self, ids, projection=None):
+        '''Get a batch of documents by id.
+
+        Returns:
+            :class:`tuple`: list of the documents found, in the order of **ids**, and list of the ids which were not found.
+        '''
+        found = {}
+        for start in range(0, len(ids), 500):
+            batch = [_encode_id(doc_id) for doc_id in ids[start:start + 500]]
+            rows = self._execute('SELECT doc FROM documents WHERE id IN ({})'.format(', '.join('?' * len(batch))), batch).fetchall()
+            found.update((doc[self.doc_id], project(doc, projection)) for doc in (BSON(row[0]).decode() for row in rows))
+        return [found[doc_id] for doc_id in ids if doc_id in found], [doc_id for doc_id in ids if doc_id not in found]
+
+    def count_tags(self, control=False, **kwargs):
+        '''Count the number of documents annotated with each tag, with the same filters as :meth:`count()<macsy.blackboards.Blackboard.count>`.
+
+        Returns:
+            :class:`dict`: number of documents for each tag name (or tag id, for tags which no longer exist).
+        '''
+        field = DocumentManager.doc_control_tags if control else DocumentManager.doc_tags
+        where, params, query = self._build_query(**kwargs)
+        if query:
+            counts = Counter(tag for doc in self._find(where, params, query) for tag in set(listify(doc.get(field, []))))
+        else:
+            counts = dict(self._execute('SELECT tag, COUNT(*) FROM document_tags WHERE field = ? AND id IN (SELECT id FROM documents WHERE {}) GROUP BY tag'.format(where),
+                [field] + params).fetchall())
+        names = {tag_id : name for tag_id, name in self._execute('SELECT id, name FROM tags').fetchall()}
+        return {names.get(tag_id, tag_id) : count for tag_id, count in counts.items()}
+
+    def get_all_tags(self):
+        '''Get all the tags of the replicated blackboard.'''
+        return [BSON(row[0]).decode() for row in self._execute('SELECT doc FROM tags ORDER BY id').fetchall()]
+
+    def get_tag(self, tag):
+        '''Retrieve a tag by id (:class:`int`) or name (:class:`str`), or :class:`None` if it does not exist.'''
+        row = self._execute('SELECT doc FROM tags WHERE {} = ?'.format('name' if isinstance(tag, str) else 'id'), (tag,)).fetchone()
+        return BSON(row[0]).decode() if row else None
+
+    def is_control_tag(self, tag):
+        '''Check whether a tag is a control tag.'''
+        return bool((self.get_tag(tag) or {}).get(TagManager.tag_control, False))
+
+    def is_inheritable_tag(self, tag):
+        '''Check whether a tag is inheritable.'''
+        return bool((self.get_tag(tag) or {}).get(TagManager.tag_inherit, False))
+
+    def get_date(self, doc):
+        '''Get the date of a document of a date-based blackboard, from its :class:`ObjectId`.'''
+        if not isinstance(doc.get(self.doc_id), ObjectId):
+            raise ValueError('Document id is not an ObjectId: {}'.format(doc.get(self.doc_id)))
+        return doc[self.doc_id].generation_time
+
+    def get_earliest_date(self):
+        '''Get the date of the earliest document, for date-based blackboards.'''
+        return self._get_extremal_date('MIN')
+
+    def get_latest_date(self):
+        '''Get the date of the latest document, for date-based blackboards.'''
+        return self._get_extremal_date('MAX')
+
+    def get_counter(self, counter_id):
+        '''Get a counter setting document of the replicated blackboard, e.g. 'INDEXES', or :class:`None` if it does not exist.'''
+        row = self._execute('SELECT doc FROM counters WHERE id = ?', (counter_id,)).fetchone()
+        return BSON(row[0]).decode() if row else None
+
+    def _get_extremal_date(self, function):
+        value = self._execute('SELECT {}(id) FROM documents'.format(function)).fetchone()[0]
+        return _decode_id(value).generation_time if isinstance(value, bytes) else None
+
+    def _build_query(self, **kwargs):
+        conditions, params = [], []
+        for keyword, operation in [('min_date', '>='), ('max_date', '<')]:
+            for date in kwargs.get(keyword, []):
+                conditions.append('id {} ?'.format(operation))
+                params.append(_encode_id(ObjectId.from_datetime(dtparser.parse(str(date)))))
+        for keyword, operation in [('after_id', '>'), ('before_id', '<')]:
+            if kwargs.get(keyword) is not None:
+                conditions.append('id {} ?'.format(operation))
+                params.append(_encode_id(kwargs[keyword]))
+        query = kwargs.get('query')
+        if query is None:
+            for keyword, operation in [('tags', 'IN'), ('without_tags', 'NOT IN')]:
+                for tag in _check_list(kwargs.get(keyword, [])):
+                    conditions.append('id {} (SELECT id FROM document_tags WHERE field = ? AND tag = ?)'.format(operation))
+                    params.extend(self._get_tag_key(tag))
+            query = {field : {'$exists' : exists} for keyword, exists in [('fields', True), ('without_fields', False)] for field in _check_list(kwargs.get(keyword, []))}
+        return (' AND '.join(conditions) or '1', params, query)
+
+    def _get_tag_key(self, tag):
+        full_tag = self.get_tag(tag)
+        if full_tag is None:
+            raise ValueError('Tag does not exist: {}'.format(tag))
+        return (DocumentManager.doc_control_tags if full_tag.get(TagManager.tag_control) else DocumentManager.doc_tags, int(full_tag[TagManager.tag_id]))
+
+    def _count(self, where, params, query):
+        if not query:
+            return self._execute('SELECT COUNT(*) FROM documents WHERE {}'.format(where), params).fetchone()[0]
+        return sum(1 for _ in self._find(where, params, query))
+
+    def _find(self, where, params, query, sort=-1, max_docs=0, raw=False):
+        order = 'ASC' if sort == 1 else 'DESC'
+        limit = ' LIMIT {:d}'.format(max_docs) if max_docs and not query else ''
+        rows = self._execute('SELECT doc FROM documents WHERE {} ORDER BY id {}{}'.format(where, order, limit), params)
+        while True:
+            with self._lock:
+                batch = rows.fetchmany(ReplicaBlackboard.fetch_size)
+            if not batch:
+                return
+            for row in batch:
+                doc = BSON(row[0]).decode()
+                if not query or match(doc, query):
+                    yield RawBSONDocument(row[0]) if raw else doc
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._replica.execute(sql, params)
+
+class ReplicaCursor():
+    '''Cursor over the documents of a :class:`ReplicaBlackboard`, wrapped in a :class:`BlackboardCursor<macsy.cursors.BlackboardCursor>`.'''
+
+    def __init__(self, replica, where, params, query, sort, max_docs, raw):
+        self._replica = replica
+        self._args = (where, params, query, sort, max_docs, raw)
+        self._docs = None
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self._replica._count(*self._args[:3])
+        return self._count
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._docs is None:
+            self._docs = self._replica._find(*self._args)
+        return next(self._docs)
+
+def _read_only(name):
+    def method(self, *args, **kwargs):
+        raise PermissionError('Replicas are read-only: {} is not supported.'.format(name))
+    method.__name__ = name
+    method.__doc__ = 'Not supported by replicas, raises a :class:`PermissionError`.'
+    return method
+
+for _name in ['insert', 'update', 'delete', 'update_where', 'delete_where', 'add_tag', 'remove_tag', 'insert_tag', 'update_tag', 'delete_tag', 'buffered']:
+    setattr(ReplicaBlackboard, _name, _read_only(_name))
+
+def _connect(path):
+    replica = sqlite3.connect(path, check_same_thread=False)
+    replica.executescript(_schema)
+    return replica
+
+def _read_meta(replica):
+    return {key : BSON(value).decode()['v'] for key, value in replica.execute('SELECT key, value FROM meta').fetchall()}
+
+def _partition_name(key):
+    return '' if key is None else str(key)
+
+def _encode_id(doc_id):
+    '''Encode a document id as a SQLite value with the same ordering: ObjectIds as their 12 bytes, which sort after numbers and strings.'''
+    return doc_id.binary if isinstance(doc_id, ObjectId) else doc_id
+
+def _decode_id(value):
+    return ObjectId(value) if isinstance(value, bytes) else value
+
+def _check_list(argument):
+    if not isinstance(argument, list):
+        raise ValueError('Argument needs to be a list: {}'.format(argument))
+    return argument
@@ -0,0 +1,125 @@
+'''Schedulers run agents over the historical data of a blackboard in resumable units of work.'''
+
+import time
+from datetime import datetime
+from collections import namedtuple
+from macsy.mappers import BlackboardMapper, PartitionRunner
+
+BackfillProgress = namedtuple('BackfillProgress', ['result', 'completed', 'total', 'throughput', 'eta'])
+BackfillProgress.__doc__ = '''Progress of a backfill, reported as each unit of work completes.
+
+    The **result** is the :class:`PartitionResult<macsy.mappers.PartitionResult>` of the unit, **throughput** its
+    documents per second, and **eta** the estimated seconds until the remaining units are complete.
+'''
+
+class BackfillScheduler(BlackboardMapper):
+    '''Scheduler which runs an agent function over the history of a blackboard, checkpointing completed units of work.
+
+    The work is split into one unit per year collection, or per finer calendar slice of the document ids
+    (e.g. 'month' or 'day') for date-based blackboards. Units are run concurrently in up to **concurrency** processes
+    and recorded in the blackboard's checkpoint collection once complete, along with the last document processed by
+    unfinished units, so that after a crash or a redeploy, running the same **job** again resumes where it stopped.
+    Standard blackboards are processed as a single unit.
+
+    **func** follows the same conventions as for :meth:`map()<macsy.blackboards.Blackboard.map>`.
+
+    Example:
+        >>> from macsy.schedulers import BackfillScheduler
+        >>> scheduler = BackfillScheduler(blackboard, 'topics-v2', classify, concurrency=8, interval='month', progress=print)
+        >>> report = scheduler.run(min_date=['2009-01-01'])
+    '''
+
+    checkpoint_suffix = '_BACKFILL'
+
+    def __init__(self, blackboard, job, func, concurrency=4, interval=None, batch_size=500, progress=None):
+        '''Constructor for the BackfillScheduler.
+
+        Args:
+            blackboard (:class:`Blackboard<macsy.blackboards.Blackboard>`): the blackboard to backfill.
+            job (:class:`str`): name of the backfill, used to identify its checkpoints.
+            func (:class:`callable`): function to apply to each document.
+            concurrency (:class:`int`, optional): maximum number of units run at once, each in its own process.
+                Use 0 to run the units one at a time in the calling process.
+            interval (:class:`str`, optional): split each year into 'month', 'week' or 'day' units rather than one per year.
+            batch_size (:class:`int`, optional): number of pending updates which triggers a bulk write.
+            progress (:class:`callable`, optional): called with a :class:`BackfillProgress` as each unit completes.
+        '''
+        super().__init__(blackboard, CheckpointedRunner(func, batch_size, job), concurrency, progress)
+        self._job = job
+        self._interval = interval
+        self._checkpoints = blackboard._db[blackboard._name + BackfillScheduler.checkpoint_suffix]
+        self._start, self._completed, self._total = None, 0, 0
+
+    def run(self, **kwargs):
+        '''Run the units of work which have not been completed yet.
+
+        Args:
+            **kwargs: the same filters as :meth:`find()<macsy.blackboards.Blackboard.find>`.
+
+        Returns:
+            :class:`MapReport<macsy.mappers.MapReport>`: results of the units run, including any failures.
+        '''
+        return super().run(**kwargs)
+
+    def get_completed(self):
+        '''Get the checkpoints of the completed units of work.
+
+        Returns:
+            :class:`list[dict]`: checkpoint of each completed unit, with the number of documents processed and when it completed.
+        '''
+        return list(self._checkpoints.find({'job' : self._job, 'done' : True}))
+
+    def reset(self):
+        '''Remove all the checkpoints of the job, so that the next run starts from the beginning.'''
+        return self._checkpoints.delete_many({'job' : self._job}).deleted_count
+
+    def _get_partitions(self, **kwargs):
+        partitions = self._blackboard.document_manager.get_partitions(interval=self._interval, **kwargs)
+        done = set(x['_id'] for x in self._checkpoints.find({'job' : self._job, 'done' : True}, {'_id' : 1}))
+        partitions = [x for x in partitions if checkpoint_id(self._job, x) not in done]
+        self._start, self._completed, self._total = time.time(), 0, len(partitions)
+        return partitions
+
+    def _report(self, result):
+        self._completed += 1
+        if result.error is None and not result.write_errors:
+            checkpoint = dict(_checkpoint_fields(self._job, result.partition), done=True, completed=datetime.utcnow(), seconds=result.seconds)
+            self._checkpoints.update_one({'_id' : checkpoint_id(self._job, result.partition)},
+                {'$set' : checkpoint, '$inc' : {'processed' : result.processed}}, upsert=True)
+        elapsed = time.time() - self._start
+        throughput = result.processed / result.seconds if result.seconds > 0 else 0.0
+        eta = elapsed / self._completed * (self._total - self._completed)
+        return super()._report(BackfillProgress(result, self._completed, self._total, throughput, eta)).result
+
+class CheckpointedRunner(PartitionRunner):
+    '''Partition runner which records the last document processed by each unit, and resumes after it.
+
+    Once a bulk write of a unit returns write errors, the unit's checkpoint is no longer advanced,
+    so the next run resumes before the documents whose changes failed rather than skipping them.
+    '''
+
+    def __init__(self, func, batch_size, job):
+        super().__init__(func, batch_size)
+        self._job = job
+
+    def _get_filters(self, blackboard, partition, kwargs):
+        checkpoint = _get_checkpoints(blackboard).find_one({'_id' : checkpoint_id(self._job, partition)})
+        if checkpoint is None or checkpoint.get('last_id') is None:
+            return kwargs
+        return dict(kwargs, after_id=checkpoint['last_id'])
+
+    def _flush(self, blackboard, partition, pending, written, last_id):
+        super()._flush(blackboard, partition, pending, written, last_id)
+        if last_id is not None and not written['errors']:
+            checkpoint = dict(_checkpoint_fields(self._job, partition), last_id=last_id)
+            _get_checkpoints(blackboard).update_one({'_id' : checkpoint_id(self._job, partition)}, {'$set' : checkpoint}, upsert=True)
+
+def checkpoint_id(job, partition):
+    '''Get the id of the checkpoint for a unit of work of a backfill job.'''
+    return '{}:{}:{}'.format(job, partition.key, partition.lower)
+
+def _checkpoint_fields(job, partition):
+    return {'job' : job, 'key' : partition.key, 'lower' : partition.lower, 'upper' : partition.upper}
+
+def _get_checkpoints(blackboard):
+    return blackboard._db[blackboard._name + BackfillScheduler.checkpoint_suffix]
@@ -1,47 +1,199 @@
 import sys, os
+import re
+import time
+import struct
 import mongomock
 from functools import wraps
-from collections import namedtuple
-from datetime import datetime
+from contextlib import redirect_stdout
+from copy import deepcopy
+from collections import namedtuple, OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from dateutil import parser as dtparser
+from dateutil.relativedelta import relativedelta
+import bson
 from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+Executor = namedtuple('Executor', ['operation','function'])
 
 class QueryBuilder():
 
+    query_cache_size = 1024
+
     def __init__(self, blackboard):
         self._blackboard = blackboard
-
-    def build_document_query(self, **kwargs):
-        Executor = namedtuple('Executor', ['operation','function'])
-        executors = {'tags' : Executor('$all', self._build_tag_query), 'without_tags' : Executor('$nin', self._build_tag_query), 
+        self._executors = {'tags' : Executor('$all', self._build_tag_query), 'without_tags' : Executor('$nin', self._build_tag_query), 
             'fields' : Executor(True, self._build_field_query), 'without_fields' : Executor(False, self._build_field_query), 
             'min_date' : Executor('$gte', self._build_date_query), 'max_date' : Executor('$lt', self._build_date_query)}
-        existing = {key : value for key, value in kwargs.items() if key in set(kwargs).intersection(executors) and self._argument_is_list(value)}
+        self._query_cache = LRUCache(QueryBuilder.query_cache_size)
+        self._tag_version = None
+        self._tag_sets = {}
+
+    def build_document_query(self, **kwargs):
+        existing = {key : value for key, value in kwargs.items() if key in self._executors and self._argument_is_list(value)}
+        key = self._get_cache_key(existing)
+        query = self._query_cache.get(key) if key is not None else None
+        if query is None:
+            query = self._compile_document_query(existing)
+            if key is not None:
+                self._query_cache.put(key, query)
+        return deepcopy(query)
+
+    def build_id_bounds(self, **kwargs):
+        doc_id = self._blackboard.document_manager.doc_id
+        bounds = {}
+        for keyword, operation in [('min_date', '$gte'), ('max_date', '$lt')]:
+            for date in kwargs.get(keyword, []):
+                bounds.update(self._build_date_query(({doc_id : bounds}, date, operation))[1])
+        bounds.update({operation : kwargs[key] for key, operation in [('after_id', '$gt'), ('before_id', '$lt')] if kwargs.get(key) is not None})
+        return bounds
+
+    def clear_cache(self):
+        self._query_cache.clear()
+
+    def _compile_document_query(self, existing):
         query = {}
         for keyword, values in existing.items():
             for value in values:
-                key, val = executors[keyword].function((query, value, executors[keyword].operation))
+                key, val = self._executors[keyword].function((query, value, self._executors[keyword].operation))
                 query[key] = val
         return query
 
+    def _get_cache_key(self, existing):
+        tag_version = getattr(self._blackboard.tag_manager, 'version', None)
+        if tag_version != self._tag_version:
+            self._query_cache.clear()
+            self._tag_version = tag_version
+        key = tuple((keyword, tuple(existing[keyword])) for keyword in sorted(existing))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def build_keyset_query(self, document_query, **kwargs):
+        bounds = {operation : kwargs[key] for key, operation in [('after_id', '$gt'), ('before_id', '$lt')] if kwargs.get(key) is not None}
+        if not bounds:
+            return document_query
+        id_query = {self._blackboard.document_manager.doc_id : bounds}
+        return {'$and' : [document_query, id_query]} if document_query else id_query
+
+    def get_required_tags(self, document_query, fields):
+        '''Get the (field, tag id) pairs which every document matching a query must have.'''
+        required = []
+        for field in fields:
+            condition = document_query.get(field)
+            if isinstance(condition, int):
+                required.append((field, condition))
+            elif isinstance(condition, dict):
+                required.extend((field, tag_id) for tag_id in condition.get('$all', []) if isinstance(tag_id, int))
+        return required
+
+    def order_tags(self, document_query, count):
+        '''Copy a query with the required tags of each field ordered from the fewest documents, as given by **count**(field, tag id),
+        so that the most selective tag is matched first.'''
+        query = dict(document_query)
+        for field, condition in document_query.items():
+            if isinstance(condition, dict) and isinstance(condition.get('$all'), list):
+                query[field] = dict(condition, **{'$all' : sorted(condition['$all'], key=lambda tag_id: count(field, tag_id))})
+        return query
+
     def build_document_update(self, doc_id, updated_fields):
+        doc_m = self._blackboard.document_manager
+        raw = None
+        if isinstance(updated_fields, RawBSONDocument):
+            # Only the id and the list fields are decoded, the other fields are set from the raw bytes
+            decoded = [key for key, (kind, _, _) in scan_raw(updated_fields).items() if kind == _raw_array or key in doc_m.array_fields or key == doc_m.doc_id]
+            updated_fields, raw = split_raw(updated_fields, decoded)
         add_to_set = self._append_list_fields(updated_fields)
-        if self._blackboard.document_manager.doc_id in updated_fields: del updated_fields[self._blackboard.document_manager.doc_id]
+        if doc_m.doc_id in updated_fields: del updated_fields[doc_m.doc_id]
+        updated_fields.update(self.build_tags_changed_fields([tag for field in [doc_m.doc_tags, doc_m.doc_control_tags] for tag in add_to_set.get(field, {}).get('$each', [])]))
+        if raw is not None:
+            updated_fields = extend_raw(raw, updated_fields)
         update = {"$set" : updated_fields, "$addToSet" : add_to_set} if len(add_to_set) else {"$set" : updated_fields}
         return update
 
     def build_tags_update_query(self, tag_ids, operation):
-        ctrl_tags = [tag_id for tag_id in tag_ids if self._blackboard.tag_manager.is_control_tag(tag_id)]
+        control_tags = self._get_control_tags()
+        ctrl_tags = [tag_id for tag_id in tag_ids if tag_id in control_tags]
         normal_tags = [x for x in tag_ids if x not in ctrl_tags]
         query = {operation : {}}
         for tags, field in [(ctrl_tags, self._blackboard.document_manager.doc_control_tags), (normal_tags, self._blackboard.document_manager.doc_tags)]:
             query[operation][field] = {"$each" : tags} if operation == "$addToSet" else tags
-        return query
+        return self._mark_tags_changed(query, tag_ids)
 
     def build_tag_update_query(self, tag_id, operation):
-        field = self._blackboard.document_manager.doc_control_tags if self._blackboard.tag_manager.is_control_tag(tag_id) else self._blackboard.document_manager.doc_tags
+        field = self._blackboard.document_manager.doc_control_tags if tag_id in self._get_control_tags() else self._blackboard.document_manager.doc_tags
         query = {operation : {field:  tag_id}} 
-        return query
+        return self._mark_tags_changed(query, [tag_id])
+
+    def build_tags_changed_fields(self, tag_ids):
+        '''Build the fields marking a document whose inheritable tags changed, so the change is found by tag propagation.'''
+        if not self._get_inheritable_tags().intersection(tag_ids):
+            return {}
+        return {self._blackboard.document_manager.doc_tags_changed : ObjectId()}
+
+    def merge_updates(self, updates):
+        merged = []
+        for update in (self._normalise_update(x) for x in updates):
+            if merged and self._can_merge_update(merged[-1], update):
+                self._merge_update(merged[-1], update)
+            elif update:
+                merged.append(update)
+        return merged
+
+    def _normalise_update(self, update):
+        normalised = {}
+        for operation, values in update.items():
+            for path, value in values.items():
+                if operation == '$addToSet':
+                    value = {'$each' : list(value['$each'])} if isinstance(value, dict) and '$each' in value else {'$each' : [value]}
+                    if not value['$each']: continue
+                elif operation == '$pull' and not isinstance(value, dict):
+                    operation, value = '$pullAll', [value]
+                elif operation == '$pullAll':
+                    value = list(value)
+                    if not value: continue
+                normalised.setdefault(operation, {})[path] = value
+        return normalised
+
+    def _can_merge_update(self, target, update):
+        paths = {path : operation for operation, values in target.items() for path in values}
+        return all(paths.get(path, operation) == operation and operation in ['$set', '$addToSet', '$pullAll']
+            for operation, values in update.items() for path in values)
+
+    def _merge_update(self, target, update):
+        for operation, values in update.items():
+            for path, value in values.items():
+                current = target.setdefault(operation, {}).get(path)
+                if current is None or operation == '$set':
+                    target[operation][path] = value
+                else:
+                    items = current['$each'] if operation == '$addToSet' else current
+                    items.extend(x for x in (value['$each'] if operation == '$addToSet' else value) if x not in items)
+        return target
+
+    def _mark_tags_changed(self, update, tag_ids):
+        fields = self.build_tags_changed_fields(tag_ids)
+        if fields:
+            update.setdefault('$set', {}).update(fields)
+        return update
+
+    def _get_inheritable_tags(self):
+        return self._get_tag_set('inheritable', self._blackboard.tag_manager.get_inheritable_tags)
+
+    def _get_control_tags(self):
+        return self._get_tag_set('control', self._blackboard.tag_manager.get_control_tags)
+
+    def _get_tag_set(self, kind, read):
+        # The ids of the tags of a kind are read with one query, and kept until the tags change
+        tag_version = getattr(self._blackboard.tag_manager, 'version', None)
+        cached = self._tag_sets.get(kind)
+        if cached is None or cached[0] != tag_version or tag_version is None:
+            cached = self._tag_sets[kind] = (tag_version, set(read()))
+        return cached[1]
 
     def _build_date_query(self, qdv):
         query, date, value = qdv
@@ -58,7 +210,8 @@ class QueryBuilder():
         field = doc_m.doc_control_tags if (tag_m.tag_control in full_tag and full_tag[tag_m.tag_control]) else doc_m.doc_tags
         if field in query and "$exists" in query[field]: del query[field]
 
-        q = query.get(field, {value : [int(full_tag[tag_m.tag_id])]})
+        q = query.get(field, {})
+        q.setdefault(value, [])
         if int(full_tag[tag_m.tag_id]) not in q[value]:
             q[value].append(int(full_tag[tag_m.tag_id]))
 
@@ -70,16 +223,78 @@ class QueryBuilder():
 
     def _append_list_fields(self, updated_fields):
         keys = [key for key, value in updated_fields.items() if (key in self._blackboard.document_manager.array_fields or isinstance(value, list))]
-        return {key : {'$each' : self._listify(updated_fields.pop(key))} for key in keys}
-
-    def _listify(self, obj):
-        return obj if isinstance(obj,list) else [obj]
+        return {key : {'$each' : listify(updated_fields.pop(key))} for key in keys}
 
     def _argument_is_list(self, argument):
         if not isinstance(argument,list):
             raise ValueError('Argument needs to be a list: {}'.format(argument))
         return True
 
+class LRUCache():
+    '''Bounded mapping which discards the least recently used entry once it holds **maxsize** entries.'''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits, self.misses = 0, 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._entries.pop(key, default)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+class TTLCache(LRUCache):
+    '''Bounded mapping which discards the least recently used entry once it holds **maxsize** entries,
+    and entries which were put more than **ttl** seconds ago.'''
+
+    def __init__(self, maxsize=1024, ttl=300.0):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        if not self._expire(key):
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key][1]
+
+    def put(self, key, value):
+        super().put(key, (time.monotonic() + self.ttl, value))
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __contains__(self, key):
+        return self._expire(key)
+
+    def _expire(self, key):
+        if key in self._entries and self._entries[key][0] <= time.monotonic():
+            del self._entries[key]
+        return key in self._entries
+
 def java_string_hashcode(string):
     '''Generate a hash from a string that is equivalent to Java's String.hashCode() function.'''
     hsh = 0
@@ -87,21 +302,264 @@ def java_string_hashcode(string):
         hsh = (31 * hsh + ord(char)) & 0xFFFFFFFF
     return ((hsh + 0x80000000) & 0xFFFFFFFF) - 0x80000000
 
+def split_id_range(lower, upper, splits):
+    '''Split the id range between **lower** and **upper** into **splits** parts, returning the inner boundaries.
+
+    Integer ids are split evenly by value and :class:`ObjectId` ids evenly by their timestamp.
+    Any other id type cannot be split and yields no boundaries.
+    '''
+    if isinstance(lower, ObjectId) and isinstance(upper, ObjectId):
+        start, end = lower.generation_time.timestamp(), upper.generation_time.timestamp()
+        bounds = [ObjectId.from_datetime(datetime.utcfromtimestamp(start + (end - start) * i / splits)) for i in range(1, splits)]
+    elif isinstance(lower, int) and isinstance(upper, int):
+        bounds = [lower + ((upper - lower) * i) // splits for i in range(1, splits)]
+    else:
+        return []
+    return sorted(set(bound for bound in bounds if lower < bound <= upper))
+
+intervals = {'year' : relativedelta(years=1), 'month' : relativedelta(months=1), 'week' : timedelta(weeks=1), 'day' : timedelta(days=1)}
+
+def interval_boundaries(start, end, interval):
+    '''Return the start of each **interval** ('year', 'month', 'week' or 'day') overlapping **start** to **end**, followed by the end of the last one.
+
+    Weeks start on Mondays, and the boundaries are aligned to the calendar rather than to **start**.
+    '''
+    if interval not in intervals:
+        raise ValueError('Interval must be one of {}: {}'.format(sorted(intervals), interval))
+    current = datetime(start.year, 1 if interval == 'year' else start.month, 1 if interval in ['year', 'month'] else start.day)
+    current -= timedelta(days=current.weekday()) if interval == 'week' else timedelta(0)
+    bounds = [current]
+    while current < end:
+        current += intervals[interval]
+        bounds.append(current)
+    return bounds
+
+partition_key_formats = OrderedDict([('week', '%Y%m%d'), ('month', '%Y%m'), ('year', '%Y')])
+
+def partition_key(date, granularity):
+    '''Return the key of the 'year', 'month' or 'week' partition holding **date** (e.g. 2017, 201703 or 20170306).
+
+    Week partitions are keyed by the date of the Monday they start on.
+    '''
+    if granularity not in partition_key_formats:
+        raise ValueError('Partitioning must be one of {}: {}'.format(list(partition_key_formats), granularity))
+    start = interval_boundaries(date.replace(tzinfo=None), date.replace(tzinfo=None), granularity)[0]
+    return int(start.strftime(partition_key_formats[granularity]))
+
+def partition_range(key):
+    '''Return the start and end :class:`datetime` of the partition with the given key, which has 4, 6 or 8 digits.'''
+    granularity = {4 : 'year', 6 : 'month', 8 : 'week'}[len(str(key))]
+    start = datetime.strptime(str(key), partition_key_formats[granularity])
+    return (start, start + intervals[granularity])
+
+def run_concurrently(func, items, max_workers=16):
+    '''Call **func** on each of the **items** in a pool of threads, returning the results in the same order.'''
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(len(items), max_workers)) as executor:
+        return list(executor.map(func, items))
+
+def wilson_interval(successes, trials, z=1.96):
+    '''Get the Wilson score interval (lower, upper) for the proportion of **successes** in a sample of **trials**.'''
+    if trials == 0:
+        return (0.0, 1.0)
+    p, z2 = successes / trials, z * z
+    centre = (p + z2 / (2 * trials)) / (1 + z2 / trials)
+    spread = z * ((p * (1 - p) / trials + z2 / (4 * trials * trials)) ** 0.5) / (1 + z2 / trials)
+    return (max(0.0, centre - spread), min(1.0, centre + spread))
+
+def allocate_sample(n, counts):
+    '''Split a sample of **n** between groups in proportion to their **counts**, using the largest remainders.'''
+    total = sum(counts)
+    if total <= n:
+        return list(counts)
+    shares = [n * count / total for count in counts]
+    sizes = [int(share) for share in shares]
+    for index in sorted(range(len(counts)), key=lambda i: sizes[i] - shares[i])[:n - sum(sizes)]:
+        sizes[index] += 1
+    return sizes
+
+def period_index_expression(field, boundaries, lower, upper):
+    '''Build an aggregation expression giving the index of the period of **boundaries** containing **field**.
+
+    The expression is a balanced tree of comparisons, so only needs :class:`ObjectId` comparisons
+    and works on servers without date conversion operators. Only periods **lower** to **upper** are considered.
+    '''
+    if upper - lower <= 1:
+        return lower
+    middle = (lower + upper) // 2
+    return {'$cond' : [{'$lt' : [field, ObjectId.from_datetime(boundaries[middle])]},
+        period_index_expression(field, boundaries, lower, middle), period_index_expression(field, boundaries, middle, upper)]}
+
+def listify(obj):
+    '''Wrap a single value in a list, e.g. a tag id given for a list of tags, leaving lists as they are.'''
+    return obj if isinstance(obj, list) else [obj]
+
+def match(doc, query):
+    '''Check whether a document matches a MongoDB query, evaluated on the client.
+
+    Supports the logical operators $and, $or and $nor and the field operators $eq, $ne, $gt, $gte, $lt, $lte, $in,
+    $nin, $all, $exists, $size, $not, $elemMatch and $regex, on top-level and dotted field paths.
+    As on the server, a condition on an array field matches if the array or any of its elements matches.
+
+    Raises:
+        :class:`ValueError`: If the query uses an unsupported operator.
+
+    Example:
+        >>> match({'Tg' : [1, 2]}, {'Tg' : {'$all' : [1], '$nin' : [3]}})
+        True
+    '''
+    for key, condition in query.items():
+        if key == '$and':
+            matched = all(match(doc, sub_query) for sub_query in condition)
+        elif key == '$or':
+            matched = any(match(doc, sub_query) for sub_query in condition)
+        elif key == '$nor':
+            matched = not any(match(doc, sub_query) for sub_query in condition)
+        elif key.startswith('$'):
+            raise ValueError('Unsupported query operator: {}'.format(key))
+        else:
+            matched = _match_condition(resolve_path(doc, key.split('.')), condition)
+        if not matched:
+            return False
+    return True
+
+def project(doc, projection):
+    '''Apply a MongoDB projection of top-level fields (a list of fields, or a dict of inclusions or exclusions) to a document.'''
+    if not projection:
+        return doc
+    if not isinstance(projection, Mapping):
+        projection = {field : 1 for field in projection}
+    fields = {field : value for field, value in projection.items() if field != '_id'}
+    include_id = projection.get('_id', True)
+    if any(fields.values()):
+        return {key : value for key, value in doc.items() if key in fields or (key == '_id' and include_id)}
+    return {key : value for key, value in doc.items() if key not in fields and (key != '_id' or include_id)}
+
+def resolve_path(value, path):
+    '''Get the values at a field path (a list of keys) of a document, descending into arrays like a MongoDB query.'''
+    if not path:
+        return [value]
+    if isinstance(value, list):
+        if path[0].isdigit():
+            return resolve_path(value[int(path[0])], path[1:]) if int(path[0]) < len(value) else []
+        return [found for item in value if isinstance(item, Mapping) for found in resolve_path(item, path)]
+    return resolve_path(value[path[0]], path[1:]) if isinstance(value, Mapping) and path[0] in value else []
+
+def is_operator_condition(condition):
+    '''Check whether a query condition is a dict of operators (e.g. ``{'$gt' : 1}``) rather than a value to match.'''
+    return isinstance(condition, Mapping) and len(condition) > 0 and all(key.startswith('$') for key in condition)
+
+def _match_condition(values, condition):
+    if is_operator_condition(condition):
+        return all(_match_operator(values, operation, argument, condition) for operation, argument in condition.items())
+    return _equals_any(values, condition)
+
+def _match_operator(values, operation, argument, condition):
+    candidates = [item for value in values for item in ([value] + value if isinstance(value, list) else [value])]
+    if operation == '$eq':
+        return _equals_any(values, argument)
+    if operation == '$ne':
+        return not _equals_any(values, argument)
+    if operation in _comparisons:
+        return any(_compare(candidate, argument, _comparisons[operation]) for candidate in candidates)
+    if operation == '$in':
+        return any(_equals_any(values, item) for item in argument)
+    if operation == '$nin':
+        return not any(_equals_any(values, item) for item in argument)
+    if operation == '$all':
+        return len(argument) > 0 and all(_equals_any(values, item) for item in argument)
+    if operation == '$exists':
+        return bool(values) == bool(argument)
+    if operation == '$size':
+        return any(isinstance(value, list) and len(value) == argument for value in values)
+    if operation == '$not':
+        return not _match_condition(values, argument)
+    if operation == '$elemMatch':
+        return any(_match_condition([item], argument) if is_operator_condition(argument) else isinstance(item, Mapping) and match(item, argument)
+            for value in values if isinstance(value, list) for item in value)
+    if operation == '$regex':
+        pattern = re.compile(argument, _regex_flags(condition.get('$options', ''))) if isinstance(argument, str) else argument
+        return any(isinstance(candidate, str) and pattern.search(candidate) is not None for candidate in candidates)
+    if operation == '$options':
+        return True
+    raise ValueError('Unsupported query operator: {}'.format(operation))
+
+def _equals_any(values, argument):
+    if not values:
+        return argument is None
+    for value in values:
+        if value == argument or (isinstance(value, list) and any(_equals(item, argument) for item in value)) or _equals(value, argument):
+            return True
+    return False
+
+def _equals(value, argument):
+    if hasattr(argument, 'search') and isinstance(value, str):
+        return argument.search(value) is not None
+    return value == argument
+
+def _compare(value, argument, comparison):
+    try:
+        return comparison(value, argument)
+    except TypeError:
+        return False
+
+def _regex_flags(options):
+    return sum(flag for option, flag in [('i', re.IGNORECASE), ('m', re.MULTILINE), ('s', re.DOTALL), ('x', re.VERBOSE)] if option in options)
+
+_comparisons = {'$gt' : lambda a, b: a > b, '$gte' : lambda a, b: a >= b, '$lt' : lambda a, b: a < b, '$lte' : lambda a, b: a <= b}
+
+_raw_array = 0x04
+_raw_fixed_sizes = {0x01 : 8, 0x06 : 0, 0x07 : 12, 0x08 : 1, 0x09 : 8, 0x0A : 0, 0x10 : 4, 0x11 : 8, 0x12 : 8, 0x13 : 16, 0x7F : 0, 0xFF : 0}
+
+def scan_raw(doc):
+    '''Map each top-level field of a RawBSONDocument to its BSON type and the (start, end) offsets of its element, without decoding the values.'''
+    data, elements, pos = doc.raw, OrderedDict(), 4
+    while data[pos]:
+        start, kind = pos, data[pos]
+        end = data.index(b'\x00', pos + 1)
+        name, pos = data[pos + 1:end].decode('utf-8'), end + 1
+        if kind in _raw_fixed_sizes:
+            pos += _raw_fixed_sizes[kind]
+        elif kind == 0x0B:
+            pos = data.index(b'\x00', data.index(b'\x00', pos) + 1) + 1
+        else:
+            # Documents, arrays and code with scope count their own length, strings, binaries and pointers follow it
+            size = struct.unpack_from('<i', data, pos)[0]
+            pos += {0x03 : size, 0x04 : size, 0x0F : size, 0x05 : 5 + size, 0x0C : 16 + size}.get(kind, 4 + size)
+        elements[name] = (kind, start, pos)
+    return elements
+
+def split_raw(doc, fields):
+    '''Split a RawBSONDocument into a dict of the decoded **fields** it has, and a RawBSONDocument of its other fields which are not decoded.'''
+    data, elements = doc.raw, scan_raw(doc)
+    spans = [[span for name, (_, *span) in elements.items() if (name in fields) == selected] for selected in [True, False]]
+    decoded, rest = [struct.pack('<i', sum(end - start for start, end in parts) + 5) + b''.join(data[start:end] for start, end in parts) + b'\x00' for parts in spans]
+    return bson.decode(decoded), RawBSONDocument(rest)
+
+def extend_raw(doc, fields):
+    '''Add the fields of a dict to a RawBSONDocument, without decoding it. The fields must not already be in the document.'''
+    if not fields:
+        return doc
+    data, extra = doc.raw, bson.encode(fields)
+    return RawBSONDocument(struct.pack('<i', len(data) + len(extra) - 5) + data[4:-1] + extra[4:])
+
+def is_mocking(collection):
+    '''Check whether a collection is from the mocking library, to work around the places where it differs from a database server.'''
+    return isinstance(collection, mongomock.Collection)
+
 def suppress_print_if_mocking(func):
-    '''Decorator to skip printing anything in a method if we are using mocking.
+    '''Decorator to skip printing anything in a method if we are using mocking or an in-memory backend.
 
     Useful when working with indexes as they are not implemented in the mocking library.
     '''
     @wraps(func)
     def wrap(*args, **kwargs):
-        if isinstance(args[0]._collection, mongomock.Collection):
-            with open(os.devnull, "w") as devnull:
-                old_stdout = sys.stdout
-                sys.stdout = devnull
-            try:  
-                yield
-            finally:
-                sys.stdout = old_stdout
+        collection = args[1] if len(args) > 1 else args[0]._collection
+        if is_mocking(collection) or getattr(collection, 'in_memory', False):
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                return func(*args, **kwargs)
         return func(*args, **kwargs)
     return wrap
 
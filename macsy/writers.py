@@ -0,0 +1,153 @@
+'''Writers queue changes to the documents of a blackboard locally and write them back in bulk.'''
+
+import time
+from collections import namedtuple, OrderedDict
+from macsy.utils import listify
+
+WriteFailure = namedtuple('WriteFailure', ['doc_id', 'update', 'code', 'message'])
+WriteFailure.__doc__ = '''A queued update which the database rejected when it was flushed.
+
+    The **update** is the coalesced update document which was sent for the document with id **doc_id**.
+'''
+
+class BufferedBlackboard():
+    '''Write-behind wrapper for a blackboard, which queues updates and tag changes and flushes them in bulk.
+
+    All the changes queued for a document are coalesced: field updates are merged (the last value of a field wins,
+    and list fields are combined), and adding then removing a tag (or the reverse) leaves only the last operation.
+    Each document's changes are then flushed as a single update where possible, in unordered bulk writes grouped by collection.
+
+    The queue is flushed when **max_docs** documents have changes queued, when a change is queued more than **max_delay**
+    seconds after the last flush, when :meth:`flush` is called, and when leaving the ``with`` block.
+    Any other attributes are read from the wrapped blackboard, so reads such as
+    :meth:`find()<macsy.blackboards.Blackboard.find>` do not see changes until they are flushed.
+
+    Example:
+        >>> with blackboard.buffered(max_docs=1000) as writer:
+        >>> ... for doc in blackboard.find(tags=['Tag_1']):
+        >>> ...     writer.add_tag(doc['_id'], 2)
+        >>> ...     writer.update(doc['_id'], {'Checked' : True})
+        >>> print(writer.errors)
+    '''
+
+    def __init__(self, blackboard, max_docs=1000, max_delay=5.0):
+        '''Constructor for the BufferedBlackboard.
+
+        Args:
+            blackboard (:class:`Blackboard<macsy.blackboards.Blackboard>`): the blackboard to write to.
+            max_docs (:class:`int`, optional): number of documents with queued changes which triggers a flush.
+            max_delay (:class:`float`, optional): seconds after the last flush at which the next change triggers a flush.
+        '''
+        self.blackboard = blackboard
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self.errors = []
+        self.matched, self.modified = 0, 0
+        self._pending = OrderedDict()
+        self._flushed = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.blackboard, name)
+
+    def update(self, doc_id, updated_fields):
+        '''Queue an update of the fields of a document.
+
+        Args:
+            doc_id (:class:`ObjectId` or :class:`int`): id of the document to update.
+            updated_fields (:class:`dict`): dictionary containing the fields to be updated, along with their new values.
+
+        Returns:
+            :class:`ObjectId` or :class:`int`: id of the document.
+        '''
+        array_fields = self.blackboard.document_manager.array_fields
+        fields = self._get_changes(doc_id)['fields']
+        for key, value in updated_fields.items():
+            if key == self.blackboard.document_manager.doc_id:
+                continue
+            if key in array_fields or isinstance(value, list):
+                current = fields.setdefault(key, [])
+                current.extend(x for x in listify(value) if x not in current)
+            else:
+                fields[key] = value
+        return self._queued(doc_id)
+
+    def add_tag(self, doc_id, tag_id):
+        '''Queue the annotation of a document with a given tag or tags.
+
+        Args:
+            doc_id (:class:`ObjectId` or :class:`int`): id of the document to annotate.
+            tag_id (:class:`int` or :class:`list[int]`): tag id or list of tag ids to annotate the document with.
+
+        Returns:
+            :class:`ObjectId` or :class:`int`: id of the document.
+        '''
+        return self._queue_tags(doc_id, tag_id, 'add_tags', 'remove_tags')
+
+    def remove_tag(self, doc_id, tag_id):
+        '''Queue the removal of tag annotations from a document.
+
+        Args:
+            doc_id (:class:`ObjectId` or :class:`int`): id of the document to remove annotations from.
+            tag_id (:class:`int` or :class:`list[int]`): tag id or list of tag ids to remove from the document.
+
+        Returns:
+            :class:`ObjectId` or :class:`int`: id of the document.
+        '''
+        return self._queue_tags(doc_id, tag_id, 'remove_tags', 'add_tags')
+
+    def flush(self):
+        '''Write all the queued changes to the blackboard.
+
+        Failed updates are added to :attr:`errors` as :class:`WriteFailure` entries. If the bulk write itself raises
+        (e.g. the connection drops), the changes stay queued, so the next flush retries them.
+
+        Returns:
+            :class:`list[WriteFailure]`: the updates which failed in this flush.
+        '''
+        doc_manager = self.blackboard.document_manager
+        updates = [(doc_id, update) for doc_id, changes in self._pending.items() \
+            for update in doc_manager.get_changes_updates(doc_id, changes)]
+        self._flushed = time.time()
+        if not updates:
+            self._pending.clear()
+            return []
+        result = doc_manager.bulk_update(updates)
+        self._pending.clear()
+        failures = [_get_write_failure(error, doc_manager.doc_id) for error in result['errors']]
+        self.matched, self.modified = self.matched + result['matched'], self.modified + result['modified']
+        self.errors.extend(failures)
+        return failures
+
+    @property
+    def pending(self):
+        ''':class:`int`: number of documents with changes waiting to be flushed.'''
+        return len(self._pending)
+
+    def _get_changes(self, doc_id):
+        if doc_id not in self._pending:
+            self._pending[doc_id] = {'fields' : {}, 'add_tags' : [], 'remove_tags' : []}
+        return self._pending[doc_id]
+
+    def _queue_tags(self, doc_id, tag_id, key, opposite):
+        changes = self._get_changes(doc_id)
+        for tag in listify(tag_id):
+            if tag in changes[opposite]:
+                changes[opposite].remove(tag)
+            if tag not in changes[key]:
+                changes[key].append(tag)
+        return self._queued(doc_id)
+
+    def _queued(self, doc_id):
+        if len(self._pending) >= self.max_docs or time.time() - self._flushed >= self.max_delay:
+            self.flush()
+        return doc_id
+
+def _get_write_failure(error, doc_id_field):
+    operation = error.get('op', {})
+    return WriteFailure(operation.get('q', {}).get(doc_id_field), operation.get('u'), error.get('code'), error.get('errmsg'))
@@ -13,7 +13,8 @@ setup(
     url="https://github.com/uob-mediapatterns/macsy",
     packages=find_packages(exclude=['test']),
     install_requires=[
-        'pymongo==3.5.1',
+        'pymongo==3.10.1',
         'python-dateutil',
+        'numpy',
     ]
 )
@@ -1,14 +1,27 @@
 import sys
 import os.path
 import mongomock
+from copy import deepcopy
+from functools import wraps
 home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
 sys.path.insert(0, home)
 from datetime import datetime
 from bson.objectid import ObjectId
 from macsy.api import BlackboardAPI
+from macsy.backends import MemoryClient
 from macsy.blackboards import Blackboard, DateBasedBlackboard
 from macsy.managers import TagManager, DocumentManager, CounterManager
 
+def _copy_found(find_one):
+    # The mocking library's projected documents share their lists with the stored ones, so an update made after the
+    # find (e.g. by find_one_and_update, returning the document before the update) changes them, unlike on a server
+    @wraps(find_one)
+    def wrapper(self, *args, **kwargs):
+        return deepcopy(find_one(self, *args, **kwargs))
+    return wrapper
+
+mongomock.Collection.find_one = _copy_found(mongomock.Collection.find_one)
+
 def mock_client(*args, **kwargs):
     client = mongomock.MongoClient(*args, **kwargs)
     db = client['testdb']
@@ -19,6 +32,16 @@ def mock_client(*args, **kwargs):
 
     return client
 
+def memory_client(*args, **kwargs):
+    client = MemoryClient(*args, **kwargs)
+    db = client['testdb']
+
+    generate_date_based_blackboard(db,'ARTICLE')
+    generate_date_based_blackboard(db,'ARTICLE2')
+    generate_standard_blackboard(db,'FEED')
+
+    return client
+
 def settings():
     return {'user' : 'test_user', 'password' : 'password', 'dbname' : 'testdb', 'dburl' : 'mongodb://localhost:27017'}
 
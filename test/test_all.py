@@ -3,13 +3,22 @@ import os.path
 home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
 sys.path.insert(0, home)
 import unittest
+from test.test_archives import TestArchives
+from test.test_backends import TestBackends, TestMemoryBlackboards, TestMemoryDateBasedBlackboards
+from test.test_bitmaps import TestBitmaps
 from test.test_blackboards import TestBlackboards
 from test.test_date_based_blackboards import TestDateBasedBlackboards
+from test.test_inheritance import TestInheritance
+from test.test_joins import TestJoins
 from test.test_blackboard_api import TestBlackboardAPI
 from test.test_managers import TestManagers
+from test.test_mappers import TestMappers
+from test.test_replicas import TestReplicas
+from test.test_schedulers import TestSchedulers
+from test.test_writers import TestWriters
 
 if __name__ == '__main__':
-    test_classes = [TestBlackboardAPI, TestBlackboards, TestDateBasedBlackboards, TestManagers]
+    test_classes = [TestArchives, TestBackends, TestBitmaps, TestBlackboardAPI, TestBlackboards, TestDateBasedBlackboards, TestInheritance, TestJoins, TestManagers, TestMemoryBlackboards, TestMemoryDateBasedBlackboards, TestMappers, TestReplicas, TestSchedulers, TestWriters]
     loader = unittest.TestLoader()
     suites_list = []
     for test_class in test_classes:
@@ -0,0 +1,121 @@
+import re
+import sys
+import os.path
+import tempfile
+import unittest
+from unittest import mock
+home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
+sys.path.insert(0, home)
+from datetime import datetime
+from bson import ObjectId
+from test import mock_data_generator
+from macsy.api import BlackboardAPI
+from macsy.archives import PartitionArchive, write_archive, remove_archive, id_bounds
+from macsy.cursors import BlackboardCursor
+from macsy.utils import match, project
+
+class TestArchives(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.api = BlackboardAPI(mock_data_generator.admin_settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('ARTICLE')
+
+    def tearDown(self):
+        self.dir.cleanup()
+        del self.api
+        del self.bb
+
+    def test_match(self):
+        doc = {'_id' : 5, 'T' : 'Title 5', 'Tg' : [5, 4], 'FOR' : [], 'Sub' : {'N' : 2}, 'Items' : [{'N' : 1}, {'N' : 3}]}
+        self.assertTrue(match(doc, {'Tg' : {'$all' : [4], '$nin' : [6]}, 'T' : {'$exists' : True}}))
+        self.assertTrue(match(doc, {'Tg' : 5, 'Sub.N' : {'$gte' : 2}, 'Items.N' : 3, 'Missing' : None}))
+        self.assertTrue(match(doc, {'$or' : [{'Tg' : 6}, {'T' : re.compile('^title', re.I)}], 'Items' : {'$elemMatch' : {'N' : {'$gt' : 2}}}}))
+        self.assertTrue(match(doc, {'$and' : [{'_id' : {'$gt' : 4}}, {'_id' : {'$lt' : 6}}], 'FOR' : {'$size' : 0}, 'T' : {'$regex' : '5$'}}))
+        self.assertFalse(match(doc, {'Tg' : {'$all' : [5, 6]}}))
+        self.assertFalse(match(doc, {'Tg' : {'$ne' : 4}}))
+        self.assertFalse(match(doc, {'$nor' : [{'Sub.N' : 2}]}))
+        self.assertFalse(match(doc, {'Tg' : {'$not' : {'$in' : [1, 5]}}}))
+        self.assertFalse(match(doc, {'_id' : {'$gt' : 'a string'}}))
+        with self.assertRaises(ValueError): match(doc, {'$where' : 'true'})
+        with self.assertRaises(ValueError): match(doc, {'T' : {'$text' : 'Title'}})
+
+        self.assertEqual(project(doc, {'T' : 1}), {'_id' : 5, 'T' : 'Title 5'})
+        self.assertEqual(project(doc, ['T']), {'_id' : 5, 'T' : 'Title 5'})
+        self.assertEqual(sorted(project(doc, {'Sub' : 0, 'Items' : 0, '_id' : 0})), ['FOR', 'T', 'Tg'])
+        self.assertEqual(id_bounds({'$and' : [{'_id' : {'$gte' : 2, '$lt' : 9}}, {'_id' : {'$in' : [3, 10]}}]}), (3, 9))
+        self.assertEqual(id_bounds({'Tg' : 1}), (None, None))
+
+    def test_write_archive(self):
+        path = os.path.join(self.dir.name, 'docs')
+        archive = write_archive(({'_id' : i, 'N' : i % 3} for i in range(25)), path, 'DOCS', chunk_size=10)
+        self.assertEqual((archive.name, archive.estimated_document_count(), len(archive.get_chunks())), ('DOCS', 25, 3))
+        self.assertEqual([chunk['n'] for chunk in archive.get_chunks({'_id' : {'$gte' : 12, '$lt' : 15}})], [10])
+        self.assertEqual([doc['_id'] for doc in archive.find({'_id' : {'$gte' : 8}, 'N' : 0}).sort('_id', -1).limit(3)], [24, 21, 18])
+        self.assertEqual(archive.find({'N' : 1}).count(), 8)
+        self.assertEqual(archive.find_one({'_id' : 7}, {'N' : 1}), {'_id' : 7, 'N' : 1})
+        with self.assertRaises(ValueError): archive.find().sort('N', 1)
+        with self.assertRaises(FileExistsError): write_archive([], path, 'DOCS')
+        self.assertIsNone(write_archive([], os.path.join(self.dir.name, 'empty'), 'EMPTY').find_one())
+        self.assertEqual(PartitionArchive(path).find({'_id' : {'$in' : [3, 4]}}).count(), 2)
+        open(os.path.join(self.dir.name, 'empty', 'notes.txt'), 'w').close()
+        remove_archive(os.path.join(self.dir.name, 'empty'))
+        self.assertEqual(os.listdir(os.path.join(self.dir.name, 'empty')), ['notes.txt'])
+
+        # Returned documents are copies of the cached chunks
+        archive.find_one({'_id' : 7})['N'] = 10
+        self.assertEqual(archive.find_one({'_id' : 7})['N'], 1)
+
+        # A limited read only decompresses the chunks it reaches, as archived sources are not counted up front
+        with mock.patch.object(PartitionArchive, '_read_chunk', side_effect=PartitionArchive(path)._read_chunk) as read_chunk:
+            self.assertEqual([doc['_id'] for doc in BlackboardCursor(([PartitionArchive(path).find({'N' : 0})], 2, None))], [0, 3])
+            self.assertEqual(read_chunk.call_count, 1)
+
+    def test_archive_and_restore(self):
+        total, tagged, latest = self.bb.count(), self.bb.count(tags=[1]), [doc['_id'] for doc in self.bb.find(max=3)]
+        path = os.path.join(self.dir.name, 'ARTICLE_2009')
+        self.assertEqual(self.bb.archive(2009, path, chunk_size=1), 1)
+        self.assertEqual(self.bb.archive(2010, os.path.join(self.dir.name, 'ARTICLE_2010')), 1)
+        with self.assertRaises(ValueError): self.bb.archive(2009, path)
+
+        # A partition written to while it is archived keeps its collection, and the archive is removed so it can be retried
+        retry_path = os.path.join(self.dir.name, 'ARTICLE_2011')
+        coll = self.bb.document_manager._collections[2011]
+        with mock.patch.object(type(coll), 'count_documents', return_value=2):
+            with self.assertRaises(RuntimeError): self.bb.archive(2011, retry_path)
+        self.assertFalse(os.path.exists(retry_path))
+        self.assertEqual(self.bb.archive(2011, retry_path), 1)
+        self.assertEqual(self.bb.restore(2011), 1)
+        self.assertNotIn('ARTICLE_2009', self.api._BlackboardAPI__db.list_collection_names())
+        self.assertEqual(self.api.get_catalog().get('ARTICLE').archives, {2009 : os.path.abspath(path), 2010 : os.path.abspath(os.path.join(self.dir.name, 'ARTICLE_2010'))})
+
+        # Archived documents are still read, by a reloaded blackboard too
+        self.bb = self.api.load_blackboard('ARTICLE')
+        self.assertEqual((self.bb.count(), self.bb.count(tags=[1])), (total, tagged))
+        self.assertEqual([doc['_id'] for doc in self.bb.find(max=3)], latest)
+        self.assertEqual([doc['T'] for doc in self.bb.find(max_date=['2011-01-01'], sort=1)], ['Title 1', 'Title 2'])
+        self.assertEqual(self.bb.count(min_date=['2009-06-01'], max_date=['2010-06-01']), 1)
+        self.assertEqual(self.bb.get_earliest_date().year, 2009)
+        first = ObjectId.from_datetime(datetime(2009, 1, 1))
+        found, missing = self.bb.get_many([first, ObjectId.from_datetime(datetime(2009, 2, 1))], projection={'T' : 1})
+        self.assertEqual((found, len(missing)), ([{'_id' : first, 'T' : 'Title 1'}], 1))
+
+        # New documents for an archived year go into a new collection alongside the archive
+        self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2009, 5, 1)), 'T' : 'Late', 'Tg' : [1]})
+        self.assertEqual((self.bb.count(max_date=['2010-01-01']), self.bb.count(tags=[1])), (2, tagged + 1))
+
+        self.assertEqual(self.bb.restore(2009), 1)
+        with self.assertRaises(KeyError): self.bb.restore(2009)
+        self.assertEqual(self.bb.count(max_date=['2010-01-01']), 2)
+        self.assertEqual(self.bb.update(first, {'Restored' : True}), first)
+        self.assertEqual(list(self.api.get_catalog().get('ARTICLE').archives), [2010])
+
+        self.api = BlackboardAPI(mock_data_generator.settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('ARTICLE')
+        with self.assertRaises(PermissionError): self.bb.archive(2011, os.path.join(self.dir.name, 'ARTICLE_2011'))
+        with self.assertRaises(PermissionError): self.bb.restore(2010)
+
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestArchives)
+    unittest.TextTestRunner().run(suite)
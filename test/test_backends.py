@@ -0,0 +1,132 @@
+import sys
+import os.path
+import unittest
+import pymongo
+home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
+sys.path.insert(0, home)
+from datetime import datetime
+from bson import ObjectId, BSON
+from bson.raw_bson import RawBSONDocument
+from bson.codec_options import CodecOptions
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from test import mock_data_generator, test_blackboards, test_date_based_blackboards
+from macsy.api import BlackboardAPI
+from macsy.backends import MemoryClient
+
+class TestBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.coll = MemoryClient()['testdb']['DOCS']
+        self.coll.insert_many([{'_id' : i, 'N' : i % 3, 'Tg' : [i, i + 1], 'Sub' : {'V' : i}} for i in range(20)])
+
+    def tearDown(self):
+        del self.coll
+
+    def test_find(self):
+        self.assertEqual(self.coll.create_index([('Tg', 1), ('_id', 1)]), 'Tg_1__id_1')
+        self.assertIn('Tg_1__id_1', self.coll.index_information())
+        self.assertEqual(self.coll.database.list_collection_names(), ['DOCS'])
+        self.assertEqual([doc['_id'] for doc in self.coll.find({'Tg' : {'$all' : [3, 4]}})], [3])
+        self.assertEqual([doc['_id'] for doc in self.coll.find({'Tg' : {'$in' : [1, 19]}, '_id' : {'$gt' : 5}})], [18, 19])
+        self.assertEqual([doc['_id'] for doc in self.coll.find({'$and' : [{'_id' : {'$gte' : 4}}, {'_id' : {'$lt' : 8}}], 'N' : 1}).sort('_id', -1)], [7, 4])
+        self.assertEqual([doc['_id'] for doc in self.coll.find({'N' : 2}, sort=[('Sub.V', -1)], limit=2, skip=1)], [14, 11])
+        self.assertEqual(self.coll.find({'Sub.V' : {'$lt' : 3}}, {'N' : 1}).count(), 3)
+        self.assertEqual(self.coll.find_one(5, {'N' : 1}), {'_id' : 5, 'N' : 2})
+        self.assertEqual(self.coll.count_documents({'Tg' : 5}), 2)
+        self.assertEqual(self.coll.distinct('N', {'_id' : {'$lt' : 2}}), [0, 1])
+        self.assertIsNone(self.coll.database['EMPTY'].find_one())
+        self.assertIsInstance(self.coll.with_options(codec_options=CodecOptions(document_class=RawBSONDocument)).find_one(), RawBSONDocument)
+
+        # Returned documents are copies
+        self.coll.find_one({'_id' : 1})['N'] = 10
+        self.assertEqual(self.coll.find_one({'_id' : 1})['N'], 1)
+
+    def test_update(self):
+        self.coll.create_index('Tg')
+        self.assertEqual(self.coll.update_one({'_id' : 1}, {'$addToSet' : {'Tg' : {'$each' : [2, 7]}}, '$set' : {'Sub.V' : 'one'}}).modified_count, 1)
+        self.assertEqual(self.coll.find_one({'Tg' : 7, 'Sub.V' : 'one'})['Tg'], [1, 2, 7])
+        self.assertEqual(self.coll.update_many({'N' : 0}, {'$pullAll' : {'Tg' : [0, 3]}, '$inc' : {'N' : 5}}).modified_count, 7)
+        self.assertEqual((self.coll.count_documents({'Tg' : 3}), self.coll.count_documents({'N' : 5})), (1, 7))
+        self.assertEqual(self.coll.update({'_id' : 2}, {'$set' : {'N' : 2}}), {'n' : 1, 'nModified' : 0, 'ok' : 1.0, 'updatedExisting' : True})
+        self.assertEqual(self.coll.update_one({'_id' : 30}, {'$set' : {'N' : 0}}, upsert=True).upserted_id, 30)
+        self.assertEqual(self.coll.replace_one({'_id' : 30}, {'T' : 'New'}).modified_count, 1)
+        self.assertEqual(self.coll.find_one({'_id' : 30}), {'_id' : 30, 'T' : 'New'})
+        with self.assertRaises(DuplicateKeyError): self.coll.insert_one({'_id' : 30})
+        self.assertEqual(self.coll.delete_many({'_id' : {'$gte' : 18}}).deleted_count, 3)
+        self.assertEqual(self.coll.remove(17), {'n' : 1, 'ok' : 1.0})
+        self.assertEqual(self.coll.count_documents({'Tg' : 18}), 0)
+        # An update rejected by a unique index leaves the document as it was
+        self.coll.create_index('Sub.V', unique=True)
+        doc = self.coll.find_one({'_id' : 16})
+        with self.assertRaises(DuplicateKeyError): self.coll.update_one({'_id' : 16}, {'$set' : {'Sub.V' : 2}})
+        self.assertEqual((self.coll.find_one({'_id' : 16}), self.coll.count_documents({'Sub.V' : 16})), (doc, 1))
+        self.assertEqual(self.coll.update_one({'_id' : 16}, {'$set' : {'Sub.V' : 30}}).modified_count, 1)
+
+    def test_find_and_modify(self):
+        self.assertEqual(self.coll.find_one_and_update({'_id' : 1}, {'$addToSet' : {'Tg' : 5}}, {'Tg' : 1}), {'_id' : 1, 'Tg' : [1, 2]})
+        self.assertEqual(self.coll.find_one_and_update({'_id' : 1}, {'$pull' : {'Tg' : 1}}, {'Tg' : 1}, return_document=ReturnDocument.AFTER), {'_id' : 1, 'Tg' : [2, 5]})
+        self.assertEqual(self.coll.find_one_and_update({'_id' : 30}, {'$set' : {'N' : 3}}, upsert=True, return_document=ReturnDocument.AFTER), {'_id' : 30, 'N' : 3})
+        self.assertIsNone(self.coll.find_one_and_update({'_id' : 31}, {'$set' : {'N' : 3}}))
+        self.assertEqual(self.coll.find_one_and_replace({'_id' : 30}, {'T' : 'New'}), {'_id' : 30, 'N' : 3})
+        self.assertEqual(self.coll.find_one_and_delete({'N' : 0}, {'N' : 1}, sort=[('_id', -1)]), {'_id' : 18, 'N' : 0})
+        self.assertEqual((self.coll.find_one({'_id' : 30}), self.coll.find_one({'_id' : 18})), ({'_id' : 30, 'T' : 'New'}, None))
+
+    def test_bulk_write(self):
+        result = self.coll.bulk_write([pymongo.InsertOne({'_id' : 20}), pymongo.UpdateMany({'N' : 1}, {'$set' : {'M' : True}}),
+            pymongo.ReplaceOne({'_id' : 21}, {'N' : 0}, upsert=True), pymongo.DeleteOne({'_id' : 0})])
+        self.assertEqual((result.inserted_count, result.modified_count, result.upserted_ids, result.deleted_count), (1, 7, {2 : 21}, 1))
+        with self.assertRaises(BulkWriteError) as context:
+            self.coll.bulk_write([pymongo.InsertOne({'_id' : 1}), pymongo.UpdateOne({'_id' : 2}, {'$set' : {'M' : True}})], ordered=False)
+        self.assertEqual((len(context.exception.details['writeErrors']), context.exception.details['nModified']), (1, 1))
+
+    def test_aggregate(self):
+        pipeline = [{'$match' : {'_id' : {'$lt' : 9}}}, {'$unwind' : '$Tg'}, {'$group' : {'_id' : '$N', 'count' : {'$sum' : 1}, 'tags' : {'$addToSet' : '$Tg'}}},
+            {'$sort' : {'_id' : -1}}]
+        self.assertEqual([(doc['_id'], doc['count'], len(doc['tags'])) for doc in self.coll.aggregate(pipeline)], [(2, 6, 6), (1, 6, 6), (0, 6, 6)])
+        pipeline = [{'$project' : {'late' : {'$cond' : [{'$gte' : ['$_id', 10]}, 1, 0]}}}, {'$group' : {'_id' : None, 'late' : {'$sum' : '$late'}, 'avg' : {'$avg' : '$late'}}}]
+        self.assertEqual(list(self.coll.aggregate(pipeline)), [{'_id' : None, 'late' : 10, 'avg' : 0.5}])
+        self.assertEqual(list(self.coll.aggregate([{'$match' : {'N' : 1}}, {'$count' : 'n'}])), [{'n' : 7}])
+        self.assertEqual(len(list(self.coll.aggregate([{'$sample' : {'size' : 3}}]))), 3)
+
+class TestMemoryBlackboards(test_blackboards.TestBlackboards):
+
+    def setUp(self):
+        self.api = BlackboardAPI(mock_data_generator.settings(), MongoClient=mock_data_generator.memory_client)
+        self.bb = self.api.load_blackboard('FEED')
+
+    def test_required_indexes(self):
+        indexes = self.api._BlackboardAPI__db['FEED'].index_information()
+        self.assertEqual([index['key'] for index in indexes.values()], [[('_id', 1)]])
+
+class TestMemoryDateBasedBlackboards(test_date_based_blackboards.TestDateBasedBlackboards):
+
+    def setUp(self):
+        self.api = BlackboardAPI(mock_data_generator.settings(), MongoClient=mock_data_generator.memory_client)
+        self.bb = self.api.load_blackboard('ARTICLE')
+
+    def test_required_indexes(self):
+        doc_id = self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2020, 1, 1)), 'T' : 'New'})
+        indexes = self.api._BlackboardAPI__db['ARTICLE_2020'].index_information()
+        self.assertIn([('Tg', 1), ('_id', 1), ('oID', 1)], [index['key'] for index in indexes.values()])
+        self.assertEqual([doc['_id'] for doc in self.bb.find(query={'T' : 'New'})], [doc_id])
+
+    def test_find_raw(self):
+        docs = list(self.bb.find(raw=True, sort=1))
+        self.assertTrue(all(isinstance(doc, RawBSONDocument) for doc in docs))
+        self.assertEqual([doc['_id'] for doc in docs], [doc['_id'] for doc in self.bb.find(sort=1)])
+        self.assertEqual(len(list(self.bb.find(raw=True, max=3))), 3)
+
+        # Raw documents are written back as they were read, and raw updates still add to the list fields
+        doc_id = self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2020, 1, 1)), 'T' : 'New', 'Tg' : [1]})
+        doc = next(self.bb.find(raw=True, query={'T' : 'New'}))
+        self.assertEqual(self.bb.insert(doc), doc_id)
+        self.assertEqual((self.bb.count(), self.bb.get(doc_id)), (11, dict(doc)))
+        self.assertEqual(self.bb.update(doc_id, RawBSONDocument(BSON.encode({'_id' : doc_id, 'T' : 'Raw', 'Tg' : [9]}))), doc_id)
+        self.assertEqual(self.bb.get(doc_id, projection=['T', 'Tg']), {'_id' : doc_id, 'T' : 'Raw', 'Tg' : [1, 9]})
+
+
+if __name__ == '__main__':
+    suite = unittest.TestSuite([unittest.defaultTestLoader.loadTestsFromTestCase(test_class)
+        for test_class in [TestBackends, TestMemoryBlackboards, TestMemoryDateBasedBlackboards]])
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,79 @@
+import sys
+import os.path
+import tempfile
+import unittest
+home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
+sys.path.insert(0, home)
+from datetime import datetime
+from bson import ObjectId
+from test import mock_data_generator
+from macsy.api import BlackboardAPI
+from macsy.bitmaps import TagBitmapIndex
+
+class TestBitmaps(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.api = BlackboardAPI(mock_data_generator.admin_settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('ARTICLE')
+
+    def tearDown(self):
+        self.dir.cleanup()
+        del self.api
+        del self.bb
+
+    def test_count_and_find_ids(self):
+        for i in range(40):
+            self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2016, 1 + i % 12, 2 + i // 12)), 'T' : 'Doc {}'.format(i), 'Tg' : [1] + ([2] if i % 2 else []) + ([3] if i % 5 == 0 else [])})
+        index = self.bb.load_tag_index(self.dir.name)
+        self.assertEqual(index.get_size(), self.bb.count())
+        queries = [{'tags' : [1]}, {'tags' : [1, 2], 'without_tags' : [3]}, {'tags' : ['Tag_2']}, {'without_tags' : [1, 'FOR>Tag_11']},
+            {'tags' : [12, 3], 'min_date' : ['2016-03-01'], 'max_date' : ['2016-09-01']}, {'tags' : [1], 'max_date' : ['2016-01-01']}, {}]
+        for query in queries:
+            self.assertEqual(index.count(**query), self.bb.count(**query), query)
+            self.assertEqual(sorted(index.find_ids(**query)), sorted(doc['_id'] for doc in self.bb.find(**query)), query)
+        with self.assertRaises(ValueError): index.count(tags=[13])
+        with self.assertRaises(ValueError): index.count(query={'T' : 'Doc 1'})
+
+    def test_refresh(self):
+        index = TagBitmapIndex(self.bb, self.dir.name)
+        self.assertEqual((index.refresh(), index.refresh(), index.count(tags=[4])), (10, 0, 2))
+        doc_id = self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2018, 6, 1)), 'T' : 'Late', 'Tg' : [4]})
+        self.assertEqual((index.refresh(), index.count(tags=[4]), index.find_ids(tags=[4], min_date=['2018-01-01'])), (1, 3, [doc_id]))
+
+        # Segments are merged, and reloaded from disk
+        max_segments = TagBitmapIndex.max_segments
+        TagBitmapIndex.max_segments = 1
+        try:
+            self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2018, 7, 1)), 'T' : 'Later', 'Tg' : [4, 5]})
+            self.assertEqual(index.refresh(), 1)
+        finally:
+            TagBitmapIndex.max_segments = max_segments
+        index = TagBitmapIndex(self.bb, self.dir.name)
+        self.assertEqual(len([segment for segment in index._get_segments() if segment.key == 2018]), 1)
+        self.assertEqual((index.count(tags=[4, 5]), index.count(tags=[4], without_tags=[5])), (2, 2))
+
+        # Tags in several merged segments keep all their documents
+        TagBitmapIndex.max_segments = 1
+        try:
+            for day in range(1, 4):
+                self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2019, 1, day)), 'T' : 'Merged {}'.format(day), 'Tg' : [1, 2]})
+                self.assertEqual(index.refresh(), 1)
+        finally:
+            TagBitmapIndex.max_segments = max_segments
+        self.assertEqual([index.count(tags=[tag], min_date=['2019-01-01']) for tag in [1, 2]], [3, 3])
+
+        # Tag changes to indexed documents are only seen after a rebuild
+        self.bb.add_tag(doc_id, 5)
+        self.assertEqual((index.refresh(), index.count(tags=[5])), (0, 3))
+        self.assertEqual((index.rebuild(), index.count(tags=[5])), (15, 4))
+
+    def test_standard_blackboard(self):
+        feeds = self.api.load_blackboard('FEED')
+        index = feeds.load_tag_index(os.path.join(self.dir.name, 'FEED'))
+        self.assertEqual([index.count(tags=[3]), index.count(without_tags=[3]), index.find_ids(tags=[12], after_id=8)], [1, 9, [9, 10]])
+
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestBitmaps)
+    unittest.TextTestRunner().run(suite)
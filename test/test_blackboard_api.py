@@ -56,9 +56,14 @@ class TestBlackboardAPI(unittest.TestCase):
 
         # Test admin drop
         self.api = BlackboardAPI(mock_data_generator.admin_settings(), MongoClient=mock_data_generator.mock_client)
+        db = self.api._BlackboardAPI__db
+        for suffix in ['_BACKFILL', '_PROPAGATION', '_ROLLUPS']:
+            db['ARTICLE' + suffix].insert_one({'_id' : 'state'})
         
         self.api.drop_blackboard('ARTICLE')
         self.assertEqual(self.api.blackboard_exists(blackboards[0][0]), not blackboards[0][1])
+        # Auxiliary collections are dropped too
+        self.assertEqual([name for name in db.list_collection_names() if name.startswith('ARTICLE_')], [])
         for bb in blackboards[1:]:
             self.assertEqual(self.api.blackboard_exists(bb[0]), bb[1])
 
@@ -93,6 +98,38 @@ class TestBlackboardAPI(unittest.TestCase):
         self.assertEqual(self.api.get_blackboard_type('MISSING', date_based=True), CounterManager.counter_type_date_based)
         self.assertEqual(self.api.get_blackboard_type('MISSING', date_based=False), CounterManager.counter_type_standard)
 
+    def test_api_get_catalog(self):
+        self.api = BlackboardAPI(mock_data_generator.settings(), MongoClient=mock_data_generator.mock_client)
+        catalog = self.api.get_catalog()
+        self.assertEqual(catalog.get_names(), ['ARTICLE', 'ARTICLE2', 'FEED'])
+        info = catalog.get('ARTICLE')
+        self.assertEqual(info.type, CounterManager.counter_type_date_based)
+        self.assertEqual(list(info.collections.items())[0], (2009, 'ARTICLE_2009'))
+        self.assertEqual(len(info.collections), 10)
+        self.assertEqual(catalog.get('FEED').collections, {None : 'FEED'})
+        self.assertIsNone(catalog.get('MISSING'))
+        self.assertEqual((catalog.get_estimated_count('ARTICLE'), catalog.get_estimated_count('FEED')), (10, 10))
+        self.assertEqual(sorted(catalog.get_index_state('ARTICLE')), list(info.collections.values()))
+
+        # Year collections are matched by exact blackboard name, so ARTICLE does not include ARTICLE2's
+        blackboard = self.api.load_blackboard('ARTICLE')
+        self.assertEqual(sorted(coll.name for coll in blackboard.document_manager._collections.values()), list(info.collections.values()))
+        self.assertIs(self.api.get_catalog(refresh=True), catalog)
+
+    def test_api_catalog_shared_client(self):
+        client = mock_data_generator.mock_client()
+        self.api = BlackboardAPI(mock_data_generator.admin_settings(), MongoClient=lambda *args, **kwargs: client)
+        other = BlackboardAPI(mock_data_generator.settings(), MongoClient=lambda *args, **kwargs: client)
+        self.assertEqual((other.load_blackboard('ARTICLE').count(), other.get_catalog().get_estimated_count('ARTICLE')), (10, 10))
+
+        # Partitions created and blackboards dropped through another client are seen when loading
+        self.api.load_blackboard('ARTICLE').insert({'_id' : ObjectId.from_datetime(datetime(2030, 1, 1)), 'T' : 'New'})
+        self.assertEqual(other.load_blackboard('ARTICLE').count(), 11)
+        self.assertIn(2030, other.get_catalog().get('ARTICLE').collections)
+        self.assertTrue(other.blackboard_exists('ARTICLE2'))
+        self.api.drop_blackboard('ARTICLE2')
+        self.assertFalse(other.blackboard_exists('ARTICLE2'))
+
     def test_setting_validation(self):
         settings = {'user' : 'dbadmin', 'dbname' : 'testdb', 'dburl' : 'mongodb://localhost:27017'}
         with self.assertRaises(ValueError): self.api = BlackboardAPI(settings, MongoClient=mock_data_generator.mock_client)
@@ -5,6 +5,7 @@ import unittest
 import mongomock 
 import pymongo
 import itertools
+from unittest import mock
 home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
 sys.path.insert(0, home)
 from test import mock_data_generator
@@ -29,6 +30,7 @@ class TestBlackboards(unittest.TestCase):
         self.assertEqual(self.bb.count(query={'Nm' : 'Feed 3'}), 1)
         self.assertEqual(self.bb.count(tags = ['FOR>Tag_11', 12]), 10)
         self.assertEqual(self.bb.count(query={'BLANK' : 'Title 3'}), 0)
+        self.assertEqual(self.bb.count(tags = [12], without_tags = ['FOR>Tag_11']), 0)
 
         with self.assertRaises(ValueError): self.bb.find(tags = [1, 13])
         with self.assertRaises(ValueError): self.bb.find(tags = ['Tag_4', 13])
@@ -45,6 +47,51 @@ class TestBlackboards(unittest.TestCase):
         self.assertEqual([x for x in self.bb.find(sort = 1)][0]['_id'], 1)
         self.assertEqual([x for x in self.bb.find(sort = -1)][0]['_id'], 10)
 
+    def test_bb_find_unsorted(self):
+        self.assertEqual(sorted(x['_id'] for x in self.bb.find(sort = None)), list(range(1, 11)))
+        self.assertEqual([x['_id'] for x in self.bb.find(sort = None, tags = [3], hint = {'_id' : 1})], [3])
+        with self.assertRaises(ValueError): self.bb.find(hint = {'Tg' : 1})
+
+    def test_bb_find_keyset(self):
+        self.assertEqual([x['_id'] for x in self.bb.find(after_id = 7, sort = 1)], [8, 9, 10])
+        self.assertEqual([x['_id'] for x in self.bb.find(before_id = 4)], [3, 2, 1])
+        self.assertEqual([x['_id'] for x in self.bb.find(after_id = 2, before_id = 5)], [4, 3])
+        self.assertEqual([x['_id'] for x in self.bb.find(query = {'Single' : True}, after_id = 5)], [])
+        self.assertEqual(self.bb.count(after_id = 7), 3)
+
+        # Resume a scan from the last seen id
+        cursor = self.bb.find(sort = 1, max = 4)
+        self.assertEqual(cursor.last_id, None)
+        self.assertEqual([x['_id'] for x in cursor], [1, 2, 3, 4])
+        self.assertEqual(cursor.last_id, 4)
+        self.assertEqual([x['_id'] for x in self.bb.find(sort = 1, after_id = cursor.last_id)], [5, 6, 7, 8, 9, 10])
+
+    def test_bb_find_reopens_lost_cursor(self):
+        from macsy.cursors import BlackboardCursor
+        from pymongo.errors import CursorNotFound, AutoReconnect
+        patcher = mock.patch.object(BlackboardCursor, 'reopen_delay', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        class FailingCursor():
+            def __init__(self, cursor, error):
+                self.collection, self._cursor, self._error = cursor.collection, cursor, error
+            def count(self):
+                return self._cursor.count()
+            def __next__(self):
+                doc = next(self._cursor)
+                if doc['_id'] == 4:
+                    raise self._error
+                return doc
+
+        for error in [CursorNotFound('cursor id not found'), AutoReconnect('connection reset')]:
+            cursors, max_docs, reopen = self.bb.document_manager.find(sort = 1)
+            cursor = BlackboardCursor((FailingCursor(cursors, error), max_docs, reopen))
+            self.assertEqual([x['_id'] for x in cursor], list(range(1, 11)))
+
+        cursors, max_docs, _ = self.bb.document_manager.find(sort = 1)
+        with self.assertRaises(CursorNotFound): [x for x in BlackboardCursor((FailingCursor(cursors, CursorNotFound('lost')), max_docs, None))]
+
     def test_insert(self):
         # Generate a doc, check # of docs, insert it, check it's incremented
         obj_id = 15
@@ -93,6 +140,48 @@ class TestBlackboards(unittest.TestCase):
         self.assertEqual(self.bb.count(query={'Deleted' : False}), 0)
         self.assertEqual(self.bb.count(), expected-1)
 
+    def test_count_tags(self):
+        self.assertEqual(self.bb.count_tags(), {'Tag_{}'.format(x) : 1 for x in range(1, 11)})
+        self.assertEqual(self.bb.count_tags(fields=['Single']), {'Tag_5' : 1})
+        self.assertEqual(self.bb.count_tags(control=True, max=1), {'FOR>Tag_11' : 10, 'POST>Tag_12' : 10})
+
+    def test_get_many(self):
+        docs, missing = self.bb.get_many([3, 12, 1])
+        self.assertEqual(([doc['_id'] for doc in docs], missing), ([3, 1], [12]))
+        self.assertEqual(self.bb.get(2)['Tg'], [2])
+
+    def test_document_cache(self):
+        cache = self.bb.enable_cache(maxsize=5)
+        self.assertEqual(self.bb.get(3)['Nm'], 'Feed 3')
+        docs, missing = self.bb.get_many([3, 4, 12], projection=['Nm'])
+        self.assertEqual((docs, missing, cache.hits, cache.misses), ([{'_id' : 3, 'Nm' : 'Feed 3'}, {'_id' : 4, 'Nm' : 'Feed 4'}], [12], 1, 3))
+        docs[0]['Nm'] = 'Changed'
+        self.assertEqual(self.bb.get(3)['Nm'], 'Feed 3')
+
+        # Writes through the blackboard drop the documents they change
+        self.bb.update(3, {'Nm' : 'Feed Three'})
+        self.bb.add_tag(4, 5)
+        self.assertEqual((self.bb.get(3)['Nm'], self.bb.get(4)['Tg'], cache.misses), ('Feed Three', [4, 5], 5))
+        self.bb.update_where({'Checked' : True}, tags=[4])
+        self.assertEqual((self.bb.get(4)['Checked'], len(cache)), (True, 1))
+        self.bb.disable_cache()
+        self.assertEqual(self.bb.get(4)['Nm'], 'Feed 4')
+        self.assertEqual((cache.hits, cache.misses), (2, 6))
+
+    def test_estimate_count(self):
+        self.assertEqual(self.bb.count(approximate=True), 10)
+        estimate = self.bb.estimate_count(sample_size=5, tags=[1])
+        self.assertEqual(estimate.sampled, 5)
+        self.assertLessEqual(estimate.lower, estimate.estimate)
+        self.assertLessEqual(estimate.estimate, estimate.upper)
+        self.assertEqual(self.bb.estimate_count(sample_size=5, after_id=7).estimate, 3)
+
+    def test_count_cooccurrences(self):
+        matrix = self.bb.count_cooccurrences()
+        self.assertEqual((matrix.get('Tag_1', 'Tag_1'), matrix.get('Tag_1', 'Tag_2'), matrix.most_common()), (1, 0, []))
+        matrix = self.bb.count_cooccurrences(control=True, fields=['Single'])
+        self.assertEqual(matrix.to_dense().tolist(), [[1, 1], [1, 1]])
+
     def test_get_all_tags(self):
         self.assertEqual(len([x for x in self.bb.get_all_tags()]), 12)
         self.assertEqual([x for x in self.bb.get_all_tags()][0]['Nm'],'Tag_1')
@@ -5,15 +5,21 @@ import unittest
 import mongomock 
 import pymongo
 import itertools
+import threading
+import time
 home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
 sys.path.insert(0, home)
 from test import mock_data_generator
-from datetime import datetime
+from datetime import datetime, timedelta
+from unittest import mock
 from dateutil import parser as dtparser
 from bson.objectid import ObjectId
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
 from macsy.api import BlackboardAPI
 from macsy.blackboards import DateBasedBlackboard
-from macsy.managers import TagManager, DocumentManager, DateBasedDocumentManager, CounterManager
+from macsy.cursors import ParallelCursor
+from macsy.managers import TagManager, DocumentManager, DateBasedDocumentManager, CounterManager, CountEstimate, TagStatistics, RollupManager
 
 class TestDateBasedBlackboards(unittest.TestCase):
 
@@ -40,6 +46,8 @@ class TestDateBasedBlackboards(unittest.TestCase):
         self.assertEqual(len([x for x in self.bb.find(max_date=['02-01-2016'], tags = ['FOR>Tag_11', 12])]), 8)
         self.assertEqual(len(self.bb.find(tags = ['FOR>Tag_11', 5])), 2)
         self.assertEqual([x for x in self.bb.find(query={'T' : 'Title 3'})][0]['T'], 'Title 3')
+        self.assertEqual([sorted(x) for x in self.bb.find(projection=['T'], max=2, sort=1)], [['T', '_id']] * 2)
+        self.assertEqual(sorted(next(self.bb.find(projection={'T' : 1, '_id' : 0}))), ['T', '_id'])
 
         with self.assertRaises(ValueError): self.bb.find(tags = [1, 13])
         with self.assertRaises(ValueError): self.bb.find(tags = ['Tag_4', 13])
@@ -51,6 +59,220 @@ class TestDateBasedBlackboards(unittest.TestCase):
         self.assertEqual(len(self.bb.find(tags = ['FOR>Tag_11', 12], max = 1)), 1)
         self.assertEqual(len(self.bb.find(min_date=['01-01-2016'], tags = ['FOR>Tag_11', 12], max = 2)), 2)
 
+    def test_bb_find_keyset(self):
+        ids = [x['_id'] for x in self.bb.find(sort = 1)]
+        self.assertEqual([x['_id'] for x in self.bb.find(after_id = ids[6], sort = 1)], ids[7:])
+        self.assertEqual([x['_id'] for x in self.bb.find(before_id = ids[3])], ids[2::-1])
+        self.assertEqual(len(self.bb.find(after_id = ids[1], before_id = ids[5])), 3)
+        self.assertEqual(self.bb.count(after_id = ids[6]), 3)
+        self.assertEqual(self.bb.count(after_id = ids[6], tags = [9]), 2)
+
+        # Resume a descending scan across year collections from the last seen id
+        cursor = self.bb.find(max = 4)
+        self.assertEqual([x['_id'] for x in cursor], ids[:-5:-1])
+        self.assertEqual(cursor.last_id, ids[-4])
+        self.assertEqual([x['_id'] for x in self.bb.find(before_id = cursor.last_id)], ids[-5::-1])
+
+    def test_bb_find_unsorted(self):
+        ids = [x['_id'] for x in self.bb.find(sort = 1)]
+        self.assertEqual(sorted(x['_id'] for x in self.bb.find(sort = None)), ids)
+        self.assertEqual(sorted(x['_id'] for x in self.bb.find(sort = None, tags = [9], min_date = ['2015-01-01'])), ids[8:10])
+        self.assertEqual(len(list(self.bb.find(sort = None, max = 3))), 3)
+        self.assertEqual(len(self.bb.find(sort = None)), 10)
+
+        # Hints are limited to the declared indexes
+        self.assertEqual([x['_id'] for x in self.bb.find(tags = [9], hint = {'Tg' : 1, '_id' : 1})], ids[9:7:-1])
+        self.assertEqual(self.bb.count(tags = [9], hint = [('Tg', 1), ('_id', 1), ('oID', 1)]), 2)
+        with self.assertRaises(ValueError): self.bb.find(hint = {'_id' : 1, 'Tg' : 1})
+        with self.assertRaises(ValueError): self.bb.count(hint = {'T' : 1})
+
+        # Errors reading any of the collections are raised by the cursor
+        def failing():
+            yield {'_id' : 1}
+            raise pymongo.errors.AutoReconnect('Connection lost')
+        with self.assertRaises(pymongo.errors.AutoReconnect): list(ParallelCursor([failing(), iter([{'_id' : 2}])]))
+
+        # Scans stopped early stop their reading threads
+        threads = threading.active_count()
+        with mock.patch.object(ParallelCursor, 'queue_size', 2):
+            for _ in range(5):
+                self.assertEqual(len(list(self.bb.find(sort = None, max = 1))), 1)
+            for doc in self.bb.find(sort = None):
+                break
+            del doc
+        for _ in range(50):
+            if threading.active_count() <= threads:
+                break
+            time.sleep(0.05)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_bb_tag_statistics(self):
+        stats = self.bb.refresh_tag_statistics()
+        self.assertEqual(stats.totals, {year : 1 for year in range(2009, 2019)})
+        self.assertEqual(sum(counts[('Tg', 9)] for counts in stats.counts.values()), 2)
+        self.assertEqual(sum(counts[('FOR', 11)] for counts in stats.counts.values()), 10)
+        self.assertEqual(self.bb.refresh_tag_statistics(max_age=timedelta(days=1)), stats)
+
+        # Statistics are stored with the blackboard, so reloaded blackboards plan with them too
+        self.bb = self.api.load_blackboard('ARTICLE')
+        doc_m = self.bb.document_manager
+        self.assertEqual(doc_m.get_tag_statistics().counts, stats.counts)
+        keys = [key for key in stats.totals if stats.counts[key][('Tg', 10)] == 0]
+        query, skipped, hint = doc_m._plan_query(list(stats.totals), tags=[5, 10])
+        self.assertEqual(query['Tg']['$all'], [10, 5])
+        self.assertEqual(skipped, set(key for key in stats.totals if 0 in [stats.counts[key][('Tg', 5)], stats.counts[key][('Tg', 10)]]))
+        self.assertIsNone(hint)
+        with mock.patch.object(DocumentManager, 'selective_fraction', 1.0):
+            self.assertEqual(doc_m._plan_query(list(stats.totals), tags=[10])[2], [('Tg', 1), ('_id', 1)])
+        self.assertEqual((self.bb.count(tags=[10]), len(self.bb.find(tags=[10, 5]))), (1, 0))
+
+        # Stale statistics never hide documents, as partitions are checked before being skipped
+        self.bb.insert({'_id' : ObjectId.from_datetime(datetime(keys[0], 3, 1)), 'T' : 'Late', 'Tg' : [10]})
+        self.assertEqual(self.bb.count(tags=[10]), 2)
+        self.assertEqual(len(list(self.bb.find(tags=[10], sort=None))), 2)
+
+        # Statistics older than the maximum age are recounted when the query planning reloads them
+        self.bb.document_manager._statistics = (None, None)
+        with mock.patch.object(DocumentManager, 'statistics_max_age', None):
+            self.assertEqual(self.bb.document_manager.get_tag_statistics(), stats)
+        self.bb.document_manager._statistics = (None, None)
+        with mock.patch.object(DocumentManager, 'statistics_max_age', timedelta(0)):
+            self.assertEqual(self.bb.count(tags=[10]), 2)
+        recounted = self.bb.document_manager.get_tag_statistics()
+        self.assertEqual((sum(counts[('Tg', 10)] for counts in recounted.counts.values()), recounted.totals[keys[0]]), (2, 2))
+        self.assertEqual(self.bb.counter_manager.get_tag_statistics(), recounted)
+
+    def test_bb_rollups(self):
+        with self.assertRaises(PermissionError): self.bb.enable_rollups()
+        with self.assertRaises(ValueError): self.bb.rollup_count()
+        self.api = BlackboardAPI(mock_data_generator.admin_settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('ARTICLE')
+        other = self.api.load_blackboard('ARTICLE')
+        self.assertFalse(other.rollup_manager.enabled)
+        self.assertEqual(len(self.bb.enable_rollups()), 10)
+        self.assertEqual((self.bb.rollup_count(), self.bb.rollup_count(tags=[9, 'FOR>Tag_11'])), (10, {9 : 2, 'FOR>Tag_11' : 10}))
+        self.assertEqual(self.bb.rollup_count(min_date=['2015-01-01'], max_date=['2017-01-01']), self.bb.count(min_date=['2015-01-01'], max_date=['2017-01-01']))
+        days = self.bb.rollup_count(tags=[9], by_day=True)
+        self.assertEqual([counts[9] for counts in days.values()].count(1), 2)
+        with self.assertRaises(ValueError): self.bb.rollup_count(tags=['Missing'])
+
+        # Blackboards loaded before the rollups were enabled start recording them once they read the flag again
+        with mock.patch.object(RollupManager, 'enabled_reload', 0):
+            other_id = other.insert({'_id' : ObjectId.from_datetime(datetime(2016, 6, 1)), 'T' : 'Other', 'Tg' : [9]})
+        self.assertEqual(self.bb.rollup_count(tags=[9]), {9 : 3})
+        other.delete(other_id)
+        self.assertEqual(self.bb.rollup_count(tags=[9]), {9 : 2})
+
+        # Every write through the blackboard keeps the rollups up to date
+        new_id = ObjectId.from_datetime(datetime(2016, 5, 1))
+        self.bb.insert({'_id' : new_id, 'T' : 'New', 'Tg' : [9, 10]})
+        self.bb.add_tag(new_id, 5)
+        self.bb.remove_tag(new_id, 10)
+        self.bb.update(new_id, {'Tg' : [3]})
+        self.bb.update_where({'$addToSet' : {'Tg' : 1}}, tags=[9])
+        with self.bb.buffered() as buffered:
+            buffered.remove_tag(new_id, 9)
+            buffered.add_tag(new_id, 2)
+        # A rejected update in a bulk write is not recorded
+        bulk_write = self.bb.document_manager._bulk_write
+        def reject_first(coll, requests):
+            return dict(bulk_write(coll, requests[1:]), errors=[{'index' : 0, 'code' : 2, 'errmsg' : 'Rejected'}])
+        with mock.patch.object(self.bb.document_manager, '_bulk_write', reject_first):
+            result = self.bb.document_manager.bulk_update([(new_id, {'$addToSet' : {'Tg' : 7}}), (new_id, {'$addToSet' : {'Tg' : 8}})])
+        self.assertEqual((len(result['errors']), result['modified']), (1, 1))
+        self.assertEqual(self.bb.verify_rollups(), [])
+        self.assertEqual(self.bb.rollup_count(tags=[1, 3, 9, 10]), {tag : self.bb.count(tags=[tag]) for tag in [1, 3, 9, 10]})
+        self.bb.delete(new_id)
+        self.bb.delete_where(tags=[4])
+        self.assertEqual((self.bb.verify_rollups(), self.bb.rollup_count()), ([], self.bb.count()))
+
+        # Writes made directly to the database are found and fixed by a rebuild
+        tag_id = self.bb.insert_tag('Tag_Direct')
+        self.bb.document_manager._collections[2016].update_many({}, {'$addToSet' : {'Tg' : tag_id}})
+        self.assertEqual(self.bb.verify_rollups(), [datetime(2016, 1, 1)])
+        self.assertEqual(self.bb.rebuild_rollups(), [datetime(2016, 1, 1)])
+        self.assertEqual((self.bb.verify_rollups(), self.bb.rollup_count(tags=['Tag_Direct'])), ([], {'Tag_Direct' : 1}))
+        self.bb.disable_rollups()
+        with self.assertRaises(ValueError): self.api.load_blackboard('ARTICLE').rollup_count()
+
+    def test_bb_count_tags(self):
+        expected = {'Tag_{}'.format(x) : 2 for x in range(1, 10)}
+        expected.update({'Tag_10' : 1, 0 : 1})
+        self.assertEqual(self.bb.count_tags(), expected)
+        self.assertEqual(self.bb.count_tags(control=True), {'FOR>Tag_11' : 10, 'POST>Tag_12' : 10})
+        self.assertEqual(self.bb.count_tags(min_date=['2017-01-01'], tags=[9]), {'Tag_8' : 1, 'Tag_9' : 2, 'Tag_10' : 1})
+
+    def test_bb_count_cooccurrences(self):
+        matrix = self.bb.count_cooccurrences()
+        self.assertEqual(matrix.tag_ids.tolist(), list(range(0, 11)))
+        self.assertEqual((matrix.get('Tag_4', 'Tag_5'), matrix.get(5, 4), matrix.get('Tag_4', 'Tag_6')), (1, 1, 0))
+        self.assertEqual(matrix.get('Tag_5', 'Tag_5'), 2)
+        self.assertEqual(len(matrix.most_common()), 10)
+        dense = matrix.to_dense()
+        self.assertEqual((dense.sum(), (dense == dense.T).all()), (40, True))
+
+        matrix = self.bb.count_cooccurrences(control=True, min_date=['2017-01-01'])
+        self.assertEqual(matrix.most_common(), [('FOR>Tag_11', 'POST>Tag_12', 2)])
+        self.assertEqual(matrix.get('Tag_1', 'FOR>Tag_11'), 0)
+
+    def test_bb_estimate_count(self):
+        self.assertEqual(self.bb.estimate_count(), CountEstimate(10, 10, 10, 0))
+        self.assertEqual(self.bb.count(approximate=True, min_date=['2013-01-01'], max_date=['2015-06-01']), 3)
+        self.assertEqual(self.bb.estimate_count(tags=[5]), CountEstimate(2, 2, 2, 10))
+
+        estimate = self.bb.estimate_count(sample_size=0, tags=[5])
+        self.assertEqual((estimate.estimate, estimate.lower, estimate.upper), (0, 0, 10))
+
+        # Whole collections are sampled without matching the range first, so $sample can pick documents without a scan
+        for day in range(1, 4):
+            self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2014, 3, day)), 'T' : 'Sampled {}'.format(day), 'Tg' : [5]})
+        coll, pipelines = self.bb.document_manager._collections[2014], []
+        aggregate = coll.aggregate
+        coll.aggregate = lambda pipeline: pipelines.append(pipeline) or aggregate(pipeline)
+        for min_date in ['2014-01-01', '2014-02-01']:
+            self.assertEqual(self.bb.estimate_count(sample_size=2, tags=[5], min_date=[min_date], max_date=['2015-01-01']).sampled, 2)
+        self.assertEqual([list(pipeline[0]) for pipeline in pipelines], [['$sample'], ['$match']])
+
+    def test_bb_sample(self):
+        docs = self.bb.sample(3)
+        self.assertEqual(len(set(doc['_id'] for doc in docs)), 3)
+        self.assertEqual(len(self.bb.sample(20, tags=[5])), 2)
+
+        docs = self.bb.sample(4, seed=7, min_date=['2012-01-01'])
+        self.assertEqual([doc['_id'] for doc in docs], [doc['_id'] for doc in self.bb.sample(4, seed=7, min_date=['2012-01-01'])])
+        self.assertTrue(all(doc['_id'].generation_time.year >= 2012 for doc in docs))
+
+        strata = self.bb.sample(1, stratify=['Tag_5', 9])
+        self.assertEqual(sorted(strata.keys(), key=str), [9, 'Tag_5'])
+        self.assertIn(5, strata['Tag_5'][0]['Tg'])
+        self.assertIn(9, strata[9][0]['Tg'])
+
+    def test_bb_count_by_period(self):
+        counts = self.bb.count_by_period('year')
+        self.assertEqual(list(counts.keys()), [datetime(year, 1, 1) for year in range(2009, 2019)])
+        self.assertEqual(list(counts.values()), [1] * 10)
+
+        counts = self.bb.count_by_period('month', min_date=['2016-01-01'])
+        self.assertEqual(len(counts), 25)
+        self.assertEqual(sum(counts.values()), 3)
+        self.assertEqual([period for period, count in counts.items() if count], [datetime(2016, 1, 1), datetime(2017, 1, 1), datetime(2018, 1, 1)])
+
+        counts = self.bb.count_by_period('day', min_date=['2012-12-30'], max_date=['2013-01-03'], tags=[4])
+        self.assertEqual(counts, {datetime(2012, 12, 30) : 0, datetime(2012, 12, 31) : 0, datetime(2013, 1, 1) : 1, datetime(2013, 1, 2) : 0})
+        self.assertEqual(sum(self.bb.count_by_period('week').values()), 10)
+        with self.assertRaises(ValueError): self.bb.count_by_period('fortnight')
+
+    def test_bb_count_tags_by_period(self):
+        matrix = self.bb.count_tags_by_period('year', rows=['Tag_5', 6])
+        self.assertEqual(matrix.tags, ['Tag_5', 'Tag_6'])
+        self.assertEqual(matrix.periods[0], datetime(2009, 1, 1))
+        self.assertEqual(matrix.counts.tolist(), [[0, 0, 0, 0, 1, 1, 0, 0, 0, 0], [0, 0, 0, 0, 0, 1, 1, 0, 0, 0]])
+
+        matrix = self.bb.count_tags_by_period('month', min_date=['2018-01-01'])
+        self.assertEqual(matrix.counts.shape, (2, 1))
+        self.assertEqual(sorted(matrix.tags), ['Tag_10', 'Tag_9'])
+        with self.assertRaises(ValueError): self.bb.count_tags_by_period(rows=['Missing'])
+
     def test_insert(self):
         from macsy import utils
         # Generate a doc, check # of docs, insert it, check it's incremented
@@ -74,6 +296,45 @@ class TestDateBasedBlackboards(unittest.TestCase):
         # Insert a document without an id and generate one
         self.assertEqual(self.bb.insert({'Blank_id' : True}).generation_time.date(), datetime.now().date())
 
+    def test_insert_raw(self):
+        doc = next(self.bb.find(max=1))
+        raw = RawBSONDocument(BSON.encode(dict(doc, HSH=1, Moved=True)))
+        self.assertEqual(self.bb.insert(raw), doc['_id'])
+        self.assertEqual((self.bb.count(), self.bb.count(query={'Moved' : True})), (10, 1))
+
+        obj_id = ObjectId.from_datetime(dtparser.parse('21-10-2017'))
+        self.assertEqual(self.bb.insert(RawBSONDocument(BSON.encode({'_id' : obj_id, 'T' : 'Raw'}))), obj_id)
+        self.assertEqual(next(self.bb.find(query={'T' : 'Raw'}))['Tg'], [])
+        self.assertEqual(self.bb.update(obj_id, RawBSONDocument(BSON.encode({'T' : 'Updated', 'Tg' : [1]}))), obj_id)
+        self.assertEqual(self.bb.count(query={'T' : 'Updated', 'Tg' : 1}), 1)
+
+    def test_get_many(self):
+        ids = [doc['_id'] for doc in self.bb.find(sort=1)]
+        missing_ids = [ObjectId.from_datetime(dtparser.parse('01-03-2012')), ObjectId.from_datetime(dtparser.parse('01-03-2030')), 'not-an-id']
+        docs, missing = self.bb.get_many([ids[5], missing_ids[0], ids[1], missing_ids[1], ids[8], missing_ids[2]], projection=['Tg'])
+        self.assertEqual([doc['_id'] for doc in docs], [ids[5], ids[1], ids[8]])
+        self.assertEqual(set(docs[0].keys()), {'_id', 'Tg'})
+        self.assertEqual(missing, missing_ids)
+        self.assertEqual(self.bb.get(ids[3], projection={'_id' : 0, 'Tg' : 1}), {'_id' : ids[3], 'Tg' : [4, 3]})
+        self.assertIsNone(self.bb.get(missing_ids[0]))
+
+    def test_filter_new(self):
+        first = self.bb.insert({'_id' : ObjectId.from_datetime(dtparser.parse('21-10-2017')), 'oID' : 515, 'T' : 'Title', 'D' : 'Description'})
+        second = self.bb.insert({'_id' : ObjectId.from_datetime(dtparser.parse('01-03-2012')), 'oID' : 516, 'T' : 'Title', 'D' : 'Other'})
+        docs = [{'oID' : 515, 'T' : 'Title', 'D' : 'Description'}, {'oID' : 517, 'T' : 'New'}, {'oID' : 516, 'T' : 'Title', 'D' : 'Other'}, {'oID' : 517, 'T' : 'New'}]
+        hashes = self.bb.existing_hashes(docs)
+        self.assertEqual(sorted(hashes.values()), sorted([first, second]))
+        new, existing = self.bb.filter_new(docs)
+        self.assertEqual(new, [{'oID' : 517, 'T' : 'New'}])
+        self.assertEqual([doc_id for doc, doc_id in existing], [first, second])
+        self.assertEqual(self.bb.filter_new([]), ([], []))
+
+        # The hash settings are read once per batch, not once per document
+        counter_m = self.bb.counter_manager
+        with mock.patch.object(counter_m, 'get_hash_settings', wraps=counter_m.get_hash_settings) as get_hash_settings:
+            self.bb.filter_new(docs * 10)
+        self.assertEqual(get_hash_settings.call_count, 2)
+
     def test_update(self):
         obj_id = self.bb.insert({'Overwritten' : False, 'Inserted' : True, 'Tg' : [1, 2, 3]})
         self.assertEqual(self.bb.update(obj_id, {'Overwritten' : True, 'Inserted' : False, 'Fds' : [104], 'Tg' : [1, 4, 6]}), obj_id)
@@ -99,6 +360,77 @@ class TestDateBasedBlackboards(unittest.TestCase):
         self.assertEqual(self.bb.count(query={'Deleted' : False}), 0)
         self.assertEqual(self.bb.count(), expected-1)
 
+    def test_update_where(self):
+        self.assertEqual(self.bb.update_where({'Checked' : True, 'Fds' : [7]}, tags=[5]), {'matched' : 2, 'modified' : 2})
+        self.assertEqual(self.bb.count(query={'Checked' : True, 'Fds' : 7}), 2)
+        self.assertEqual(self.bb.update_where({'$unset' : {'Checked' : 1}}, min_date=['2014-01-01']), {'matched' : 5, 'modified' : 1})
+        self.assertEqual(self.bb.count(query={'Checked' : True}), 1)
+        with self.assertRaises(ValueError): self.bb.update_where({'$unset' : {'Checked' : 1}, 'Fds' : [7]}, tags=[5])
+        self.assertEqual(self.bb.count(query={'Checked' : True}), 1)
+
+    def test_delete_where(self):
+        with self.assertRaises(PermissionError): self.bb.delete_where(tags=[5])
+        self.api = BlackboardAPI(mock_data_generator.admin_settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('ARTICLE')
+        self.assertEqual(self.bb.delete_where(tags=[5], max_date=['2014-01-01']), {'deleted' : 1})
+        self.assertEqual((self.bb.count(), self.bb.count(tags=[5])), (9, 1))
+        with self.assertRaises(ValueError): self.bb.delete_where()
+        self.assertEqual(self.bb.count(), 9)
+        self.assertEqual(self.bb.delete_where(delete_all=True), {'deleted' : 9})
+        self.assertEqual(self.bb.count(), 0)
+
+    def test_partitioning(self):
+        self.assertEqual(self.bb.get_partitioning(), 'year')
+        with self.assertRaises(PermissionError): self.bb.set_partitioning('month')
+        self.api = BlackboardAPI(mock_data_generator.admin_settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('ARTICLE')
+        with self.assertRaises(ValueError): self.bb.set_partitioning('day')
+        self.bb.set_partitioning('month')
+
+        march = self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2019, 3, 5)), 'T' : 'March'})
+        june = self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2015, 6, 1)), 'T' : 'June'})
+        info = self.api.get_catalog().get('ARTICLE')
+        self.assertEqual((info.partitioning, list(info.collections)[-2:]), ('month', [2018, 201903]))
+        self.assertEqual(self.bb.count(), 12)
+        self.assertEqual(self.bb.count(min_date=['2019-01-01']), 1)
+        self.assertEqual(self.bb.count(min_date=['2015-01-01'], max_date=['2016-01-01']), 2)
+        self.assertEqual(self.bb.add_tag(march, 1), march)
+
+        self.assertEqual(self.bb.repartition(2015), 2)
+        with self.assertRaises(ValueError): self.bb.repartition(201903, 'year')
+        self.bb = self.api.load_blackboard('ARTICLE')
+        self.assertEqual(self.bb.get_partitioning(), 'month')
+        self.assertEqual(sorted(key for key in self.bb.document_manager._collections if key > 9999), [201501, 201506, 201903])
+        self.assertEqual([doc['T'] for doc in self.bb.find(min_date=['2015-03-01'], max_date=['2019-12-01'], query={'T' : {'$in' : ['March', 'June']}})], ['March', 'June'])
+        self.assertEqual(self.bb.update(june, {'Moved' : True}), june)
+        self.assertEqual((self.bb.count(), self.bb.count(tags=[1]), self.bb.count(query={'Moved' : True})), (12, 3, 1))
+
+    def test_repartition_sets_partitioning(self):
+        self.api = BlackboardAPI(mock_data_generator.admin_settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('ARTICLE')
+        self.assertEqual(self.bb.repartition(2016, 'month'), 1)
+        self.assertEqual((self.bb.get_partitioning(), self.api.get_catalog().get('ARTICLE').partitioning), ('month', 'month'))
+        # A later document of the split year goes into a month collection, rather than recreating the year collection
+        self.bb = self.api.load_blackboard('ARTICLE')
+        self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2016, 9, 1)), 'T' : 'September'})
+        self.assertEqual(sorted(key for key in self.bb.document_manager._collections if key // 100 == 2016 or key == 2016), [201601, 201609])
+        self.assertEqual(self.bb.count(min_date=['2016-01-01'], max_date=['2017-01-01']), 2)
+
+    def test_overlapping_partitions(self):
+        self.api = BlackboardAPI(mock_data_generator.admin_settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('ARTICLE')
+        self.bb.set_partitioning('month')
+        # Part way through repartitioning 2015: a month collection exists, and the year still holds a later March document
+        doc_m = self.bb.document_manager
+        early = doc_m._get_key_collection(201503).insert_one({'_id' : ObjectId.from_datetime(datetime(2015, 3, 10)), 'T' : 'Moved'}).inserted_id
+        late = doc_m._collections[2015].insert_one({'_id' : ObjectId.from_datetime(datetime(2015, 3, 20)), 'T' : 'Not moved'}).inserted_id
+        ids = [doc['_id'] for doc in self.bb.find(min_date=['2015-01-01'], max_date=['2016-01-01'], sort=1)]
+        self.assertEqual((ids, len(ids)), (sorted(ids), 3))
+        self.assertEqual([doc['_id'] for doc in self.bb.find(min_date=['2015-01-01'], max_date=['2016-01-01'])], ids[::-1])
+        self.assertEqual([doc['_id'] for doc in self.bb.find(after_id=early, max_date=['2016-01-01'], sort=1)], [late])
+        self.assertEqual(doc_m.bulk_update([(late, {'$set' : {'Routed' : True}}), (early, {'$set' : {'Routed' : True}})])['matched'], 2)
+        self.assertEqual(self.bb.count(query={'Routed' : True}), 2)
+
     def test_add_tag(self):
         obj_id = self.bb.insert({'hasTags' : False})
         self.bb.add_tag(obj_id, 1)
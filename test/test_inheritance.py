@@ -0,0 +1,73 @@
+import sys
+import os.path
+import unittest
+home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
+sys.path.insert(0, home)
+from test import mock_data_generator
+from macsy.api import BlackboardAPI
+from macsy.inheritance import TagPropagator, PropagationReport
+
+class TestInheritance(unittest.TestCase):
+
+    def setUp(self):
+        self.api = BlackboardAPI(mock_data_generator.settings(), MongoClient=mock_data_generator.mock_client)
+        self.feeds = self.api.load_blackboard('FEED')
+        self.articles = self.api.load_blackboard('ARTICLE')
+        self.wire = self.feeds.insert_tag('Source>Wire', inheritable=True)
+
+    def tearDown(self):
+        del self.api
+        del self.feeds
+        del self.articles
+
+    def test_propagate_tags(self):
+        for feed_id in [3, 4]:
+            self.feeds.add_tag(feed_id, self.wire)
+        self.feeds.add_tag(4, 1)
+        self.assertEqual(self.feeds.count(query={'TgC' : {'$exists' : True}}), 2)
+
+        report = self.feeds.propagate_tags(self.articles, link_field='oID')
+        self.assertEqual(report, PropagationReport(parents=2, updates=1, matched=2, modified=2))
+        wire = self.articles.get_tag('Source>Wire')
+        self.assertTrue(wire['DInh'])
+        self.assertEqual(sorted(doc['oID'] for doc in self.articles.find(tags=[wire['_id']])), [3, 4])
+        self.assertEqual(self.articles.count(query={'TgC' : {'$exists' : True}}), 2)
+        # The first run indexes the marker of tag changes, which the incremental runs query
+        self.assertIn({'TgC' : 1}, self.feeds.counter_manager.get_required_indexes())
+        self.assertIn([('TgC', 1)], [index['key'] for index in self.feeds.document_manager._collection.index_information().values()])
+
+        # Only parents changed since the last run are processed
+        self.feeds.update_where({'$unset' : {'TgC' : ''}})
+        self.feeds.update(5, {'Tg' : [self.wire]})
+        self.assertEqual(self.feeds.propagate_tags(self.articles, link_field='oID'), PropagationReport(1, 1, 1, 1))
+        self.assertEqual(self.articles.count(tags=[wire['_id']]), 3)
+        self.assertEqual(self.feeds.propagate_tags(self.articles, link_field='oID', full=True), PropagationReport(3, 1, 0, 0))
+        self.assertEqual(TagPropagator(self.feeds, self.articles, link_field='oID', batch_size=1).run(full=True), PropagationReport(3, 3, 0, 0))
+
+    def test_remove_propagated_tags(self):
+        propagator = TagPropagator(self.feeds, self.articles, link_field='oID', remove=True)
+        self.feeds.add_tag(3, self.wire)
+        propagator.run()
+        self.feeds.update_where({'$unset' : {'TgC' : ''}})
+        self.feeds.remove_tag(3, self.wire)
+        self.assertEqual(propagator.run(), PropagationReport(1, 1, 1, 1))
+        self.assertEqual(self.articles.count(tags=['Source>Wire']), 0)
+        self.assertEqual(propagator.reset(), 2)
+
+    def test_full_run_removes_lost_tags(self):
+        propagator = TagPropagator(self.feeds, self.articles, link_field='oID', remove=True, batch_size=1)
+        for feed_id in [3, 4, 5]:
+            self.feeds.add_tag(feed_id, self.wire)
+        self.assertEqual(propagator.run(), PropagationReport(3, 3, 3, 3))
+        # Tags removed without marking the parents are only found by a full run, from the state of the propagated parents
+        self.feeds.update_where({'$unset' : {'TgC' : ''}})
+        self.feeds.document_manager._collection.update_many({'_id' : {'$in' : [3, 4]}}, {'$pull' : {'Tg' : self.wire}})
+        self.assertEqual(propagator.run(), PropagationReport(0, 0, 0, 0))
+        self.assertEqual(propagator.run(full=True), PropagationReport(3, 3, 2, 2))
+        self.assertEqual(sorted(doc['oID'] for doc in self.articles.find(tags=['Source>Wire'])), [5])
+        self.assertEqual(propagator.run(full=True), PropagationReport(1, 1, 0, 0))
+
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestInheritance)
+    unittest.TextTestRunner().run(suite)
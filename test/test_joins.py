@@ -0,0 +1,49 @@
+import sys
+import os.path
+import unittest
+home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
+sys.path.insert(0, home)
+from datetime import datetime
+from bson import ObjectId
+from test import mock_data_generator
+from macsy.api import BlackboardAPI
+from macsy.joins import BlackboardJoin
+from macsy.utils import LRUCache
+
+class TestJoins(unittest.TestCase):
+
+    def setUp(self):
+        self.api = BlackboardAPI(mock_data_generator.settings(), MongoClient=mock_data_generator.mock_client)
+        self.articles = self.api.load_blackboard('ARTICLE')
+        self.feeds = self.api.load_blackboard('FEED')
+
+    def tearDown(self):
+        del self.api
+        del self.articles
+        del self.feeds
+
+    def test_join(self):
+        docs = list(self.articles.join(self.articles.find(sort=1), self.feeds, 'oID', projection=['Nm']))
+        self.assertEqual([(doc['oID'], doc['FEED']) for doc in docs[:2]], [(1, {'_id' : 1, 'Nm' : 'Feed 1'}), (2, {'_id' : 2, 'Nm' : 'Feed 2'})])
+        self.assertEqual(len(docs), 10)
+
+        # References are fetched once per batch, and cached between batches
+        for day, feeds in enumerate([[1, 2], [2, 99], [1], [], None]):
+            doc = {'_id' : ObjectId.from_datetime(datetime(2016, 2, day + 1)), 'T' : 'Linked {}'.format(day)}
+            self.articles.insert(dict(doc, Fds=feeds) if feeds is not None else doc)
+        join = BlackboardJoin(self.articles.find(query={'T' : {'$regex' : '^Linked'}}, sort=1), self.feeds, 'Fds', into='Feeds', batch_size=2)
+        docs = list(join)
+        self.assertEqual([[feed['Nm'] for feed in doc['Feeds']] for doc in docs[:4]], [['Feed 1', 'Feed 2'], ['Feed 2'], ['Feed 1'], []])
+        self.assertEqual((docs[4]['Feeds'], join.queries, join.hits, join.misses), ([], 1, 1, 3))
+        self.assertIs(docs[0]['Feeds'][1], docs[1]['Feeds'][0])
+
+        self.assertEqual([doc['FEED'] for doc in BlackboardJoin([{'oID' : 99}, {'T' : 'Unlinked'}], self.feeds, 'oID')], [None, None])
+        self.assertEqual([feed['_id'] for feed in next(iter(BlackboardJoin([{'Fds' : [None, 1]}], self.feeds, 'Fds')))['FEED']], [1])
+        cache = LRUCache(1)
+        list(BlackboardJoin([{'Fds' : [1, 2]}, {'Fds' : [1]}], self.feeds, 'Fds', batch_size=1, cache=cache))
+        self.assertEqual((len(cache), cache.hits, cache.misses), (1, 0, 3))
+
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestJoins)
+    unittest.TextTestRunner().run(suite)
@@ -2,6 +2,7 @@ import sys
 import os.path
 import random
 import unittest
+from unittest import mock
 import mongomock 
 import pymongo
 import itertools
@@ -44,6 +45,49 @@ class TestManagers(unittest.TestCase):
         with self.assertRaises(UserWarning): CounterManager(self.bb)
         with self.assertRaises(UserWarning): CounterManager(None)
 
+    def test_query_cache(self):
+        query_builder = self.bb.document_manager._query_builder
+        cache = query_builder._query_cache
+        query = query_builder.build_document_query(tags=['Tag_1'], min_date=['2017-01-01'])
+        query['Tg']['$all'].append(99)
+        self.assertEqual(query_builder.build_document_query(min_date=['2017-01-01'], tags=['Tag_1'])['Tg'], {'$all' : [1]})
+        self.assertEqual((len(cache), cache.hits), (1, 1))
+
+        self.bb.update_tag(1, 'Tag_One')
+        with self.assertRaises(ValueError): query_builder.build_document_query(tags=['Tag_1'])
+        self.assertEqual(query_builder.build_document_query(tags=['Tag_One']), {'Tg' : {'$all' : [1]}})
+        self.assertEqual(len(cache), 1)
+
+        # Tag changes made through another blackboard (e.g. in another process) invalidate the cache too
+        other = self.api.load_blackboard('ARTICLE')
+        self.assertEqual(other.document_manager._query_builder.build_document_query(tags=['Tag_One']), {'Tg' : {'$all' : [1]}})
+        self.bb.update_tag(1, 'Tag_Uno')
+        with mock.patch.object(TagManager, 'version_reload', 0):
+            with self.assertRaises(ValueError): other.document_manager._query_builder.build_document_query(tags=['Tag_One'])
+
+    def test_lru_cache(self):
+        from macsy.utils import LRUCache
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(('a' in cache, 'b' in cache, 'c' in cache, len(cache)), (True, False, True, 2))
+        self.assertEqual((cache.get('b', 0), cache.hits, cache.misses), (0, 1, 1))
+
+    def test_ttl_cache(self):
+        from unittest import mock
+        from macsy.utils import TTLCache
+        cache = TTLCache(2, ttl=10)
+        with mock.patch('time.monotonic', return_value=100.0):
+            cache.put('a', 1)
+            cache.put('b', 2)
+        with mock.patch('time.monotonic', return_value=105.0):
+            cache.put('c', 3)
+            self.assertEqual((cache.get('a'), cache.get('b'), cache.pop('c'), len(cache)), (None, 2, 3, 1))
+        with mock.patch('time.monotonic', return_value=110.0):
+            self.assertEqual(('b' in cache, cache.get('b', 0), cache.hits, cache.misses), (False, 0, 1, 2))
+
 
 if __name__ == '__main__':
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestManagers)
@@ -0,0 +1,77 @@
+import sys
+import os.path
+import unittest
+home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
+sys.path.insert(0, home)
+from test import mock_data_generator
+from macsy.api import BlackboardAPI
+from macsy.blackboards import Blackboard
+from macsy.managers import Partition
+from macsy.mappers import MapReport
+
+def tag_even_feeds(doc):
+    return {'add_tags' : [3], 'fields' : {'Mapped' : True}} if doc['_id'] % 2 == 0 else None
+
+def fail_on_fifth_feed(doc):
+    if doc['_id'] == 5:
+        raise RuntimeError('Annotator failed')
+    return {'fields' : {'Mapped' : True}}
+
+class TestMappers(unittest.TestCase):
+
+    def setUp(self):
+        self.api = BlackboardAPI(mock_data_generator.settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('FEED')
+        self.date_bb = self.api.load_blackboard('ARTICLE')
+
+    def tearDown(self):
+        del self.api
+        del self.bb
+        del self.date_bb
+
+    def test_get_partitions(self):
+        self.assertEqual(self.bb.document_manager.get_partitions(), [Partition(None, None, None)])
+        partitions = self.bb.document_manager.get_partitions(3)
+        self.assertEqual([(x.lower, x.upper) for x in partitions], [(None, 4), (4, 7), (7, None)])
+        self.assertEqual(sum(len(list(self.bb.document_manager.find_partition(x))) for x in partitions), 10)
+        self.assertEqual(len(list(self.bb.document_manager.find_partition(partitions[1], tags=[5]))), 1)
+
+        partitions = self.date_bb.document_manager.get_partitions(min_date=['2015-06-01'])
+        self.assertEqual([x.key for x in partitions], [2015, 2016, 2017, 2018])
+        self.assertEqual(sum(len(list(self.date_bb.document_manager.find_partition(x, min_date=['2015-06-01']))) for x in partitions), 3)
+
+    def test_map(self):
+        progress = []
+        report = self.bb.map(tag_even_feeds, workers=0, batch_size=2, progress=progress.append)
+        self.assertIsInstance(report, MapReport)
+        self.assertEqual((report.processed, report.changed, report.modified, report.failed), (10, 5, 5, []))
+        self.assertEqual(len(progress), len(report.results))
+        self.assertEqual(self.bb.count(query={'Mapped' : True}), 5)
+        self.assertEqual(self.bb.count(tags=[3]), 6)
+
+        report = self.date_bb.map(lambda doc: {'remove_tags' : [5], 'add_tags' : [1]}, workers=0, tags=[5])
+        # Adding and removing tags on the same field needs two updates per document
+        self.assertEqual((report.processed, report.changed, report.modified), (2, 2, 4))
+        self.assertEqual(self.date_bb.count(tags=[5]), 0)
+        self.assertEqual(self.date_bb.count(tags=[1]), 4)
+
+    def test_map_failure_report(self):
+        report = self.bb.map(fail_on_fifth_feed, workers=0)
+        self.assertEqual(len(report.failed), 1)
+        self.assertEqual(report.failed[0].last_id, 4)
+        self.assertIn('Annotator failed', report.failed[0].error)
+        # Changes made before the failure are written back
+        self.assertEqual(self.bb.count(query={'Mapped' : True}), 4)
+
+    def test_map_in_worker_processes(self):
+        report = self.date_bb.map(lambda doc: None, workers=2)
+        self.assertEqual((report.processed, report.changed, report.failed), (10, 0, []))
+        report = self.bb.map(tag_even_feeds, workers=2)
+        self.assertEqual((report.processed, report.changed, report.modified), (10, 5, 5))
+
+        with self.assertRaises(ValueError): Blackboard((self.bb._db, 'FEED', False)).map(tag_even_feeds, workers=2)
+
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestMappers)
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,79 @@
+import sys
+import os.path
+import tempfile
+import unittest
+home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
+sys.path.insert(0, home)
+from datetime import datetime
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from test import mock_data_generator
+from macsy.api import BlackboardAPI
+from macsy.replicas import ReplicaSync, ReplicaBlackboard, SyncReport
+
+class TestReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'ARTICLE.db')
+        self.api = BlackboardAPI(mock_data_generator.settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('ARTICLE')
+
+    def tearDown(self):
+        self.dir.cleanup()
+        del self.api
+        del self.bb
+
+    def test_find_and_count(self):
+        self.assertEqual(self.bb.replicate(self.path), SyncReport(10, 10, 12))
+        replica = ReplicaBlackboard(self.path)
+        queries = [{}, {'tags' : [1]}, {'tags' : ['Tag_2', 12], 'without_tags' : [3]}, {'without_tags' : ['FOR>Tag_11']},
+            {'min_date' : ['2012-01-01'], 'max_date' : ['2015-06-01']}, {'fields' : ['T'], 'tags' : [5]}, {'without_fields' : ['T']},
+            {'query' : {'oID' : {'$gt' : 7}}}, {'query' : {'oID' : {'$gt' : 3}}, 'max_date' : ['2012-06-01']}]
+        for query in queries:
+            self.assertEqual(replica.count(**query), self.bb.count(**query), query)
+            self.assertEqual([doc['_id'] for doc in replica.find(**query)], [doc['_id'] for doc in self.bb.find(**query)], query)
+        self.assertEqual([doc['T'] for doc in replica.find(sort=1, max=2)], ['Title 1', 'Title 2'])
+        self.assertEqual(len(replica.find(tags=[12], max=3)), 3)
+        cursor = replica.find(sort=1, max=3)
+        list(cursor)
+        self.assertEqual([doc['T'] for doc in replica.find(sort=1, after_id=cursor.last_id, max=1)], ['Title 4'])
+        self.assertIsInstance(next(replica.find(raw=True)), RawBSONDocument)
+        self.assertEqual(replica.count_tags(min_date=['2017-01-01']), self.bb.count_tags(min_date=['2017-01-01']))
+        self.assertEqual(replica.count_tags(control=True, query={'oID' : 1}), {'FOR>Tag_11' : 1, 'POST>Tag_12' : 1})
+        with self.assertRaises(ValueError): replica.count(tags=[13])
+        with self.assertRaises(ValueError): replica.find(tags=1)
+
+        first = ObjectId.from_datetime(datetime(2009, 1, 1))
+        self.assertEqual(replica.get(first, ['T']), {'_id' : first, 'T' : 'Title 1'})
+        missing = ObjectId.from_datetime(datetime(2009, 2, 1))
+        docs, not_found = replica.get_many([missing, first], ['T'])
+        self.assertEqual((docs, not_found), ([{'_id' : first, 'T' : 'Title 1'}], [missing]))
+        self.assertEqual((replica.get_tag('Tag_3')['_id'], replica.is_control_tag(11), replica.is_control_tag('Tag_1'), len(replica.get_all_tags())), (3, True, False, 12))
+        self.assertEqual((replica.get_earliest_date().year, replica.get_latest_date().year), (2009, 2018))
+        self.assertEqual(replica.get_counter('HASH_FIELD')['HASH_FIELD'], 'HSH')
+        with self.assertRaises(PermissionError): replica.insert({'T' : 'New'})
+        with self.assertRaises(PermissionError): replica.add_tag(first, 1)
+        with self.assertRaises(FileNotFoundError): ReplicaBlackboard(os.path.join(self.dir.name, 'missing.db'))
+
+    def test_incremental_sync(self):
+        sync = ReplicaSync(self.bb, self.path, fields=['T'])
+        self.assertEqual(sync.run().documents, 10)
+        self.assertEqual(sync.run().documents, 0)
+        first = ObjectId.from_datetime(datetime(2009, 1, 1))
+        self.assertEqual(ReplicaBlackboard(self.path).get(first), {'_id' : first, 'T' : 'Title 1', 'Tg' : [1, 0], 'FOR' : [11, 12]})
+
+        self.bb.insert({'_id' : ObjectId.from_datetime(datetime(2018, 6, 1)), 'T' : 'New', 'D' : 'Skipped', 'Tg' : [4]})
+        self.bb.add_tag(first, 5)
+        self.assertEqual(sync.run().documents, 1)
+        replica = ReplicaBlackboard(self.path)
+        self.assertEqual((replica.count(tags=[4]), replica.count(tags=[5]), replica.count(fields=['D'])), (3, 2, 0))
+        with self.assertRaises(ValueError): ReplicaSync(self.bb, self.path, fields=['T', 'D']).run()
+        self.assertEqual(ReplicaSync(self.bb, self.path, fields=['T', 'D']).run(full=True).documents, 11)
+        self.assertEqual((replica.count(tags=[5]), replica.count(fields=['D'])), (3, 11))
+        with self.assertRaises(ValueError): self.api.load_blackboard('ARTICLE2').replicate(self.path)
+
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestReplicas)
+    unittest.TextTestRunner().run(suite)
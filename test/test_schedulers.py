@@ -0,0 +1,90 @@
+import sys
+import os.path
+import unittest
+home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
+sys.path.insert(0, home)
+from test import mock_data_generator
+from macsy.api import BlackboardAPI
+from macsy.schedulers import BackfillScheduler, BackfillProgress
+
+failing = set()
+
+def mark_feed(doc):
+    if doc['_id'] in failing:
+        raise RuntimeError('Agent crashed')
+    return {'fields' : {'Backfilled' : True}}
+
+class TestSchedulers(unittest.TestCase):
+
+    def setUp(self):
+        self.api = BlackboardAPI(mock_data_generator.settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('FEED')
+        self.date_bb = self.api.load_blackboard('ARTICLE')
+        failing.clear()
+
+    def tearDown(self):
+        del self.api
+        del self.bb
+        del self.date_bb
+
+    def test_backfill_by_month(self):
+        progress = []
+        scheduler = BackfillScheduler(self.date_bb, 'tagger', lambda doc: {'add_tags' : [1]}, concurrency=0, interval='month', progress=progress.append)
+        report = scheduler.run(min_date=['2012-01-01'])
+        self.assertEqual((report.processed, report.modified, report.failed), (7, 7, []))
+        self.assertEqual(len(progress), 7 * 12)
+        self.assertIsInstance(progress[-1], BackfillProgress)
+        self.assertEqual((progress[-1].completed, progress[-1].total, progress[-1].eta), (84, 84, 0))
+        self.assertEqual(len(scheduler.get_completed()), 84)
+        self.assertEqual(self.date_bb.count(tags=[1]), 9)
+
+        # Completed units are skipped when the job is run again
+        report = BackfillScheduler(self.date_bb, 'tagger', lambda doc: {'add_tags' : [1]}, concurrency=0, interval='month').run()
+        self.assertEqual((len(report.results), report.processed), (3 * 12, 3))
+
+        # Different jobs have separate checkpoints
+        report = BackfillScheduler(self.date_bb, 'other', lambda doc: None, concurrency=0).run()
+        self.assertEqual((len(report.results), report.processed), (10, 10))
+        self.assertEqual(scheduler.reset(), 120)
+        self.assertEqual(scheduler.get_completed(), [])
+
+    def test_backfill_resumes_after_failure(self):
+        failing.add(5)
+        scheduler = BackfillScheduler(self.bb, 'marker', mark_feed, concurrency=0, batch_size=1)
+        report = scheduler.run(sort=1)
+        self.assertEqual((report.processed, len(report.failed)), (4, 1))
+        self.assertEqual(scheduler.get_completed(), [])
+
+        failing.clear()
+        report = scheduler.run()
+        self.assertEqual((report.processed, report.failed), (6, []))
+        self.assertEqual(self.bb.count(query={'Backfilled' : True}), 10)
+        self.assertEqual(len(scheduler.get_completed()), 1)
+        self.assertEqual(scheduler.run().processed, 0)
+
+    def test_backfill_resumes_before_write_errors(self):
+        error = {'index' : 0, 'code' : 2, 'errmsg' : 'Write failed', 'op' : {'q' : {'_id' : 3}, 'u' : {}}}
+        bulk_write, calls = self.bb.document_manager._bulk_write, []
+        def rejecting_bulk_write(coll, requests):
+            calls.append(requests)
+            return {'matched' : 0, 'modified' : 0, 'errors' : [error]} if len(calls) == 3 else bulk_write(coll, requests)
+        self.bb.document_manager._bulk_write = rejecting_bulk_write
+        scheduler = BackfillScheduler(self.bb, 'marker', mark_feed, concurrency=0, batch_size=1)
+        report = scheduler.run(sort=1)
+        self.assertEqual((report.processed, len(report.results[0].write_errors)), (10, 1))
+        self.assertEqual((self.bb.count(query={'Backfilled' : True}), scheduler.get_completed()), (9, []))
+
+        # The checkpoint stopped before the failed write, so documents 3 to 10 are processed again
+        del self.bb.document_manager._bulk_write
+        report = scheduler.run(sort=1)
+        self.assertEqual((report.processed, report.results[0].write_errors), (8, []))
+        self.assertEqual((self.bb.count(query={'Backfilled' : True}), len(scheduler.get_completed())), (10, 1))
+
+    def test_backfill_in_worker_processes(self):
+        report = BackfillScheduler(self.date_bb, 'parallel', lambda doc: None, concurrency=2).run()
+        self.assertEqual((len(report.results), report.processed, report.failed), (10, 10, []))
+
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestSchedulers)
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,90 @@
+import sys
+import os.path
+import unittest
+import pymongo
+from unittest import mock
+home = '/'.join(os.path.abspath(__file__).split('/')[0:-2])
+sys.path.insert(0, home)
+from test import mock_data_generator
+from macsy.api import BlackboardAPI
+from macsy.writers import BufferedBlackboard, WriteFailure
+from macsy.managers import TagManager
+
+class TestWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.api = BlackboardAPI(mock_data_generator.settings(), MongoClient=mock_data_generator.mock_client)
+        self.bb = self.api.load_blackboard('FEED')
+        self.date_bb = self.api.load_blackboard('ARTICLE')
+
+    def tearDown(self):
+        del self.api
+        del self.bb
+        del self.date_bb
+
+    def test_coalesced_changes(self):
+        with self.bb.buffered() as writer:
+            self.assertIsInstance(writer, BufferedBlackboard)
+            writer.update(1, {'Checked' : False, 'Sources' : ['a']})
+            writer.update(1, {'Checked' : True, 'Sources' : ['b', 'a']})
+            writer.add_tag(1, [2, 3])
+            writer.remove_tag(1, 3)
+            writer.remove_tag(2, 2)
+            writer.add_tag(2, 2)
+            writer.add_tag(2, 11)
+            self.assertEqual((writer.pending, writer.count(tags=[2])), (2, 1))
+        # Adding and removing tags on the same field of document 1 needs two updates
+        self.assertEqual((writer.pending, writer.matched, writer.modified, writer.errors), (0, 3, 1, []))
+        doc = next(self.bb.find(query={'_id' : 1}))
+        self.assertEqual((doc['Checked'], doc['Sources'], doc['Tg']), (True, ['a', 'b'], [1, 2]))
+        doc = next(self.bb.find(query={'_id' : 2}))
+        self.assertEqual((doc['Tg'], doc['FOR']), ([2], [11, 12]))
+
+    def test_flush_triggers(self):
+        writer = BufferedBlackboard(self.date_bb, max_docs=2)
+        ids = [doc['_id'] for doc in self.date_bb.find(max=3)]
+        writer.add_tag(ids[0], 1)
+        self.assertEqual((writer.pending, self.date_bb.count(tags=[1])), (1, 2))
+        writer.add_tag(ids[1], 1)
+        self.assertEqual((writer.pending, self.date_bb.count(tags=[1])), (0, 4))
+
+        writer = BufferedBlackboard(self.date_bb, max_delay=0)
+        writer.remove_tag(ids[2], 1)
+        self.assertEqual(writer.pending, 0)
+        self.assertEqual(writer.flush(), [])
+
+    def test_write_failures(self):
+        error = {'index' : 0, 'code' : 2, 'errmsg' : 'Cannot apply $addToSet to non-array field', 'op' : {'q' : {'_id' : 3}, 'u' : {'$set' : {}}}}
+        self.bb.document_manager._bulk_write = lambda coll, requests: {'matched' : len(requests) - 1, 'modified' : len(requests) - 1, 'errors' : [error]}
+        writer = self.bb.buffered()
+        writer.add_tag(3, 1)
+        writer.add_tag(4, 1)
+        failures = writer.flush()
+        self.assertEqual(failures, [WriteFailure(3, {'$set' : {}}, 2, 'Cannot apply $addToSet to non-array field')])
+        self.assertEqual((writer.errors, writer.matched), (failures, 1))
+
+        # Changes stay queued when the bulk write raises
+        def failing_bulk_write(coll, requests):
+            raise pymongo.errors.AutoReconnect('connection lost')
+        self.bb.document_manager._bulk_write = failing_bulk_write
+        writer = self.bb.buffered()
+        writer.update(5, {'Checked' : True})
+        with self.assertRaises(pymongo.errors.AutoReconnect): writer.flush()
+        self.assertEqual(writer.pending, 1)
+        del self.bb.document_manager._bulk_write
+        self.assertEqual((writer.flush(), writer.pending, self.bb.get(5)['Checked']), ([], 0, True))
+
+    def test_tag_lookups(self):
+        # The control tags are read once for a flush, not looked up per tag of each document
+        with mock.patch.object(TagManager, 'get_tag', wraps=self.bb.tag_manager.get_tag) as get_tag, \
+                mock.patch.object(TagManager, 'get_control_tags', wraps=self.bb.tag_manager.get_control_tags) as get_control_tags:
+            with self.bb.buffered() as writer:
+                for doc_id in range(1, 11):
+                    writer.add_tag(doc_id, [1, 2, 11])
+        self.assertEqual((get_tag.call_count, get_control_tags.call_count), (0, 1))
+        self.assertEqual((self.bb.count(tags=[1, 2]), self.bb.count(query={'FOR' : 11})), (10, 10))
+
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestWriters)
+    unittest.TextTestRunner().run(suite)